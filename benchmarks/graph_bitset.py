@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+"""内存鉴权图：角色权限使用 Bitset 与 set 的内存占用及检查耗时对比
+
+用法（在项目根目录）::
+
+    PYTHONPATH=src python3 benchmarks/graph_bitset.py \\
+        --permissions 100000 --roles 10000 --role-permissions 500
+
+不访问数据库，直接向 `AuthzGraph` 应用变更构造数据。每个角色随机分配
+`--role-permissions` 个权限，用户随机拥有 `--user-roles` 个角色。
+"""
+
+import argparse
+import gc
+import random
+import statistics
+import time
+import tracemalloc
+
+from codebase.graph import AuthzGraph
+from codebase.models import Change
+
+
+def traced(func, *args):
+    """返回 (func 的结果, 执行期间新增且未释放的内存)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = func(*args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return result, size
+
+
+def build_graph(args, assignments):
+    graph = AuthzGraph()
+    graph.loaded = True
+    for perm_id in range(1, args.permissions + 1):
+        graph.apply([Change("add", "permission", perm_id,
+                            uuid=perm_id, name=f"perm-{perm_id}")])
+
+    def add_role_permissions():
+        for role_id, perm_ids in assignments.items():
+            graph.apply([Change("add", "role", role_id)])
+            graph.apply([Change("add", "role_permission", role_id, ref_id=p)
+                         for p in perm_ids])
+
+    _, size = traced(add_role_permissions)
+    return graph, size
+
+
+def build_sets(assignments):
+    """role id -> set(permission id) ，即改用 Bitset 之前的结构，作为对照
+    """
+    return traced(lambda: {
+        role_id: set(perm_ids) for role_id, perm_ids in assignments.items()})
+
+
+def measure(func, checks):
+    costs = []
+    for user_id, perm_id in checks:
+        start = time.perf_counter()
+        func(user_id, perm_id)
+        costs.append(time.perf_counter() - start)
+    costs.sort()
+    return {
+        "p50": statistics.median(costs) * 1e6,
+        "p99": costs[int(len(costs) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--permissions", type=int, default=100000)
+    parser.add_argument("--roles", type=int, default=10000)
+    parser.add_argument("--role-permissions", type=int, default=500,
+                        help="每个角色的权限数")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--user-roles", type=int, default=5,
+                        help="每个用户的角色数")
+    parser.add_argument("--checks", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    perm_ids = range(1, args.permissions + 1)
+    # 权限 id 使用新创建的 int 对象，与从数据库读取时一致
+    assignments = {
+        role_id: [int(str(p)) for p in rng.sample(
+            perm_ids, args.role_permissions)]
+        for role_id in range(1, args.roles + 1)}
+    graph, bitset_size = build_graph(args, assignments)
+    sets, set_size = build_sets(assignments)
+
+    role_ids = list(assignments)
+    for user_id in range(1, args.users + 1):
+        graph.user_roles[user_id] = frozenset(
+            rng.sample(role_ids, args.user_roles))
+
+    checks = [(rng.randint(1, args.users), rng.randint(1, args.permissions))
+              for _ in range(args.checks)]
+
+    def check_sets(user_id, perm_id):
+        # 与改用 Bitset 之前的 AuthzGraph.has_permission 相同
+        for role_id in graph.user_roles.get(user_id, ()):
+            if role_id in graph.admin_roles:
+                return True
+            perms = sets.get(role_id)
+            if perms and perm_id in perms:
+                return True
+        return False
+
+    # 两种结构的检查结果必须一致
+    for user_id, perm_id in checks[:1000]:
+        assert graph.has_permission(user_id, perm_id) == \
+            check_sets(user_id, perm_id)
+
+    print(f"{args.permissions} permissions x {args.roles} roles, "
+          f"{args.role_permissions} permissions per role, "
+          f"{args.user_roles} roles per user")
+    for name, size, func in [
+            ("bitset", bitset_size, graph.has_permission),
+            ("set", set_size, check_sets)]:
+        stats = measure(func, checks)
+        print(f"{name:>8}: memory {size / 2 ** 20:8.1f} MiB  "
+              f"p50 {stats['p50']:6.2f}us  p99 {stats['p99']:6.2f}us")
+
+    # 首次检查某个角色组合时计算并集，之后命中缓存
+    effective = graph._effective  # pylint: disable=protected-access
+    print(f"effective permission cache: {len(effective)} role sets, "
+          f"{sum(len(b) for b in effective.values()) / 2 ** 20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
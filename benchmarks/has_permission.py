@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+"""对比 ORM 与 SQL 两种鉴权方式的查询次数与耗时
+
+用法（在项目根目录）::
+
+    PYTHONPATH=src python3 benchmarks/has_permission.py --roles 20 --permissions 50
+
+默认使用 `settings.DB_URI` （sqlite 内存数据库），可以通过环境变量 `DB_URI`
+指定其他数据库。注意：脚本会清空并重建数据库！
+"""
+
+import argparse
+import statistics
+import time
+import uuid
+
+from sqlalchemy import event
+from eva.conf import settings
+
+from codebase.utils.sqlalchemy import dbc
+from codebase.models import (
+    User,
+    Role,
+    Permission,
+    _USER_ROLES,
+    _ROLE_PERMISSIONS,
+)
+
+
+class QueryCounter:
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *_args):
+        self.count += 1
+
+
+def seed(roles, permissions):
+    """创建一个拥有 `roles` 个角色、每个角色 `permissions` 个权限的用户
+    """
+    dbc.drop_all()
+    dbc.create_all()
+
+    conn = dbc.engine
+    user_uuid = uuid.uuid4()
+    conn.execute(User.__table__.insert(), [{"uuid": user_uuid}])
+    user_id = conn.execute(
+        User.__table__.select().where(User.uuid == user_uuid)).first().id
+
+    role_rows = [{"name": f"bench-role-{i}", "uuid": uuid.uuid4()}
+                 for i in range(roles)]
+    perm_rows = [{"name": f"bench-permission-{i}", "uuid": uuid.uuid4()}
+                 for i in range(roles * permissions)]
+    conn.execute(Role.__table__.insert(), role_rows)
+    conn.execute(Permission.__table__.insert(), perm_rows)
+
+    role_ids = [r.id for r in conn.execute(
+        Role.__table__.select().where(Role.name.like("bench-role-%")))]
+    perm_ids = [p.id for p in conn.execute(
+        Permission.__table__.select().where(
+            Permission.name.like("bench-permission-%")))]
+
+    conn.execute(_USER_ROLES.insert(), [
+        {"user_id": user_id, "role_id": role_id} for role_id in role_ids])
+    conn.execute(_ROLE_PERMISSIONS.insert(), [
+        {"role_id": role_id, "permission_id": perm_ids[i * permissions + j]}
+        for i, role_id in enumerate(role_ids) for j in range(permissions)])
+
+    # 检查最后一个角色的最后一个权限，即 ORM 方式的最坏情况
+    return str(user_uuid), perm_rows[-1]["name"]
+
+
+def check_orm(user_id, perm_name):
+    db = dbc.session()
+    try:
+        user = db.query(User).filter_by(uuid=user_id).first()
+        perm = db.query(Permission).filter_by(name=perm_name).first()
+        return user.has_permission(perm)
+    finally:
+        dbc.session.remove()
+
+
+def check_sql(user_id, perm_name):
+    db = dbc.session()
+    try:
+        return User.check_permission(db, user_id, permission_name=perm_name)[2]
+    finally:
+        dbc.session.remove()
+
+
+def run(name, func, counter, iterations, *args):
+    assert func(*args), f"{name}: permission expected"
+    counter.count = 0
+    func(*args)
+    queries = counter.count
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "method": name,
+        "queries": queries,
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[int(len(timings) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--roles", type=int, default=20,
+                        help="用户拥有的角色数")
+    parser.add_argument("--permissions", type=int, default=50,
+                        help="每个角色拥有的权限数")
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"DB_URI={settings.DB_URI} roles={args.roles} "
+          f"permissions/role={args.permissions}")
+    user_id, perm_name = seed(args.roles, args.permissions)
+    counter = QueryCounter(dbc.engine)
+
+    results = [
+        run("orm", check_orm, counter, args.iterations, user_id, perm_name),
+        run("sql", check_sql, counter, args.iterations, user_id, perm_name),
+    ]
+    print(f"{'method':8}{'queries':>10}{'p50(ms)':>12}{'p99(ms)':>12}")
+    for r in results:
+        print(f"{r['method']:8}{r['queries']:>10}"
+              f"{r['p50_ms']:>12.3f}{r['p99_ms']:>12.3f}")
+
+    dbc.drop_all()
+
+
+if __name__ == "__main__":
+    main()
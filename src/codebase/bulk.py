@@ -0,0 +1,384 @@
+# pylint: disable=C0103
+"""授权数据批量导入/导出（NDJSON）
+
+每行一个 JSON 对象，`type` 表示记录类型：
+
+    {"type": "permission", "name": "...", "summary": "...", "description": "..."}
+    {"type": "role", "name": "...", "summary": "...", "description": "..."}
+    {"type": "role_parent", "role": "角色名称", "parent": "父角色名称"}
+    {"type": "role_permission", "role": "角色名称", "permission": "权限名称"}
+    {"type": "user_role", "user": "用户ID", "role": "角色名称"}
+
+导入时按类型分块，每块使用集合查询解析名称/ID，批量插入不存在的记录与关联，
+每块一个事务；已存在的记录与关联跳过，缺失的角色、权限、用户自动创建。
+导出时按键分页逐块读取。两者内存占用与数据量无关。
+
+`ensure_users` / `ensure_entities` / `insert_links` / `delete_links` 为不经过 ORM
+的集合操作（同时登记变更），也用于批量修改用户角色、角色权限的接口。
+"""
+
+import datetime
+import json
+import uuid
+
+from eva.conf import settings
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from codebase.models import (
+    User,
+    Role,
+    Permission,
+    Change,
+    record_changes,
+    _USER_ROLES,
+    _ROLE_PERMISSIONS,
+    _ROLE_PARENTS,
+)
+from codebase.utils.cache import TTLCache
+from codebase.utils.sqlalchemy import dbc
+from codebase.utils.sqlalchemy.page import iter_keyset_pages
+
+
+# 多行 INSERT 每条语句的行数（PostgreSQL 单条语句最多 65535 个参数）
+_INSERT_BATCH = 1000
+
+RECORD_TYPES = [
+    "permission", "role", "role_parent", "role_permission", "user_role"]
+
+
+class BulkError(ValueError):
+    """导入数据格式错误，消息为错误码（如 `invalid-json:3` ）
+    """
+
+
+def parse_line(line, lineno):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise BulkError(f"invalid-json:{lineno}")
+    if not isinstance(record, dict) or record.get("type") not in RECORD_TYPES:
+        raise BulkError(f"invalid-record:{lineno}")
+    try:
+        if record["type"] in ("permission", "role"):
+            if not isinstance(record["name"], str):
+                raise KeyError("name")
+        elif record["type"] == "role_parent":
+            record["role"], record["parent"] = (
+                str(record["role"]), str(record["parent"]))
+        elif record["type"] == "role_permission":
+            record["role"], record["permission"] = (
+                str(record["role"]), str(record["permission"]))
+        else:
+            record["user"] = uuid.UUID(str(record["user"]))
+            record["role"] = str(record["role"])
+    except (KeyError, ValueError):
+        raise BulkError(f"invalid-record:{lineno}")
+    return record
+
+
+def ensure_users(db, uuids):
+    """确保给定 uuid 的用户存在，批量创建不存在的用户
+
+    返回 `({uuid: user id}, 新建的用户数)`
+    """
+    uuids = set(uuids)
+    users = {}
+    q = db.query(User.id, User.uuid).filter(User.uuid.in_(uuids))
+    users.update({_uuid: _id for _id, _uuid in q})
+
+    new = uuids - set(users)
+    if new:
+        now = datetime.datetime.utcnow()
+        db.execute(User.__table__.insert(), [
+            {"uuid": _uuid, "created": now} for _uuid in new])
+        q = db.query(User.id, User.uuid).filter(User.uuid.in_(new))
+        changes = []
+        for _id, _uuid in q:
+            users[_uuid] = _id
+            changes.append(Change("add", "user", _id, uuid=_uuid))
+        record_changes(db, changes)
+    return users, len(new)
+
+
+def ensure_entities(db, model, kind, rows):
+    """确保给定名称的角色/权限存在，批量创建不存在的记录
+
+    `rows` 为 name -> 属性字典（`summary` 、`description`），返回
+    `({name: id}, 新建的数量)`
+    """
+    result = {}
+    if not rows:
+        return result, 0
+    q = db.query(model.id, model.name).filter(model.name.in_(set(rows)))
+    result.update({name: _id for _id, name in q})
+
+    new = [name for name in rows if name not in result]
+    if new:
+        now = datetime.datetime.utcnow()
+        db.execute(model.__table__.insert(), [{
+            "name": name,
+            "uuid": uuid.uuid4(),
+            "summary": rows[name].get("summary"),
+            "description": rows[name].get("description"),
+            "created": now,
+            "updated": now,
+        } for name in new])
+        changes = []
+        q = db.query(model.id, model.uuid, model.name).filter(
+            model.name.in_(new))
+        for _id, _uuid, name in q:
+            result[name] = _id
+            changes.append(Change("add", kind, _id, uuid=_uuid, name=name))
+        record_changes(db, changes)
+    return result, len(new)
+
+
+def insert_links(db, table, left, right, kind, pairs):
+    """插入不存在的关联关系（去重），返回插入的数量
+
+    先查询已存在的关联，只插入缺失的部分。并发请求可能在查询之后插入相同的关联，
+    由唯一索引保证不重复：PostgreSQL 使用 `ON CONFLICT DO NOTHING RETURNING` ，
+    只登记实际插入的关联；sqlite 使用 `INSERT OR IGNORE` （写入串行执行）。
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return 0
+    left_ids = {a for a, _ in pairs}
+    right_ids = {b for _, b in pairs}
+    exist = db.execute(select([left, right]).where(
+        left.in_(left_ids)).where(right.in_(right_ids)))
+    pairs -= {(a, b) for a, b in exist}
+    if not pairs:
+        return 0
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        rows = sorted(pairs)
+        pairs = set()
+        for i in range(0, len(rows), _INSERT_BATCH):
+            stmt = pg_insert(table).values([
+                {left.key: a, right.key: b}
+                for a, b in rows[i:i + _INSERT_BATCH]
+            ]).on_conflict_do_nothing().returning(left, right)
+            pairs.update((a, b) for a, b in db.execute(stmt))
+    else:
+        stmt = table.insert()
+        if dialect == "sqlite":
+            stmt = stmt.prefix_with("OR IGNORE")
+        db.execute(stmt, [{left.key: a, right.key: b} for a, b in pairs])
+    record_changes(db, [Change("add", kind, a, ref_id=b) for a, b in pairs])
+    return len(pairs)
+
+
+def delete_links(db, table, left, right, kind, left_ids, right_ids):
+    """删除 `left_ids` 与 `right_ids` 之间（笛卡尔积）已存在的关联关系，返回删除
+    的数量
+    """
+    if not left_ids or not right_ids:
+        return 0
+    where = left.in_(set(left_ids)) & right.in_(set(right_ids))
+    pairs = {(a, b) for a, b in db.execute(select([left, right]).where(where))}
+    if not pairs:
+        return 0
+
+    db.execute(table.delete().where(where))
+    record_changes(db, [Change("remove", kind, a, ref_id=b) for a, b in pairs])
+    return len(pairs)
+
+
+class Importer:
+    """流式导入
+
+    使用方式::
+
+        importer = Importer()
+        for lineno, line in enumerate(lines, 1):
+            importer.feed_line(line, lineno)
+        importer.close()
+
+    `stats` 记录各类型新增的记录数。
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = int(chunk_size or settings.BULK_CHUNK_SIZE)
+        self.db = dbc.session.session_factory()
+        self.buffers = {t: [] for t in RECORD_TYPES}
+        self.stats = {t: 0 for t in RECORD_TYPES}
+        self.stats["lines"] = 0
+        self.closed = False
+        # 名称 -> id ，角色与权限的数量远小于关联关系，缓存以减少查询
+        self.role_ids = TTLCache(maxsize=100000)
+        self.permission_ids = TTLCache(maxsize=100000)
+
+    def feed_line(self, line, lineno):
+        line = line.strip()
+        if not line:
+            return
+        self.feed(parse_line(line, lineno))
+
+    def feed(self, record):
+        self.stats["lines"] += 1
+        buf = self.buffers[record["type"]]
+        buf.append(record)
+        if len(buf) >= self.chunk_size:
+            self.flush(record["type"])
+
+    def flush(self, record_type=None):
+        types = [record_type] if record_type else RECORD_TYPES
+        # 关联关系依赖角色与权限，先写入缓存中的角色与权限
+        if any(t not in ("permission", "role") for t in types):
+            types = ["permission", "role"] + types
+        for t in types:
+            buf = self.buffers[t]
+            if not buf:
+                continue
+            self.buffers[t] = []
+            try:
+                getattr(self, f"_import_{t}")(buf)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            self.db.close()
+
+    def abort(self):
+        """放弃尚未写入的记录（已提交的块不回滚），可以重复调用
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.buffers = {t: [] for t in RECORD_TYPES}
+        try:
+            self.db.rollback()
+        finally:
+            self.db.close()
+
+    def _ensure_entities(self, model, kind, cache, rows):
+        """同 `ensure_entities` ，只返回 name -> id ，并使用名称缓存
+
+        `rows` 为 name -> 属性字典
+        """
+        result = {}
+        missing = {}
+        for name, row in rows.items():
+            _id = cache.get(name)
+            if _id is None:
+                missing[name] = row
+            else:
+                result[name] = _id
+
+        if missing:
+            ids, new = ensure_entities(self.db, model, kind, missing)
+            for name, _id in ids.items():
+                cache.set(name, _id)
+            result.update(ids)
+            self.stats[kind] += new
+        return result
+
+    def _import_permission(self, records):
+        self._ensure_entities(
+            Permission, "permission", self.permission_ids,
+            {r["name"]: r for r in records})
+
+    def _import_role(self, records):
+        self._ensure_entities(
+            Role, "role", self.role_ids, {r["name"]: r for r in records})
+
+    def _insert_links(self, table, left, right, kind, pairs):
+        self.stats[kind] += insert_links(self.db, table, left, right, kind, pairs)
+
+    def _import_role_parent(self, records):
+        """继承关系需要检查环并维护闭包表，逐条通过 `Role.add_parent` 写入
+        """
+        names = {r["role"]: {} for r in records}
+        names.update({r["parent"]: {} for r in records})
+        ids = self._ensure_entities(Role, "role", self.role_ids, names)
+        roles = {r.id: r for r in self.db.query(Role).filter(
+            Role.id.in_(set(ids.values())))}
+        for r in records:
+            role, parent = roles[ids[r["role"]]], roles[ids[r["parent"]]]
+            if parent is role or role.is_ancestor_of(self.db, parent):
+                raise BulkError(f"role-cycle:{r['role']}:{r['parent']}")
+            if role.add_parent(self.db, parent):
+                self.stats["role_parent"] += 1
+
+    def _import_role_permission(self, records):
+        roles = self._ensure_entities(
+            Role, "role", self.role_ids, {r["role"]: {} for r in records})
+        perms = self._ensure_entities(
+            Permission, "permission", self.permission_ids,
+            {r["permission"]: {} for r in records})
+        self._insert_links(
+            _ROLE_PERMISSIONS,
+            _ROLE_PERMISSIONS.c.role_id, _ROLE_PERMISSIONS.c.permission_id,
+            "role_permission",
+            [(roles[r["role"]], perms[r["permission"]]) for r in records])
+
+    def _import_user_role(self, records):
+        roles = self._ensure_entities(
+            Role, "role", self.role_ids, {r["role"]: {} for r in records})
+        users, _ = ensure_users(self.db, (r["user"] for r in records))
+        self._insert_links(
+            _USER_ROLES, _USER_ROLES.c.user_id, _USER_ROLES.c.role_id,
+            "user_role",
+            [(users[r["user"]], roles[r["role"]]) for r in records])
+
+
+def export_chunks(chunk_size=None):
+    """按块生成导出记录（字典列表），按主键（关联表为联合唯一键）分页读取，
+    不一次性加载全部数据
+    """
+    chunk_size = int(chunk_size or settings.BULK_CHUNK_SIZE)
+    role = Role.__table__
+    parent = Role.__table__.alias("parent")
+    perm = Permission.__table__
+    user = User.__table__
+    ur, rp, rpa = _USER_ROLES.c, _ROLE_PERMISSIONS.c, _ROLE_PARENTS.c
+
+    queries = [
+        ("permission",
+         select([perm.c.name, perm.c.summary, perm.c.description]),
+         [perm.c.id],
+         lambda r: {"name": r[0], "summary": r[1], "description": r[2]}),
+        ("role",
+         select([role.c.name, role.c.summary, role.c.description]),
+         [role.c.id],
+         lambda r: {"name": r[0], "summary": r[1], "description": r[2]}),
+        ("role_parent",
+         select([role.c.name, parent.c.name]).select_from(
+             _ROLE_PARENTS
+             .join(role, role.c.id == rpa.role_id)
+             .join(parent, parent.c.id == rpa.parent_id)),
+         [rpa.role_id, rpa.parent_id],
+         lambda r: {"role": r[0], "parent": r[1]}),
+        ("role_permission",
+         select([role.c.name, perm.c.name]).select_from(
+             _ROLE_PERMISSIONS
+             .join(role, role.c.id == rp.role_id)
+             .join(perm, perm.c.id == rp.permission_id)),
+         [rp.role_id, rp.permission_id],
+         lambda r: {"role": r[0], "permission": r[1]}),
+        ("user_role",
+         select([user.c.uuid, role.c.name]).select_from(
+             _USER_ROLES
+             .join(user, user.c.id == ur.user_id)
+             .join(role, role.c.id == ur.role_id)),
+         [ur.user_id, ur.role_id],
+         lambda r: {"user": str(r[0]), "role": r[1]}),
+    ]
+
+    with dbc.engine.connect() as conn:
+        for record_type, query, keys, convert in queries:
+            for rows in iter_keyset_pages(conn, query, keys, chunk_size):
+                yield [dict(type=record_type, **convert(row)) for row in rows]
+
+
+def dump_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
@@ -1,12 +1,27 @@
 # pylint: disable=W0223,W0221
 
+import uuid
+
 from tornado.web import HTTPError
+from eva.conf import settings
 
 from codebase.web import APIRequestHandler
 from codebase.models import (
     User,
-    Permission
+    Role,
+    Permission,
+    _USER_ROLES,
+    _ROLE_PERMISSIONS,
+    effective_user_roles,
 )
+from codebase.graph import graph, uuid_key
+from codebase.utils.metrics import REGISTRY
+from codebase.utils.sqlalchemy import dbc
+
+
+decisions = REGISTRY.counter(
+    "authz_decisions_total", "Permission check decisions.",
+    ("handler", "decision"))
 
 
 class _Base(APIRequestHandler):
@@ -29,46 +44,247 @@ class _Base(APIRequestHandler):
             return perm
         raise HTTPError(400, reason="invalid-permission")
 
+    @property
+    def use_graph(self):
+        return settings.AUTHZ_ENGINE == "memory"
+
+    @property
+    def use_sql(self):
+        return settings.AUTHZ_ENGINE == "sql"
+
+    def check_permission_by_sql(self, user_id, **kwargs):
+        uid, pid, granted = User.check_permission(self.db, user_id, **kwargs)
+        if uid is None:
+            raise HTTPError(400, reason="invalid-user")
+        if pid is None:
+            raise HTTPError(400, reason="invalid-permission")
+        return granted
+
+    async def run_check(self, func, *args):
+        """内存引擎直接检查，其他引擎在数据库线程池中执行
+        """
+        if self.use_graph:
+            return func(*args)
+        return await dbc.run_in_executor(func, *args)
+
+    def get_graph_user_id(self, _id):
+        graph.ensure_loaded()
+        user_id = graph.get_user_id(_id)
+        if user_id is not None:
+            return user_id
+        raise HTTPError(400, reason="invalid-user")
+
+    def check_permission_by_name(self, user_id, perm_name):
+        if self.use_graph:
+            uid = self.get_graph_user_id(user_id)
+            perm_id = graph.get_permission_id_by_name(perm_name)
+            if perm_id is None:
+                raise HTTPError(400, reason="invalid-permission")
+            return graph.has_permission(uid, perm_id)
+
+        if self.use_sql:
+            return self.check_permission_by_sql(
+                user_id, permission_name=perm_name)
+
+        user = self.get_user(user_id)
+        perm = self.get_permission_by_name(perm_name)
+        return user.has_permission(perm)
+
+    def check_permission_by_id(self, user_id, perm_id):
+        if self.use_graph:
+            uid = self.get_graph_user_id(user_id)
+            pid = graph.get_permission_id_by_uuid(perm_id)
+            if pid is None:
+                raise HTTPError(400, reason="invalid-permission")
+            return graph.has_permission(uid, pid)
+
+        if self.use_sql:
+            return self.check_permission_by_sql(user_id, permission_id=perm_id)
+
+        user = self.get_user(user_id)
+        perm = self.get_permission_by_id(perm_id)
+        return user.has_permission(perm)
+
+    def decided(self, status):
+        decisions.inc((type(self).__name__, status))
+        return status
+
 
 class HasPermissionHandler(_Base):
     """检查用户是否拥有某项权限
     """
 
-    def get(self):
+    async def get(self):
         user_id = self.get_query_argument("user_id")
         perm_name = self.get_query_argument("permission_name")
-        self.do_has_permission(user_id, perm_name)
+        await self.do_has_permission(user_id, perm_name)
 
-    def post(self):
+    async def post(self):
         body = self.get_body_json()
-        self.do_has_permission(body["user_id"], body["permission_name"])
+        await self.do_has_permission(body["user_id"], body["permission_name"])
 
-    def do_has_permission(self, user_id, perm_name):
-        user = self.get_user(user_id)
-        perm = self.get_permission_by_name(perm_name)
-        if user.has_permission(perm):
-            self.success(status="yes")
+    async def do_has_permission(self, user_id, perm_name):
+        if await self.run_check(self.check_permission_by_name, user_id, perm_name):
+            self.success(status=self.decided("yes"))
         else:
-            self.success(status="no")
+            self.success(status=self.decided("no"))
 
 
 class HasPermissionIDHandler(_Base):
     """检查用户是否拥有某项权限（使用权限ID）
     """
 
-    def get(self):
+    async def get(self):
         user_id = self.get_query_argument("user_id")
         perm_id = self.get_query_argument("permission_id")
-        self.do_has_permission(user_id, perm_id)
+        await self.do_has_permission(user_id, perm_id)
 
-    def post(self):
+    async def post(self):
         body = self.get_body_json()
-        self.do_has_permission(body["user_id"], body["permission_id"])
+        await self.do_has_permission(body["user_id"], body["permission_id"])
 
-    def do_has_permission(self, user_id, perm_id):
-        user = self.get_user(user_id)
-        perm = self.get_permission_by_id(perm_id)
-        if user.has_permission(perm):
-            self.success(status="yes")
+    async def do_has_permission(self, user_id, perm_id):
+        if await self.run_check(self.check_permission_by_id, user_id, perm_id):
+            self.success(status=self.decided("yes"))
         else:
-            self.success(status="no")
+            self.success(status=self.decided("no"))
+
+
+class HasPermissionBatchHandler(_Base):
+    """批量检查用户是否拥有权限
+
+    用户、权限与授权关系均使用集合查询一次性解析，不随检查项数量增加查询次数。
+    """
+
+    async def post(self):
+        body = self.get_body_json()
+        checks = body.get("checks")
+        if not isinstance(checks, list):
+            self.fail("invalid-checks")
+            return
+        if len(checks) > int(settings.HAS_PERMISSION_BATCH_LIMIT):
+            self.fail("too-many-checks")
+            return
+        for item in checks:
+            if not (isinstance(item, dict) and "user_id" in item and
+                    ("permission_name" in item or "permission_id" in item)):
+                self.fail("invalid-checks")
+                return
+
+        # 字段不是字符串的检查项不参与查询，直接返回对应的错误
+        invalid = [self.invalid_field(item) for item in checks]
+        valid = [item for item, error in zip(checks, invalid) if not error]
+        if self.use_graph:
+            decide = self.decide_by_graph(valid)
+        else:
+            decide = await dbc.run_in_executor(self.decide_by_db, valid)
+
+        data = []
+        for item, error in zip(checks, invalid):
+            result = dict(item)
+            result["status"] = self.decided(error or decide(item))
+            data.append(result)
+        self.success(data=data)
+
+    @staticmethod
+    def invalid_field(item):
+        """检查项的字段类型错误时返回 `invalid-user` / `invalid-permission`
+        """
+        if not isinstance(item["user_id"], str):
+            return "invalid-user"
+        perm = item.get("permission_name", item.get("permission_id"))
+        if not isinstance(perm, str):
+            return "invalid-permission"
+        return None
+
+    def decide_by_graph(self, _checks):
+        graph.ensure_loaded()
+
+        def decide(item):
+            user_id = graph.get_user_id(item["user_id"])
+            if user_id is None:
+                return "invalid-user"
+            if "permission_name" in item:
+                perm_id = graph.get_permission_id_by_name(
+                    item["permission_name"])
+            else:
+                perm_id = graph.get_permission_id_by_uuid(
+                    item["permission_id"])
+            if perm_id is None:
+                return "invalid-permission"
+            return "yes" if graph.has_permission(user_id, perm_id) else "no"
+
+        return decide
+
+    def decide_by_db(self, checks):
+        user_keys = set()
+        perm_names = set()
+        perm_keys = set()
+        for item in checks:
+            user_keys.add(uuid_key(item["user_id"]))
+            if "permission_name" in item:
+                perm_names.add(item["permission_name"])
+            else:
+                perm_keys.add(uuid_key(item["permission_id"]))
+        user_keys.discard(None)
+        perm_keys.discard(None)
+
+        users = {}
+        if user_keys:
+            q = self.db.query(User.id, User.uuid).filter(
+                User.uuid.in_([uuid.UUID(int=k) for k in user_keys]))
+            users = {uuid_key(_uuid): _id for _id, _uuid in q}
+
+        perms_by_name = {}
+        if perm_names:
+            q = self.db.query(Permission.id, Permission.name).filter(
+                Permission.name.in_(perm_names))
+            perms_by_name = {name: _id for _id, name in q}
+
+        perms_by_uuid = {}
+        if perm_keys:
+            q = self.db.query(Permission.id, Permission.uuid).filter(
+                Permission.uuid.in_([uuid.UUID(int=k) for k in perm_keys]))
+            perms_by_uuid = {uuid_key(_uuid): _id for _id, _uuid in q}
+
+        admins = set()
+        granted = set()
+        user_ids = set(users.values())
+        perm_ids = set(perms_by_name.values()) | set(perms_by_uuid.values())
+        # 用户直接拥有的角色及其继承的祖先角色
+        roles = effective_user_roles(_USER_ROLES.c.user_id.in_(user_ids))
+        if user_ids:
+            # 拥有超级管理员角色的用户
+            q = self.db.query(roles.c.user_id).join(
+                Role, Role.id == roles.c.role_id,
+            ).filter(
+                Role.name == settings.ADMIN_ROLE_NAME,
+            )
+            admins = {user_id for user_id, in q}
+
+        if user_ids and perm_ids:
+            q = self.db.query(
+                roles.c.user_id, _ROLE_PERMISSIONS.c.permission_id,
+            ).join(
+                _ROLE_PERMISSIONS,
+                _ROLE_PERMISSIONS.c.role_id == roles.c.role_id,
+            ).filter(
+                _ROLE_PERMISSIONS.c.permission_id.in_(perm_ids),
+            ).distinct()
+            granted = set(q)
+
+        def decide(item):
+            user_id = users.get(uuid_key(item["user_id"]))
+            if user_id is None:
+                return "invalid-user"
+            if "permission_name" in item:
+                perm_id = perms_by_name.get(item["permission_name"])
+            else:
+                perm_id = perms_by_uuid.get(uuid_key(item["permission_id"]))
+            if perm_id is None:
+                return "invalid-permission"
+            if user_id in admins or (user_id, perm_id) in granted:
+                return "yes"
+            return "no"
+
+        return decide
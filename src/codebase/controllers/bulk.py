@@ -0,0 +1,123 @@
+# pylint: disable=W0221,W0223,W0201
+
+import tornado.ioloop
+import tornado.locks
+import tornado.web
+from eva.conf import settings
+from tornado.log import app_log
+
+from codebase.web import APIRequestHandler
+from codebase.bulk import Importer, BulkError, export_chunks, dump_record
+from codebase.utils.sqlalchemy import dbc
+
+
+@tornado.web.stream_request_body
+class BulkImportHandler(APIRequestHandler):
+    """批量导入（NDJSON）
+
+    请求体按块接收、按行解析，导入在数据库线程池中分块执行，不缓存整个请求体。
+    导入器的会话在每个请求中独占，对它的操作依次执行（`_lock`）；请求出错、
+    结束或客户端中途断开时回滚并关闭会话，释放数据库连接。
+    """
+
+    def prepare(self):
+        super().prepare()
+        self.request.connection.set_max_body_size(
+            int(settings.BULK_MAX_BODY_SIZE))
+        self.importer = Importer(self.get_argument("chunk_size", None))
+        self._lock = tornado.locks.Lock()
+        self.remain = b""
+        self.lineno = 0
+        self.error = None
+        self.error_status = 400
+
+    async def run_importer(self, func, *args):
+        async with self._lock:
+            return await dbc.run_in_executor(func, *args)
+
+    async def abort(self):
+        await self.run_importer(self.importer.abort)
+
+    def _cleanup(self):
+        importer = getattr(self, "importer", None)
+        if importer is not None and not importer.closed:
+            tornado.ioloop.IOLoop.current().spawn_callback(self.abort)
+
+    def on_connection_close(self):
+        # 客户端中途断开时不会再调用 post
+        self.error = "connection-closed"
+        self._cleanup()
+        super().on_connection_close()
+
+    def on_finish(self):
+        self._cleanup()
+        super().on_finish()
+
+    async def data_received(self, chunk):
+        if self.error:
+            return
+        lines = (self.remain + chunk).split(b"\n")
+        self.remain = lines.pop()
+        if len(self.remain) > int(settings.BULK_MAX_LINE_SIZE):
+            # 没有换行的输入不能无限缓存
+            self.error = f"line-too-long:{self.lineno + len(lines) + 1}"
+            await self.abort()
+            return
+        await self.feed(lines)
+
+    async def feed(self, lines):
+        start, self.lineno = self.lineno, self.lineno + len(lines)
+        try:
+            await self.run_importer(self._feed_lines, lines, start)
+        except BulkError as e:
+            self.error = str(e)
+            await self.abort()
+        except Exception:  # pylint: disable=broad-except
+            # 在 data_received 中抛出的异常不会返回响应，记录后由 post 返回错误
+            app_log.exception("bulk import failed at line %d", start + 1)
+            self.error, self.error_status = "internal-error", 500
+            await self.abort()
+
+    def _feed_lines(self, lines, start):
+        for i, line in enumerate(lines, start + 1):
+            try:
+                line = line.decode("utf8")
+            except UnicodeDecodeError:
+                raise BulkError(f"invalid-json:{i}")
+            self.importer.feed_line(line, i)
+
+    async def post(self):
+        """批量导入
+        """
+        if not self.error and self.remain:
+            await self.feed([self.remain])
+        if self.error:
+            self.fail(self.error, status=self.error_status,
+                      data=self.importer.stats)
+            return
+
+        try:
+            await self.run_importer(self.importer.close)
+        except BulkError as e:
+            self.fail(str(e), data=self.importer.stats)
+            return
+        self.success(data=self.importer.stats)
+
+
+class BulkExportHandler(APIRequestHandler):
+
+    async def get(self):
+        """批量导出（NDJSON），逐块查询并发送
+        """
+        self.set_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        chunks = export_chunks(self.get_argument("chunk_size", None))
+        try:
+            while True:
+                chunk = await dbc.run_in_executor(next, chunks, None)
+                if chunk is None:
+                    break
+                self.write("".join(dump_record(r) + "\n" for r in chunk))
+                await self.flush()
+        finally:
+            # 客户端中途断开时释放数据库连接
+            chunks.close()
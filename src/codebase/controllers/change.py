@@ -0,0 +1,113 @@
+# pylint: disable=W0223,W0221
+
+import time
+
+from eva.conf import settings
+
+from codebase.web import (
+    APIRequestHandler,
+    run_on_db_executor,
+)
+from codebase.models import current_revision, oldest_since, read_change_log
+from codebase.watch import watcher
+from codebase.utils.sqlalchemy import dbc
+
+
+class ChangeHandler(APIRequestHandler):
+
+    def get_int_argument(self, name, default=None):
+        """读取整数参数，格式错误时返回错误并抛出 ValueError
+        """
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            self.fail("invalid-argument")
+            raise
+
+    def get_limit(self):
+        """读取 `limit` 参数，不超过 `CHANGES_MAX_LIMIT`
+        """
+        limit = self.get_int_argument("limit", int(settings.CHANGES_LIMIT))
+        return min(limit, int(settings.CHANGES_MAX_LIMIT))
+
+    def read_changes(self, since, limit):
+        """读取 `since` 之后的变更，`since` 无效时返回错误并返回 None
+        """
+        revision = current_revision(self.db)
+        if since < 0 or since > revision:
+            # 数据库被重建等情况，客户端需要清空缓存后重新开始
+            self.fail("invalid-since")
+            return None
+        if since < oldest_since(self.db):
+            # 之后的部分变更记录已被清理，客户端需要清空缓存后从当前修订号开始
+            self.fail("since-too-old", data={"revision": revision})
+            return None
+
+        revision, more, entities = read_change_log(self.db, since, limit)
+        return {
+            "revision": revision,
+            "more": more,
+            "users": entities["user"],
+            "roles": entities["role"],
+            "permissions": entities["permission"],
+        }
+
+    @run_on_db_executor
+    def get(self):
+        """获取指定修订号之后变化的用户、角色、权限
+        """
+        try:
+            since = self.get_int_argument("since")
+            limit = self.get_limit()
+        except ValueError:
+            return
+        if limit < 1:
+            self.fail("invalid-argument")
+            return
+
+        if since is None:
+            # 不指定 since 时只返回当前修订号，客户端以此为起点
+            self.success(data={"revision": current_revision(self.db),
+                               "more": False,
+                               "users": [], "roles": [], "permissions": []})
+            return
+
+        data = self.read_changes(since, limit)
+        if data is not None:
+            self.success(data=data)
+
+
+class WatchHandler(ChangeHandler):
+
+    async def get(self):
+        """等待指定修订号之后的变更（长轮询）
+
+        已有变更时立即返回，否则等待到有新的变更或超时，超时返回空的变更。
+        """
+        try:
+            since = self.get_int_argument("since")
+            limit = self.get_limit()
+            timeout = self.get_int_argument(
+                "timeout", int(settings.WATCH_TIMEOUT))
+        except ValueError:
+            return
+        if since is None or limit < 1 or timeout < 0:
+            self.fail("invalid-argument")
+            return
+        timeout = min(timeout, int(settings.WATCH_MAX_TIMEOUT))
+
+        data = await dbc.run_in_executor(self.read_changes, since, limit)
+        if data is None:
+            return
+        deadline = time.monotonic() + timeout
+        while data["revision"] == since:
+            remain = deadline - time.monotonic()
+            if remain <= 0 or not await watcher.wait(since, remain):
+                break
+            data = await dbc.run_in_executor(self.read_changes, since, limit)
+            if data is None:
+                return
+        self.success(data=data)
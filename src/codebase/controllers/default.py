@@ -2,7 +2,9 @@
 
 import os
 
-from codebase.web import APIRequestHandler
+from codebase.web import APIRequestHandler, admin_required
+from codebase.utils.metrics import REGISTRY
+from codebase.utils.sqlalchemy import dbc
 
 
 class HealthHandler(APIRequestHandler):
@@ -10,6 +12,22 @@ class HealthHandler(APIRequestHandler):
         self.write("ok")
 
 
+class DebugDBHandler(APIRequestHandler):
+    @admin_required
+    def get(self):
+        """数据库连接池状态（需要超级管理员角色）
+        """
+        self.success(data=dbc.pool_status())
+
+
+class MetricsHandler(APIRequestHandler):
+    def get(self):
+        """Prometheus 文本格式的指标（当前 worker 进程）
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(REGISTRY.render())
+
+
 class SpecHandler(APIRequestHandler):
     """
     提供 SwaggerUI YAML 文档
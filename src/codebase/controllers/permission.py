@@ -4,18 +4,26 @@ from tornado.web import HTTPError
 
 from codebase.web import (
     APIRequestHandler,
-    authenticated
+    authenticated,
+    revision_etag,
+    run_on_db_executor,
 )
-from codebase.models import Permission
+from codebase.models import Permission, Role
 from codebase.utils.sqlalchemy.page import get_list
 
 
 class MyPermissionHandler(APIRequestHandler):
 
+    @run_on_db_executor
     @authenticated
+    @revision_etag
     def get(self):
         """获取我的权限列表
+
+        角色与全部角色的权限各一次查询，与角色数无关
         """
+        roles = self.current_user.simple_roles(self.db)
+        perms = Role.permissions_of(self.db, [role.id for role in roles])
         self.success(
             **{
                 "data": [
@@ -23,9 +31,10 @@ class MyPermissionHandler(APIRequestHandler):
                         "id": str(role.uuid),
                         "name": role.name,
                         "summary": role.summary,
-                        "permissions": [p.isimple for p in role.permissions],
+                        "permissions": [
+                            p.isimple for p in perms.get(role.id, [])],
                     }
-                    for role in self.current_user.roles
+                    for role in roles
                 ]
             }
         )
@@ -33,6 +42,8 @@ class MyPermissionHandler(APIRequestHandler):
 
 class PermissionHandler(APIRequestHandler):
 
+    @run_on_db_executor
+    @revision_etag
     def get(self):
         """获取权限列表
         """
@@ -48,6 +59,7 @@ class PermissionHandler(APIRequestHandler):
 
         self.success(**{"data": [x.isimple for x in result], "filter": _filter})
 
+    @run_on_db_executor
     def post(self):
         """创建权限
         """
@@ -79,12 +91,14 @@ class _BaseSinglePermissionHandler(APIRequestHandler):
 
 class SinglePermissionHandler(_BaseSinglePermissionHandler):
 
+    @run_on_db_executor
     def get(self, _id):
         """获取权限详情
         """
         perm = self.get_permission(_id)
         self.success(data=perm.ifull)
 
+    @run_on_db_executor
     def post(self, _id):
         """更新权限属性
         """
@@ -94,6 +108,7 @@ class SinglePermissionHandler(_BaseSinglePermissionHandler):
         self.db.commit()
         self.success()
 
+    @run_on_db_executor
     def delete(self, _id):
         """删除权限
         """
@@ -114,6 +129,7 @@ class SinglePermissionHandler(_BaseSinglePermissionHandler):
 
 class PermissionIDByNameHandler(APIRequestHandler):
 
+    @run_on_db_executor
     def get(self):
         name = self.get_query_argument("name")
         perm = self.db.query(Permission).filter_by(name=name).first()
@@ -1,21 +1,22 @@
 # pylint: disable=W0223,W0221,broad-except
 
-import logging
-import json
 from hashlib import md5
 
 from tornado.web import HTTPError
-from tornado.httpclient import AsyncHTTPClient
-from eva.conf import settings
-from etcd3 import Client
 
+from codebase.bulk import delete_links, ensure_entities, insert_links
 from codebase.web import (
     APIRequestHandler,
-    authenticated
+    authenticated,
+    revision_etag,
+    run_on_db_executor,
 )
 from codebase.models import (
     Permission,
-    Role
+    Role,
+    load_collection,
+    simple_columns,
+    _ROLE_PERMISSIONS,
 )
 from codebase.utils.sqlalchemy.page import get_list
 
@@ -26,21 +27,22 @@ def compute_checksum(v):
     return md5(bytes(v)).hexdigest()
 
 
-def get_permission_role_key(permission):
-    return f"ga.auth.permissions.{permission}.roles"
-
-
 class MyRoleHandler(APIRequestHandler):
 
+    @run_on_db_executor
     @authenticated
+    @revision_etag
     def get(self):
         """获取我的角色列表
         """
-        self.success(**{"data": [x.isimple for x in self.current_user.roles]})
+        self.success(**{"data": [
+            x.isimple for x in self.current_user.simple_roles(self.db)]})
 
 
 class RoleHandler(APIRequestHandler):
 
+    @run_on_db_executor
+    @revision_etag
     def get(self):
         """获取角色列表
         """
@@ -56,6 +58,7 @@ class RoleHandler(APIRequestHandler):
 
         self.success(**{"data": [x.isimple for x in result], "filter": _filter})
 
+    @run_on_db_executor
     def post(self):
         """创建角色
         """
@@ -78,8 +81,8 @@ class RoleHandler(APIRequestHandler):
 
 class _BaseSingleRoleHandler(APIRequestHandler):
 
-    def get_role(self, _id):
-        role = self.db.query(Role).filter_by(uuid=_id).first()
+    def get_role(self, _id, *options):
+        role = self.db.query(Role).options(*options).filter_by(uuid=_id).first()
         if role:
             return role
         raise HTTPError(400, reason="not-found")
@@ -87,12 +90,14 @@ class _BaseSingleRoleHandler(APIRequestHandler):
 
 class SingleRoleHandler(_BaseSingleRoleHandler):
 
+    @run_on_db_executor
     def get(self, _id):
         """获取角色详情
         """
         role = self.get_role(_id)
         self.success(data=role.ifull)
 
+    @run_on_db_executor
     def post(self, _id):
         """更新角色属性
         """
@@ -102,6 +107,7 @@ class SingleRoleHandler(_BaseSingleRoleHandler):
         self.db.commit()
         self.success()
 
+    @run_on_db_executor
     def delete(self, _id):
         """删除角色
         """
@@ -114,6 +120,12 @@ class SingleRoleHandler(_BaseSingleRoleHandler):
         # 删除 User 依赖
         # role.users = []
 
+        # 删除继承关系（同时维护闭包表）
+        for parent in role.parents:
+            role.remove_parent(self.db, parent)
+        for child in self.db.query(Role).filter(Role.parents.contains(role)):
+            child.remove_parent(self.db, role)
+
         # 删除 Permission 依赖
         # TODO: 是否需要删除没有任何 Role 关联的 Permission ?
         role.permissions = []
@@ -126,101 +138,143 @@ class SingleRoleHandler(_BaseSingleRoleHandler):
 
 class RolePermissionHandler(_BaseSingleRoleHandler):
 
+    @run_on_db_executor
+    @revision_etag
     def get(self, _id):
-        """获取指定角色的权限列表
+        """获取指定角色的权限列表（默认包括继承的权限）
+        """
+        if self.get_argument("inherited", "true") in ["false", "0"]:
+            role = self.get_role(_id, load_collection(Role.permissions))
+            perms = role.permissions
+        else:
+            role = self.get_role(_id)
+            perms = role.all_permissions(self.db).options(
+                simple_columns(Permission))
+        self.success(data=[p.isimple for p in perms])
+
+
+class _BaseRoleParentHandler(_BaseSingleRoleHandler):
+
+    def get_parents(self, role_ids):
+        """通过给定的角色ID列表查询角色，返回 `(roles, notexist)`
+        """
+        roles = self.db.query(Role).filter(Role.uuid.in_(role_ids)).all()
+        found = {str(r.uuid) for r in roles}
+        return roles, [_id for _id in role_ids if _id not in found]
+
+
+class RoleParentHandler(_BaseRoleParentHandler):
+
+    @run_on_db_executor
+    def get(self, _id):
+        """获取指定角色的父角色列表
         """
         role = self.get_role(_id)
-        self.success(data=[p.isimple for p in role.permissions])
+        self.success(data=[r.isimple for r in role.parents])
 
 
-class RolePermissionAppendHandler(_BaseSingleRoleHandler):
+class RoleParentAppendHandler(_BaseRoleParentHandler):
 
-    async def post(self):
-        """增加指定角色的权限
+    @run_on_db_executor
+    def post(self, _id):
+        """增加指定角色的父角色（继承父角色的权限）
         """
+        role = self.get_role(_id)
         body = self.get_body_json()
-        role = self.db.query(Role).filter_by(name=body["role"]).first()
-        if not role:
-            role = Role(name=body["role"])
-            self.db.add(role)
-            self.db.commit()
-
-        perms = []
-        for perm_name in body["permissions"]:
-            perm = self.db.query(Permission).filter_by(name=perm_name).first()
-            if not perm:
-                perm = Permission(name=perm_name)
-                self.db.add(perm)
-                self.db.commit()
-            perms.append(perm)
-
-        if not perms:
-            self.fail("no-permissions")
+
+        parents, notexist = self.get_parents(body["parents"])
+        if notexist:
+            self.fail(error="have-not-exist", data=notexist)
+            return
+
+        # 父角色不能是自身或自身的后代，否则形成环
+        cycle = [str(p.uuid) for p in parents
+                 if p.id == role.id or role.is_ancestor_of(self.db, p)]
+        if cycle:
+            self.fail(error="role-cycle", data=cycle)
+            return
+
+        for parent in parents:
+            role.add_parent(self.db, parent)
+        self.db.commit()
+        self.success()
+
+
+class RoleParentRemoveHandler(_BaseRoleParentHandler):
+
+    @run_on_db_executor
+    def post(self, _id):
+        """删除指定角色的父角色
+        """
+        role = self.get_role(_id)
+        body = self.get_body_json()
+
+        parents, notexist = self.get_parents(body["parents"])
+        if notexist:
+            self.fail(error="have-not-exist", data=notexist)
             return
 
-        # sync to etcd
-        if settings.SYCN_ETCD:
+        for parent in parents:
+            role.remove_parent(self.db, parent)
+        self.db.commit()
+        self.success()
+
 
-            # create etcd client
-            for endpoint in settings.ETCD_ENDPOINTS.split(";"):
-                host, port = endpoint.split(":")
-                client = Client(host, int(port))
-                break  # FIXME: try when failed
+class RolePermissionAppendHandler(_BaseSingleRoleHandler):
 
-            key = get_permission_role_key(perm.name)
-            new_roles = []
+    @run_on_db_executor
+    def post(self):
+        """增加指定角色的权限
 
-            r = client.range(key)
-            if r.count == 1:
-                new_roles.extend(json.loads(r.kvs[0].value))
-            if role.name not in new_roles:
-                new_roles.append(role.name)
-            client.put(key, json.dumps(new_roles))
+        角色与权限按名称集合查询，不存在的批量创建，只插入尚不存在的关联，
+        整个请求一个事务。etcd 由 outbox 异步同步（见 `codebase.sync`）
+        """
+        body = self.get_body_json()
+
+        names = list(dict.fromkeys(body["permissions"]))
+        if not names:
+            self.fail("no-permissions")
+            return
+
+        roles, _ = ensure_entities(self.db, Role, "role", {body["role"]: {}})
+        perms, _ = ensure_entities(
+            self.db, Permission, "permission", {name: {} for name in names})
 
         # append permissions
-        role.permissions.extend(perms)
+        role_id = roles[body["role"]]
+        insert_links(
+            self.db, _ROLE_PERMISSIONS,
+            _ROLE_PERMISSIONS.c.role_id, _ROLE_PERMISSIONS.c.permission_id,
+            "role_permission", [(role_id, perms[name]) for name in names])
         self.db.commit()
         self.success()
 
 
 class RolePermissionRemoveHandler(_BaseSingleRoleHandler):
 
-    async def post(self):
-        """删除指定角色的权限
+    @run_on_db_executor
+    def post(self):
+        """删除指定角色的权限，角色没有的权限忽略
         """
         body = self.get_body_json()
-        role = self.db.query(Role).filter_by(name=body["role"]).first()
-        if not role:
+
+        role_id = self.db.query(Role.id).filter_by(name=body["role"]).scalar()
+        if role_id is None:
             self.fail("role-not-found")
             return
 
-        notexist = []
-        perms = []
-        for perm_name in body["permissions"]:
-            perm = self.db.query(Permission).filter_by(name=perm_name).first()
-            if perm:
-                perms.append(perm)
-            else:
-                notexist.append(perm_name)
-
+        names = body["permissions"]
+        perms = dict(self.db.query(Permission.name, Permission.id).filter(
+            Permission.name.in_(set(names))))
+        notexist = [name for name in names if name not in perms]
         if notexist:
             self.fail(error="have-not-exist", data=notexist)
             return
 
-        # sync to etcd
-        if settings.SYCN_ETCD:
-            for perm in perms:
-                key = get_permission_role_key(perm)
-                url = settings.ETCD_URL_ENDPOINT + key
-                http_client = AsyncHTTPClient()
-                try:
-                    # FIXME: handle error
-                    await http_client.fetch(url, method="DELETE", raise_error=False)
-                except Exception as e:
-                    logging.error("delete permission from role at etcd error: %s", e)
-
         # remove permissions
-        for perm in perms:
-            role.permissions.remove(perm)
+        delete_links(
+            self.db, _ROLE_PERMISSIONS,
+            _ROLE_PERMISSIONS.c.role_id, _ROLE_PERMISSIONS.c.permission_id,
+            "role_permission", [role_id], list(perms.values()))
         self.db.commit()
         self.success()
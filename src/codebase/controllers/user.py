@@ -1,51 +1,83 @@
 # pylint: disable=W0223,W0221
 
+import uuid
+
+from eva.conf import settings
 from tornado.web import HTTPError
 
-from codebase.web import APIRequestHandler
+from codebase.bulk import delete_links, ensure_users, insert_links
+from codebase.web import (
+    APIRequestHandler,
+    revision_etag,
+    run_on_db_executor,
+)
 from codebase.models import (
     User,
-    Role
+    Role,
+    load_collection,
+    _USER_ROLES,
 )
 
 
+def _parse_uuids(values):
+    try:
+        return [uuid.UUID(str(v)) for v in values]
+    except ValueError:
+        return None
+
+
+def _chunks(items):
+    items = list(items)
+    size = int(settings.BULK_CHUNK_SIZE)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 class _Base(APIRequestHandler):
 
-    def get_user(self, _id):
-        user = self.db.query(User).filter_by(uuid=_id).first()
+    def get_user(self, _id, *options):
+        user = self.db.query(User).options(*options).filter_by(uuid=_id).first()
         if user:
             return user
         raise HTTPError(400, reason="not-found")
 
     def get_roles(self, role_ids):
-        """通过给定的角色ID列表，查询对应的角色对象
+        """通过给定的角色ID列表，查询对应的角色对象（一次 `IN` 查询）
 
         返回：
         1. `roles` : 找到的角色对象列表
         2. `notexist` : 没有找到的角色ID列表
         """
-        notexsit = []
-        roles = []
-        for role_id in role_ids:
-            role = self.db.query(Role).filter_by(uuid=role_id).first()
-            if role:
-                roles.append(role)
+        # 格式错误的ID作为不存在的角色
+        uuids = [(_parse_uuids([role_id]) or [None])[0] for role_id in role_ids]
+        valid = set(uuids) - {None}
+        found = {}
+        if valid:
+            found = {role.uuid: role for role in self.db.query(Role).filter(
+                Role.uuid.in_(valid))}
+        roles, notexist = [], []
+        for role_id, role_uuid in zip(role_ids, uuids):
+            if role_uuid in found:
+                roles.append(found[role_uuid])
             else:
-                notexsit.append(role_id)
-        return roles, notexsit
+                notexist.append(role_id)
+        return roles, notexist
 
 
 class UserRoleHandler(_Base):
 
+    @run_on_db_executor
+    @revision_etag
     def get(self, _id):
         """获取指定用户的角色列表
         """
-        user = self.get_user(_id)
+        user = self.get_user(_id, load_collection(User.roles))
         self.success(data=[role.isimple for role in user.roles])
 
 
 class UserRoleAppendHandler(_Base):
 
+    @run_on_db_executor
     def post(self, _id):
         """增加指定用户的角色
         """
@@ -62,16 +94,20 @@ class UserRoleAppendHandler(_Base):
         if not user:
             user = User(uuid=_id)
             self.db.add(user)
-            self.db.commit()
+            self.db.flush()
 
-        # append roles
-        user.roles.extend(roles)
+        # append roles ，已有的角色不重复增加（并发请求也不会重复插入）
+        insert_links(
+            self.db, _USER_ROLES,
+            _USER_ROLES.c.user_id, _USER_ROLES.c.role_id, "user_role",
+            [(user.id, role.id) for role in roles])
         self.db.commit()
         self.success()
 
 
 class UserRoleRemoveHandler(_Base):
 
+    @run_on_db_executor
     def post(self, _id):
         """删除指定用户的角色
         """
@@ -83,8 +119,92 @@ class UserRoleRemoveHandler(_Base):
             self.fail(error="have-not-exist", data=notexist)
             return
 
-        # remove roles
+        # remove roles ，用户没有的角色忽略
         for role in roles:
-            user.roles.remove(role)
+            if role in user.roles:
+                user.roles.remove(role)
         self.db.commit()
         self.success()
+
+
+class _BaseUserRoleBulk(APIRequestHandler):
+    """批量修改用户角色：`users` 中的每个用户与 `roles` 中的每个角色
+
+    用户与角色均使用 `IN` 查询解析，关联关系按集合插入/删除（已存在的关联不重复
+    插入，不存在的关联忽略），整个请求一个事务。
+    """
+
+    def parse_body(self):
+        """返回 `(用户 uuid 集合, 角色 id 列表)` ，参数错误时返回错误并返回 None
+        """
+        body = self.get_body_json()
+        users, roles = body.get("users"), body.get("roles")
+        if not isinstance(users, list) or not isinstance(roles, list):
+            self.fail("invalid-argument")
+            return None
+        if len(users) > int(settings.USER_ROLE_BULK_MAX_USERS):
+            self.fail("too-many-users")
+            return None
+        if len(roles) > int(settings.USER_ROLE_BULK_MAX_ROLES):
+            self.fail("too-many-roles")
+            return None
+        user_uuids, role_uuids = _parse_uuids(users), _parse_uuids(roles)
+        if user_uuids is None or role_uuids is None:
+            self.fail("invalid-argument")
+            return None
+
+        found = dict(self.db.query(Role.uuid, Role.id).filter(
+            Role.uuid.in_(set(role_uuids))))
+        notexist = [r for r, u in zip(roles, role_uuids) if u not in found]
+        if notexist:
+            self.fail(error="have-not-exist", data=notexist)
+            return None
+        return set(user_uuids), list(found.values())
+
+
+class UserRoleBulkAppendHandler(_BaseUserRoleBulk):
+
+    @run_on_db_executor
+    def post(self):
+        """为多个用户增加多个角色，不存在的用户自动创建
+        """
+        parsed = self.parse_body()
+        if parsed is None:
+            return
+        user_uuids, role_ids = parsed
+
+        created = added = 0
+        for chunk in _chunks(user_uuids):
+            users, new = ensure_users(self.db, chunk)
+            created += new
+            added += insert_links(
+                self.db, _USER_ROLES,
+                _USER_ROLES.c.user_id, _USER_ROLES.c.role_id, "user_role",
+                [(u, r) for u in users.values() for r in role_ids])
+        self.db.commit()
+        self.success(data={"users": len(user_uuids),
+                           "created_users": created,
+                           "added": added})
+
+
+class UserRoleBulkRemoveHandler(_BaseUserRoleBulk):
+
+    @run_on_db_executor
+    def post(self):
+        """删除多个用户的多个角色，不存在的用户忽略
+        """
+        parsed = self.parse_body()
+        if parsed is None:
+            return
+        user_uuids, role_ids = parsed
+
+        removed = 0
+        for chunk in _chunks(user_uuids):
+            user_ids = [_id for _id, in self.db.query(User.id).filter(
+                User.uuid.in_(chunk))]
+            removed += delete_links(
+                self.db, _USER_ROLES,
+                _USER_ROLES.c.user_id, _USER_ROLES.c.role_id, "user_role",
+                user_ids, role_ids)
+        self.db.commit()
+        self.success(data={"users": len(user_uuids), "removed": removed})
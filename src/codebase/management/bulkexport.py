@@ -0,0 +1,32 @@
+import sys
+from importlib import import_module
+
+from eva.conf import settings
+from eva.management.common import EvaManagementCommand
+
+
+class Command(EvaManagementCommand):
+    def __init__(self):
+        super(Command, self).__init__()
+
+        self.cmd = "bulkexport"
+        self.help = "批量导出授权数据（NDJSON）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="-",
+                            help="输出文件路径，默认为标准输出")
+        parser.add_argument("--chunk-size", type=int, default=None,
+                            help="每次查询的记录数")
+
+    def run(self):
+        import_module(settings.MODELS_MODULE)
+        from codebase.bulk import export_chunks, dump_record
+
+        f = sys.stdout if self.args.path == "-" else open(
+            self.args.path, "w", encoding="utf8")
+        try:
+            for chunk in export_chunks(self.args.chunk_size):
+                f.write("".join(dump_record(r) + "\n" for r in chunk))
+        finally:
+            if f is not sys.stdout:
+                f.close()
@@ -0,0 +1,41 @@
+import json
+import sys
+from importlib import import_module
+
+from eva.conf import settings
+from eva.management.common import EvaManagementCommand
+
+
+class Command(EvaManagementCommand):
+    def __init__(self):
+        super(Command, self).__init__()
+
+        self.cmd = "bulkimport"
+        self.help = "从 NDJSON 文件批量导入授权数据"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="NDJSON 文件路径，- 表示标准输入")
+        parser.add_argument("--chunk-size", type=int, default=None,
+                            help="每块（每个事务）的记录数")
+
+    def run(self):
+        import_module(settings.MODELS_MODULE)
+        from codebase.bulk import Importer, BulkError
+
+        importer = Importer(self.args.chunk_size)
+        f = sys.stdin if self.args.path == "-" else open(
+            self.args.path, encoding="utf8")
+        try:
+            for lineno, line in enumerate(f, 1):
+                importer.feed_line(line, lineno)
+            importer.flush()
+        except BulkError as e:
+            importer.abort()
+            print(f"导入失败: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        importer.close()
+        print(json.dumps(importer.stats))
@@ -0,0 +1,24 @@
+from importlib import import_module
+
+from eva.conf import settings
+from eva.management.common import EvaManagementCommand
+
+
+class Command(EvaManagementCommand):
+    def __init__(self):
+        super(Command, self).__init__()
+
+        self.cmd = "prunechanges"
+        self.help = "删除超过保留时间的变更日志"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retention", type=int, default=None,
+                            help="保留时间（秒），默认为 CHANGES_RETENTION")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="每个事务删除的修订号数")
+
+    def run(self):
+        import_module(settings.MODELS_MODULE)
+        from codebase.retention import prune
+
+        print(prune(self.args.retention, self.args.batch_size))
@@ -0,0 +1,33 @@
+import json
+from importlib import import_module
+
+from eva.conf import settings
+from eva.management.common import EvaManagementCommand
+from tornado.ioloop import IOLoop
+
+
+class Command(EvaManagementCommand):
+    def __init__(self):
+        super(Command, self).__init__()
+
+        self.cmd = "syncetcd"
+        self.help = "根据数据库全量校正 etcd 中的权限角色列表"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="只比较，不写入 etcd")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="每批处理的权限数，默认为 ETCD_MAX_TXN_OPS")
+
+    def run(self):
+        import_module(settings.MODELS_MODULE)
+        from codebase.sync import reconcile
+
+        stats = IOLoop.current().run_sync(lambda: reconcile(
+            batch_size=self.args.batch_size, dry_run=self.args.dry_run))
+        seconds = stats["seconds"] or 1e-9
+        stats["seconds"] = round(seconds, 3)
+        stats["permissions_per_second"] = round(
+            stats["permissions"] / seconds, 1)
+        stats["dry_run"] = self.args.dry_run
+        print(json.dumps(stats, indent=2))
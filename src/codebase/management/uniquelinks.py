@@ -0,0 +1,22 @@
+import json
+from importlib import import_module
+
+from eva.conf import settings
+from eva.management.common import EvaManagementCommand
+
+from codebase.utils.sqlalchemy import dbc
+
+
+class Command(EvaManagementCommand):
+    def __init__(self):
+        super(Command, self).__init__()
+
+        self.cmd = "uniquelinks"
+        self.help = "删除重复的用户角色、角色权限关联，并将联合索引改为唯一索引"
+
+    def run(self):
+        import_module(settings.MODELS_MODULE)
+        from codebase.models import make_link_indexes_unique
+
+        with dbc.engine.begin() as conn:
+            print(json.dumps(make_link_indexes_unique(conn), indent=2))
@@ -1,32 +1,57 @@
 # pylint: disable=R0902,E1101,W0201,too-few-public-methods,W0613
 
 import datetime
+import logging
 import uuid
+from collections import namedtuple
 
 from sqlalchemy_utils import UUIDType
 from eva.conf import settings
 from eva.utils.time_ import utc_rfc3339_string
 from sqlalchemy import (
+    and_,
+    bindparam,
     event,
+    exists,
+    func,
+    inspect,
+    literal,
+    or_,
+    select,
+    union,
+    union_all,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Sequence,
     String,
     Table,
     Text,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import (
+    joinedload,
+    load_only,
+    object_session,
+    relationship,
+    selectinload,
+    Session,
+)
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
 
 from codebase.utils.sqlalchemy import ORMBase, dbc
 
 
+# 关联表的联合索引唯一：并发的增加请求不会插入重复的关联（见
+# `codebase.bulk.insert_links`），旧数据库使用 `manage.py core uniquelinks` 迁移
 _USER_ROLES = Table(
     "authz_user__role",
     ORMBase.metadata,
     Column("user_id", Integer, ForeignKey("authz_user.id")),
     Column("role_id", Integer, ForeignKey("authz_role.id")),
+    Index("ix_authz_user__role_user_id_role_id", "user_id", "role_id",
+          unique=True),
 )
 
 
@@ -35,9 +60,91 @@ _ROLE_PERMISSIONS = Table(
     ORMBase.metadata,
     Column("role_id", Integer, ForeignKey("authz_role.id")),
     Column("permission_id", Integer, ForeignKey("authz_permission.id")),
+    Index("ix_authz_role__permission_role_id_permission_id",
+          "role_id", "permission_id", unique=True),
+)
+
+
+# 角色继承关系（直接边）：子角色 `role_id` 继承父角色 `parent_id` 的权限
+_ROLE_PARENTS = Table(
+    "authz_role__parent",
+    ORMBase.metadata,
+    Column("role_id", Integer, ForeignKey("authz_role.id"), primary_key=True),
+    Column("parent_id", Integer, ForeignKey("authz_role.id"), primary_key=True),
+    Index("ix_authz_role__parent_parent_id", "parent_id"),
+)
+
+
+# 角色继承关系的传递闭包：`ancestor_id` 是 `descendant_id` 的（直接或间接）祖先，
+# `paths` 为两者之间的路径数（多继承时可能有多条），删除边时据此增量维护。
+# 不包含角色到自身的记录。
+_ROLE_CLOSURE = Table(
+    "authz_role_closure",
+    ORMBase.metadata,
+    Column("descendant_id", Integer, ForeignKey("authz_role.id"),
+           primary_key=True),
+    Column("ancestor_id", Integer, ForeignKey("authz_role.id"),
+           primary_key=True),
+    Column("paths", Integer, nullable=False),
+    Index("ix_authz_role_closure_ancestor_id", "ancestor_id"),
+)
+
+
+# 待同步到 etcd 的权限（transactional outbox）：与授权关系的修改在同一事务中写入，
+# 由后台任务（`codebase.sync.OutboxDrainer`）批量同步后删除
+_ETCD_OUTBOX = Table(
+    "authz_etcd_outbox",
+    ORMBase.metadata,
+    Column("id", Integer, Sequence("authz_etcd_outbox_id_seq"),
+           primary_key=True),
+    Column("permission", String(512), nullable=False),
+    Column("created", DateTime(), nullable=False),
+)
+
+
+# 全局修订号：只有一行，每个修改授权数据的事务在提交前加 1 。更新该行会锁定到
+# 事务结束，修订号的顺序即提交顺序，读到修订号 N 时 N 及之前的变更均已提交
+_REVISION = Table(
+    "authz_revision",
+    ORMBase.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("revision", Integer, nullable=False),
+)
+
+
+# 变更日志：每个修订号影响的用户（uuid）、角色（uuid）、权限（名称），
+# 供客户端按修订号增量失效缓存（`/changes?since=`）
+_CHANGE_LOG = Table(
+    "authz_change",
+    ORMBase.metadata,
+    Column("id", Integer, Sequence("authz_change_id_seq"), primary_key=True),
+    Column("revision", Integer, nullable=False),
+    Column("kind", String(16), nullable=False),
+    Column("ref", String(512), nullable=False),
+    Column("created", DateTime(), nullable=False),
+    Index("ix_authz_change_revision", "revision"),
 )
 
 
+def simple_columns(model):
+    """只加载 `isimple` 需要的列（主键总是加载）
+    """
+    return load_only(model.uuid, model.name, model.summary)
+
+
+def load_collection(attr):
+    """按 `RELATIONSHIP_LOADING` 预先加载集合关系，只加载 `isimple` 需要的列
+
+    - selectin: 加载主对象后，用一条 `IN` 查询加载所有主对象的关联对象
+    - joined: 与主对象在同一条查询中 LEFT OUTER JOIN 加载
+    """
+    if settings.RELATIONSHIP_LOADING == "joined":
+        loader = joinedload(attr)
+    else:
+        loader = selectinload(attr)
+    return loader.load_only("uuid", "name", "summary")
+
+
 class SimilarBase:
 
     def update(self, **kwargs):
@@ -71,6 +178,9 @@ class Role(ORMBase, SimilarBase):
     """
 
     __tablename__ = "authz_role"
+    __table_args__ = (
+        Index("ix_authz_role_created_id", "created", "id"),
+    )
 
     id = Column(Integer, Sequence("authz_role_id_seq"), primary_key=True)
     uuid = Column(UUIDType(), default=uuid.uuid4, unique=True)
@@ -84,6 +194,173 @@ class Role(ORMBase, SimilarBase):
         "Permission", secondary=_ROLE_PERMISSIONS, backref="roles"
     )
 
+    # 继承关系只能通过 `add_parent` / `remove_parent` 修改，以维护闭包表
+    parents = relationship(
+        "Role", secondary=_ROLE_PARENTS,
+        primaryjoin="Role.id == authz_role__parent.c.role_id",
+        secondaryjoin="Role.id == authz_role__parent.c.parent_id",
+        viewonly=True,
+    )
+    ancestors = relationship(
+        "Role", secondary=_ROLE_CLOSURE,
+        primaryjoin="Role.id == authz_role_closure.c.descendant_id",
+        secondaryjoin="Role.id == authz_role_closure.c.ancestor_id",
+        viewonly=True,
+    )
+
+    @staticmethod
+    def permissions_of(db, role_ids):
+        """多个角色各自的全部权限（包括从祖先角色继承的），一次查询
+
+        返回 `{role id: [Permission]}` ，权限只加载 `isimple` 需要的列。
+        """
+        if not role_ids:
+            return {}
+        rp = _ROLE_PERMISSIONS.c
+        closure = _ROLE_CLOSURE.c
+        owned = union(
+            select([rp.role_id.label("owner_id"), rp.permission_id])
+            .where(rp.role_id.in_(role_ids)),
+            select([closure.descendant_id.label("owner_id"), rp.permission_id])
+            .select_from(_ROLE_CLOSURE.join(
+                _ROLE_PERMISSIONS, rp.role_id == closure.ancestor_id))
+            .where(closure.descendant_id.in_(role_ids)),
+        ).alias("owned")
+        result = {}
+        for owner_id, perm in db.query(owned.c.owner_id, Permission).join(
+                Permission, Permission.id == owned.c.permission_id).options(
+                    simple_columns(Permission)).order_by(
+                        owned.c.owner_id, Permission.id):
+            result.setdefault(owner_id, []).append(perm)
+        return result
+
+    def all_permissions(self, db):
+        """角色的全部权限（包括从祖先角色继承的），一次查询
+        """
+        rp = _ROLE_PERMISSIONS
+        closure = _ROLE_CLOSURE
+        return db.query(Permission).join(
+            rp, rp.c.permission_id == Permission.id,
+        ).filter(or_(
+            rp.c.role_id == self.id,
+            rp.c.role_id.in_(select([closure.c.ancestor_id]).where(
+                closure.c.descendant_id == self.id)),
+        )).distinct()
+
+    def is_ancestor_of(self, db, role):
+        return db.query(exists().where(and_(
+            _ROLE_CLOSURE.c.ancestor_id == self.id,
+            _ROLE_CLOSURE.c.descendant_id == role.id,
+        ))).scalar()
+
+    def add_parent(self, db, parent):
+        """继承 `parent` 的权限，已存在时返回 False
+
+        调用方需要先检查不会形成环（`parent` 不是自身或自身的后代）。
+        """
+        if not _add_role_edge(db, self.id, parent.id, 1):
+            return False
+        db.expire(self, ["parents", "ancestors"])
+        return True
+
+    def remove_parent(self, db, parent):
+        """取消继承 `parent` ，不存在时返回 False
+        """
+        if not _add_role_edge(db, self.id, parent.id, -1):
+            return False
+        db.expire(self, ["parents", "ancestors"])
+        return True
+
+
+class RoleClosureError(Exception):
+    """闭包表与继承边不一致
+    """
+
+
+def _add_role_edge(db, role_id, parent_id, sign):
+    """增加（sign=1）或删除（sign=-1）继承边，并增量维护闭包表
+
+    新边使 `parent` 及其祖先（A）成为 `role` 及其后代（D）的祖先，
+    A x D 中每一对之间增加 paths(a, parent) * paths(role, d) 条路径；删除时相反。
+
+    读取闭包前先锁定修订号行（与提交前的 `next_revision` 是同一行），使并发的
+    继承关系修改串行执行，不会基于过期的路径数计算。
+    """
+    db.execute(_REVISION.update().values(revision=_REVISION.c.revision))
+    edge = and_(_ROLE_PARENTS.c.role_id == role_id,
+                _ROLE_PARENTS.c.parent_id == parent_id)
+    found = db.query(exists().where(edge)).scalar()
+    if found == (sign > 0):
+        return False
+
+    if sign > 0:
+        db.execute(_ROLE_PARENTS.insert(),
+                   {"role_id": role_id, "parent_id": parent_id})
+    else:
+        db.execute(_ROLE_PARENTS.delete().where(edge))
+
+    c = _ROLE_CLOSURE.c
+    ancestors = {parent_id: 1}
+    ancestors.update(db.execute(select([c.ancestor_id, c.paths]).where(
+        c.descendant_id == parent_id)).fetchall())
+    descendants = {role_id: 1}
+    descendants.update(db.execute(select([c.descendant_id, c.paths]).where(
+        c.ancestor_id == role_id)).fetchall())
+    existing = {(a, d): n for a, d, n in db.execute(
+        select([c.ancestor_id, c.descendant_id, c.paths]).where(
+            c.ancestor_id.in_(ancestors)).where(
+            c.descendant_id.in_(descendants)))}
+
+    inserts, updates, deletes = [], [], []
+    for a, na in ancestors.items():
+        for d, nd in descendants.items():
+            old = existing.get((a, d), 0)
+            new = old + sign * na * nd
+            if new < 0:
+                # 闭包表与继承边不一致，继续写入会留下 paths <= 0 的记录
+                raise RoleClosureError(
+                    f"closure ({a}, {d}) has {old} paths, cannot remove {na * nd}")
+            row = {"a": a, "d": d, "n": new}
+            if not new:
+                if old:
+                    deletes.append(row)
+            elif old:
+                updates.append(row)
+            else:
+                inserts.append(row)
+
+    match = and_(c.ancestor_id == bindparam("a"),
+                 c.descendant_id == bindparam("d"))
+    if inserts:
+        db.execute(_ROLE_CLOSURE.insert().values(
+            ancestor_id=bindparam("a"), descendant_id=bindparam("d"),
+            paths=bindparam("n")), inserts)
+    if updates:
+        db.execute(_ROLE_CLOSURE.update().where(match).values(
+            paths=bindparam("n")), updates)
+    if deletes:
+        db.execute(_ROLE_CLOSURE.delete().where(match), deletes)
+
+    record_changes(db, [Change("add" if sign > 0 else "remove",
+                               "role_parent", role_id, ref_id=parent_id)])
+    return True
+
+
+def effective_user_roles(whereclause):
+    """用户的有效角色 `(user_id, role_id)` ：直接拥有的角色及其全部祖先角色
+
+    `whereclause` 为 `_USER_ROLES` 上的过滤条件（如限定用户）。
+    """
+    ur = _USER_ROLES.c
+    closure = _ROLE_CLOSURE.c
+    return union_all(
+        select([ur.user_id, ur.role_id]).where(whereclause),
+        select([ur.user_id, closure.ancestor_id.label("role_id")]).select_from(
+            _USER_ROLES.join(
+                _ROLE_CLOSURE, closure.descendant_id == ur.role_id),
+        ).where(whereclause),
+    ).alias("effective_user_role")
+
 
 class Permission(ORMBase, SimilarBase):
     """
@@ -91,6 +368,9 @@ class Permission(ORMBase, SimilarBase):
     """
 
     __tablename__ = "authz_permission"
+    __table_args__ = (
+        Index("ix_authz_permission_created_id", "created", "id"),
+    )
 
     id = Column(Integer, Sequence("authz_permission_id_seq"), primary_key=True)
     uuid = Column(UUIDType(), default=uuid.uuid4, unique=True)
@@ -100,6 +380,36 @@ class Permission(ORMBase, SimilarBase):
     updated = Column(DateTime(), default=datetime.datetime.utcnow)
     created = Column(DateTime(), default=datetime.datetime.utcnow)
 
+    @staticmethod
+    def role_names(db, names):
+        """拥有给定权限的角色名称（包括继承该权限的后代角色）
+
+        返回 `{权限名称: [角色名称]}` ，不存在的权限不出现在结果中，没有角色的
+        权限对应空列表。
+        """
+        perm = Permission.__table__
+        role = Role.__table__
+        rp = _ROLE_PERMISSIONS.c
+        closure = _ROLE_CLOSURE.c
+        columns = [perm.c.name.label("permission"), role.c.name.label("role")]
+        direct = select(columns).select_from(
+            _ROLE_PERMISSIONS
+            .join(perm, perm.c.id == rp.permission_id)
+            .join(role, role.c.id == rp.role_id)
+        ).where(perm.c.name.in_(names))
+        inherited = select(columns).select_from(
+            _ROLE_PERMISSIONS
+            .join(perm, perm.c.id == rp.permission_id)
+            .join(_ROLE_CLOSURE, closure.ancestor_id == rp.role_id)
+            .join(role, role.c.id == closure.descendant_id)
+        ).where(perm.c.name.in_(names))
+
+        result = {name: set() for name, in db.execute(
+            select([perm.c.name]).where(perm.c.name.in_(names)))}
+        for perm_name, role_name in db.execute(union_all(direct, inherited)):
+            result[perm_name].add(role_name)
+        return {k: sorted(v) for k, v in result.items()}
+
 
 class User(ORMBase):
     """
@@ -119,29 +429,472 @@ class User(ORMBase):
 
     roles = relationship("Role", secondary=_USER_ROLES, backref="users")
 
+    def simple_roles(self, db):
+        """用户的角色（只加载 `isimple` 需要的列），一次查询
+        """
+        if self.id is None:
+            # 未记录过的用户
+            return []
+        return db.query(Role).join(
+            _USER_ROLES, _USER_ROLES.c.role_id == Role.id,
+        ).filter(_USER_ROLES.c.user_id == self.id).options(
+            simple_columns(Role)).order_by(Role.id).all()
+
     def has_permission(self, permission):
-        for role in self.roles:
-            # 如果拥有超级管理员角色名称，拥有权限
-            if role.name == settings.ADMIN_ROLE_NAME:
-                return True
-            for perm in role.permissions:
-                if perm.id == permission.id:
+        db = object_session(self)
+        if db is None or self.id is None:
+            roles = self.roles
+        else:
+            # 一次加载角色、祖先角色以及它们的权限，不逐个角色懒加载
+            roles = db.query(Role).with_parent(self, "roles").options(
+                selectinload(Role.permissions),
+                selectinload(Role.ancestors).selectinload(Role.permissions),
+            ).all()
+        for role in roles:
+            for r in [role] + role.ancestors:
+                # 如果拥有超级管理员角色名称，拥有权限
+                if r.name == settings.ADMIN_ROLE_NAME:
                     return True
+                for perm in r.permissions:
+                    if perm.id == permission.id:
+                        return True
         return False
 
+    @staticmethod
+    def is_admin(db, user_pk):
+        """用户（主键）直接拥有或继承了超级管理员角色
+        """
+        roles = effective_user_roles(_USER_ROLES.c.user_id == user_pk)
+        role = Role.__table__
+        return db.query(exists().where(and_(
+            role.c.id == roles.c.role_id,
+            role.c.name == settings.ADMIN_ROLE_NAME,
+        ))).scalar()
+
+    @staticmethod
+    def check_permission(db, user_id, permission_name=None, permission_id=None):
+        """在数据库端完成鉴权，只执行一条 SQL，不加载 ORM 对象
+
+        `user_id` 为用户 uuid，`permission_name` 与 `permission_id` （权限
+        uuid）二选一。
+
+        返回 `(user_pk, permission_pk, granted)` ，用户或权限不存在时对应的
+        主键为 None 。
+        """
+        try:
+            user_uuid = uuid.UUID(str(user_id))
+        except ValueError:
+            return None, None, False
+        user_pk = select([User.id]).where(User.uuid == user_uuid).as_scalar()
+
+        if permission_name is not None:
+            perm_pk = select([Permission.id]).where(
+                Permission.name == permission_name).as_scalar()
+        else:
+            try:
+                perm_uuid = uuid.UUID(str(permission_id))
+            except ValueError:
+                return db.execute(select([user_pk])).scalar(), None, False
+            perm_pk = select([Permission.id]).where(
+                Permission.uuid == perm_uuid).as_scalar()
+
+        role = Role.__table__
+        # 用户直接拥有的角色及其继承的祖先角色
+        roles = effective_user_roles(_USER_ROLES.c.user_id == user_pk)
+        granted = select([literal(1)]).select_from(
+            roles.join(
+                role, role.c.id == roles.c.role_id,
+            ).outerjoin(
+                _ROLE_PERMISSIONS,
+                and_(_ROLE_PERMISSIONS.c.role_id == roles.c.role_id,
+                     _ROLE_PERMISSIONS.c.permission_id == perm_pk),
+            )
+        ).where(
+            # 如果拥有超级管理员角色名称，拥有权限
+            or_(role.c.name == settings.ADMIN_ROLE_NAME,
+                _ROLE_PERMISSIONS.c.permission_id.isnot(None)),
+        )
+
+        row = db.execute(select([
+            user_pk.label("user_id"),
+            perm_pk.label("permission_id"),
+            exists(granted).label("granted"),
+        ])).first()
+        return row.user_id, row.permission_id, bool(row.granted)
+
+
+# 授权数据变更记录
+#
+# 每次 flush 时收集 User/Role/Permission 及其关联关系的变化，事务提交后统一
+# 通知订阅者（如内存鉴权图），回滚时丢弃。绕过 ORM 的批量操作（Core
+# insert/delete）需要调用 `record_changes` 自行登记。
+#
+# - user/role/permission: id 为主键，附带 uuid / name ；op 为 add / remove /
+#   update （属性修改）
+# - user_role: id 为 user_id, ref_id 为 role_id
+# - role_permission: id 为 role_id, ref_id 为 permission_id
+# - role_parent: id 为 role_id, ref_id 为 parent_id （由 `Role.add_parent` /
+#   `Role.remove_parent` 登记）
+Change = namedtuple(
+    "Change", ["op", "kind", "id", "ref_id", "uuid", "name"],
+    defaults=[None, None, None])
+
+_CHANGES_KEY = "authz_changes"
+_COMMIT_HOOKS = []
+
+
+def on_changes_committed(func):
+    """注册事务提交后的变更回调，回调参数为 `Change` 列表
+    """
+    _COMMIT_HOOKS.append(func)
+    return func
 
-@event.listens_for(Permission.__table__, 'after_create')
-def insert_initial_perms(*args, **kwargs):
-    db = dbc.session()
-    db.add(Permission(name="admin"))
-    db.commit()
 
+def record_changes(session, changes):
+    """登记当前事务中的变更（用于绕过 ORM 的批量操作）
+    """
+    session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+def _entity_change(op, obj):
+    if isinstance(obj, User):
+        return Change(op, "user", obj.id, uuid=obj.uuid)
+    if isinstance(obj, Role):
+        return Change(op, "role", obj.id, uuid=obj.uuid, name=obj.name)
+    if isinstance(obj, Permission):
+        return Change(op, "permission", obj.id, uuid=obj.uuid, name=obj.name)
+    return None
+
+
+# (关系属性, 变更类型, 是否需要交换 id/ref_id)
+_LINK_ATTRIBUTES = {
+    User: [("roles", "user_role", False)],
+    Role: [("users", "user_role", True),
+           ("permissions", "role_permission", False)],
+    Permission: [("roles", "role_permission", True)],
+}
+
+
+def _link_changes(obj):
+    for attr, kind, swap in _LINK_ATTRIBUTES.get(type(obj), []):
+        history = get_history(obj, attr, passive=PASSIVE_NO_INITIALIZE)
+        for op, targets in (("add", history.added),
+                            ("remove", history.deleted)):
+            for target in targets or ():
+                if swap:
+                    yield Change(op, kind, target.id, ref_id=obj.id)
+                else:
+                    yield Change(op, kind, obj.id, ref_id=target.id)
+
+
+@event.listens_for(Session, "after_flush")
+def collect_changes(session, _flush_context):
+    changes = []
+    for obj in session.new:
+        change = _entity_change("add", obj)
+        if change:
+            changes.append(change)
+    for obj in session.deleted:
+        change = _entity_change("remove", obj)
+        if change:
+            changes.append(change)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            change = _entity_change("update", obj)
+            if change:
+                changes.append(change)
+
+    # 关联关系两端（backref）都会记录历史，这里去重
+    seen = set()
+    for obj in list(session.new) + list(session.dirty):
+        for change in _link_changes(obj):
+            if change not in seen:
+                seen.add(change)
+                changes.append(change)
+
+    if changes:
+        record_changes(session, changes)
+
+
+def _id_chunks(ids):
+    """按 `settings.BULK_CHUNK_SIZE` 分批，IN 查询的参数个数不超过数据库的限制
+    （sqlite 最多 32766 个）
+    """
+    ids = sorted(ids)
+    size = int(settings.BULK_CHUNK_SIZE)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def affected_permission_names(session, changes):
+    """给定变更影响的权限名称（etcd 中这些权限的角色列表需要更新）
+    """
+    names = set()
+    perm_ids = set()
+    parent_ids = set()
+    for change in changes:
+        if change.kind == "permission" and change.op == "remove":
+            names.add(change.name)
+        elif change.kind == "role_permission":
+            perm_ids.add(change.ref_id)
+        elif change.kind == "role_parent":
+            parent_ids.add(change.ref_id)
+
+    if parent_ids:
+        # 子角色及其后代继承了父角色及其祖先的权限
+        closure = _ROLE_CLOSURE.c
+        ancestors = select([closure.ancestor_id]).where(
+            closure.descendant_id.in_(parent_ids))
+        rp = _ROLE_PERMISSIONS.c
+        perm_ids.update(pid for pid, in session.execute(
+            select([rp.permission_id]).where(or_(
+                rp.role_id.in_(parent_ids), rp.role_id.in_(ancestors)))))
+
+    perm = Permission.__table__
+    for chunk in _id_chunks(perm_ids):
+        names.update(name for name, in session.execute(
+            select([perm.c.name]).where(perm.c.id.in_(chunk))))
+    return names
+
+
+def write_outbox(session, changes):
+    """为受影响的权限写入 outbox 记录
+    """
+    names = affected_permission_names(session, changes)
+    if names:
+        now = datetime.datetime.utcnow()
+        session.execute(_ETCD_OUTBOX.insert(), [
+            {"permission": name, "created": now} for name in sorted(names)])
+
+
+def affected_entities(session, changes):
+    """给定变更影响的用户、角色、权限，返回 `(kind, ref)` 集合
+
+    ref 为用户/角色的 uuid 字符串或权限名称。继承关系变化时，子角色及其所有
+    后代角色的有效权限都发生变化。
+    """
+    uuids = {"user": {}, "role": {}}
+    perm_names = {}
+    for change in changes:
+        if change.kind in uuids:
+            uuids[change.kind][change.id] = change.uuid
+        elif change.kind == "permission":
+            perm_names[change.id] = change.name
+
+    user_ids, role_ids, perm_ids, child_ids = set(), set(), set(), set()
+    for change in changes:
+        if change.kind == "user":
+            user_ids.add(change.id)
+        elif change.kind == "role":
+            role_ids.add(change.id)
+        elif change.kind == "permission":
+            perm_ids.add(change.id)
+        elif change.kind == "user_role":
+            user_ids.add(change.id)
+            role_ids.add(change.ref_id)
+        elif change.kind == "role_permission":
+            role_ids.add(change.id)
+            perm_ids.add(change.ref_id)
+        elif change.kind == "role_parent":
+            child_ids.add(change.id)
+
+    if child_ids:
+        closure = _ROLE_CLOSURE.c
+        role_ids.update(child_ids)
+        role_ids.update(_id for _id, in session.execute(
+            select([closure.descendant_id]).where(
+                closure.ancestor_id.in_(child_ids))))
+
+    # 本次变更中没有附带 uuid / 名称的，从数据库读取
+    for model, ids, known, column in (
+            (User, user_ids, uuids["user"], User.uuid),
+            (Role, role_ids, uuids["role"], Role.uuid),
+            (Permission, perm_ids, perm_names, Permission.name)):
+        for chunk in _id_chunks(ids - set(known)):
+            known.update((_id, value) for _id, value in session.execute(
+                select([model.id, column]).where(model.id.in_(chunk))))
+
+    result = set()
+    for kind, ids, known in (("user", user_ids, uuids["user"]),
+                             ("role", role_ids, uuids["role"]),
+                             ("permission", perm_ids, perm_names)):
+        for _id in ids:
+            if known.get(_id) is not None:
+                result.add((kind, str(known[_id])))
+    return result
+
+
+def next_revision(session):
+    """全局修订号加 1 并返回（锁定修订号到事务结束）
+    """
+    session.execute(_REVISION.update().values(
+        revision=_REVISION.c.revision + 1))
+    return session.execute(select([_REVISION.c.revision])).scalar()
+
+
+def current_revision(db):
+    return db.execute(select([_REVISION.c.revision])).scalar() or 0
+
+
+def write_change_log(session, changes):
+    """分配修订号，记录受影响的实体
+    """
+    entities = affected_entities(session, changes)
+    if not entities:
+        return
+    revision = next_revision(session)
+    now = datetime.datetime.utcnow()
+    session.execute(_CHANGE_LOG.insert(), [
+        {"revision": revision, "kind": kind, "ref": ref, "created": now}
+        for kind, ref in sorted(entities)])
+
+
+def read_change_log(db, since, limit):
+    """读取修订号 `since` 之后的变更，返回 `(修订号, 是否还有更多, 实体)`
+
+    实体为 `{"user": [...], "role": [...], "permission": [...]}` 。最多读取
+    约 `limit` 条记录，但不拆分同一修订号的记录：返回的修订号之前（含）的变更
+    都已包含在结果中，客户端下次从该修订号继续读取。
+    """
+    log = _CHANGE_LOG.c
+    rows = db.execute(
+        select([log.revision, log.kind, log.ref])
+        .where(log.revision > since)
+        .order_by(log.revision, log.id).limit(limit + 1)).fetchall()
+    more = len(rows) > limit
+    if more:
+        last = rows[limit - 1].revision
+        if rows[0].revision == last:
+            # 单个修订号超过 limit 条记录，完整返回该修订号
+            rows = db.execute(
+                select([log.revision, log.kind, log.ref])
+                .where(log.revision == last)).fetchall()
+        else:
+            rows = [r for r in rows[:limit] if r.revision < last]
+        revision = rows[-1].revision
+    else:
+        revision = rows[-1].revision if rows else since
+
+    entities = {"user": set(), "role": set(), "permission": set()}
+    for _, kind, ref in rows:
+        entities[kind].add(ref)
+    return revision, more, {k: sorted(v) for k, v in entities.items()}
+
+
+def oldest_since(db):
+    """仍可以读取变更的最小 `since`
+
+    每个修订号至少有一条变更记录，清理按修订号整体删除，因此保留的记录从最小的
+    修订号起是连续的；全部清理后只能从当前修订号开始。
+    """
+    oldest = db.execute(select([func.min(_CHANGE_LOG.c.revision)])).scalar()
+    if oldest is None:
+        return current_revision(db)
+    return oldest - 1
+
+
+def prune_change_log(db, before, batch_size):
+    """删除 `before` （UTC 时间）之前的变更记录，返回删除的记录数
+
+    按修订号从小到大，每次删除最多 `batch_size` 个修订号的记录（一个事务），
+    避免长时间锁表。同一修订号的记录创建时间相同，不会被部分删除。
+    """
+    log = _CHANGE_LOG.c
+    deleted = 0
+    while True:
+        first = db.execute(select([func.min(log.revision)])).scalar()
+        if first is None:
+            break
+        created = db.execute(select([log.created]).where(
+            log.revision == first).limit(1)).scalar()
+        if created >= before:
+            break
+        deleted += db.execute(_CHANGE_LOG.delete().where(and_(
+            log.revision < first + batch_size, log.created < before))).rowcount
+        db.commit()
+    return deleted
+
+
+@event.listens_for(Session, "before_commit")
+def write_commit_records(session):
+    """提交前在同一事务中写入变更日志与 etcd outbox
+    """
+    # 提交时的 flush 在本回调之后执行，这里先 flush 以收集全部变更
+    session.flush()
+    changes = session.info.get(_CHANGES_KEY)
+    if not changes:
+        return
+    write_change_log(session, changes)
+    if settings.SYCN_ETCD == "true":
+        write_outbox(session, changes)
+
+
+@event.listens_for(Session, "after_commit")
+def dispatch_changes(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if not changes:
+        return
+    for hook in _COMMIT_HOOKS:
+        try:
+            hook(changes)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("dispatch changes to %s failed", hook)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def discard_changes(session, transaction):
+    # 提交时已在 after_commit 中取走，这里只会丢弃回滚/关闭的事务的变更
+    if transaction.parent is None:
+        session.info.pop(_CHANGES_KEY, None)
+
+
+def make_link_indexes_unique(conn):
+    """迁移：删除关联表中重复的记录，将联合索引改为唯一索引
+
+    已经是唯一索引的表跳过，可以重复执行。返回 `{表名: 删除的重复记录数}` 。
+    """
+    result = {}
+    inspector = inspect(conn)
+    for table in (_USER_ROLES, _ROLE_PERMISSIONS):
+        index = next(ix for ix in table.indexes if ix.unique)
+        current = {ix["name"]: ix for ix in inspector.get_indexes(table.name)}
+        if current.get(index.name, {}).get("unique"):
+            continue
+
+        left, right = table.c
+        dups = conn.execute(
+            select([left, right, func.count()])
+            .group_by(left, right).having(func.count() > 1)).fetchall()
+        if dups:
+            # 没有主键，删除重复的关联后各插入一条
+            conn.execute(table.delete().where(and_(
+                left == bindparam("a"), right == bindparam("b"))),
+                [{"a": a, "b": b} for a, b, _ in dups])
+            conn.execute(table.insert(),
+                         [{left.key: a, right.key: b} for a, b, _ in dups])
+        result[table.name] = sum(n - 1 for _, _, n in dups)
+
+        if index.name in current:
+            index.drop(conn)
+        index.create(conn)
+    return result
+
+
+@event.listens_for(ORMBase.metadata, "after_create")
+def insert_initial_data(target, connection, tables=(), **kwargs):
+    """第一次创建表时写入初始数据
+
+    在所有表创建之后执行：写入的数据会同时写入变更日志等表。
+    """
+    if _REVISION in tables:
+        connection.execute(_REVISION.insert(), {"id": 1, "revision": 0})
 
-# 第一次创建 Role 表时创建一些默认角色
-@event.listens_for(Role.__table__, 'after_create')
-def insert_initial_roles(*args, **kwargs):
     db = dbc.session()
-    db.add(Role(name=settings.ADMIN_ROLE_NAME))
-    db.add(Role(name='anonymous'))
-    db.add(Role(name='authenticated'))
+    if Permission.__table__ in tables:
+        db.add(Permission(name="admin"))
+    # 第一次创建 Role 表时创建一些默认角色
+    if Role.__table__ in tables:
+        db.add(Role(name=settings.ADMIN_ROLE_NAME))
+        db.add(Role(name='anonymous'))
+        db.add(Role(name='authenticated'))
     db.commit()
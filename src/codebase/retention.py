@@ -0,0 +1,69 @@
+"""变更日志的定期清理
+
+`authz_change` 每次修改授权数据都会增加记录，`ChangeLogPruner` 定期删除超过
+`CHANGES_RETENTION` 秒的记录（见 `codebase.models.prune_change_log`）。`since`
+早于保留的最早修订号时，`/changes` 与 `/watch` 返回 `since-too-old` ，客户端
+需要重新同步。每个部署只需要一个（多进程时只在 worker 0 中运行）。
+"""
+
+import asyncio
+import datetime
+import logging
+
+from eva.conf import settings
+from tornado.ioloop import IOLoop
+
+from codebase.models import prune_change_log
+from codebase.utils.sqlalchemy import dbc
+
+
+def prune(retention=None, batch_size=None):
+    """删除超过保留时间的变更记录，返回删除的记录数
+    """
+    retention = int(settings.CHANGES_RETENTION if retention is None
+                    else retention)
+    if retention <= 0:
+        return 0
+    before = (datetime.datetime.utcnow() -
+              datetime.timedelta(seconds=retention))
+    db = dbc.session.session_factory()
+    try:
+        return prune_change_log(
+            db, before, int(batch_size or settings.CHANGES_PRUNE_BATCH))
+    finally:
+        db.close()
+
+
+class ChangeLogPruner:
+    """定期清理变更日志的后台任务，`stats` 记录删除的记录数与失败次数
+    """
+
+    def __init__(self, interval=None):
+        self.interval = float(interval or settings.CHANGES_PRUNE_INTERVAL)
+        self.stats = {"deleted": 0, "errors": 0}
+        self._running = False
+
+    def start(self):
+        """在当前 IOLoop 中启动
+        """
+        self._running = True
+        IOLoop.current().spawn_callback(self.run)
+
+    def stop(self):
+        self._running = False
+
+    async def prune_once(self):
+        deleted = await dbc.run_in_executor(prune)
+        self.stats["deleted"] += deleted
+        if deleted:
+            logging.info("pruned %d change log records", deleted)
+        return deleted
+
+    async def run(self):
+        while self._running:
+            try:
+                await self.prune_once()
+            except Exception:  # pylint: disable=broad-except
+                self.stats["errors"] += 1
+                logging.exception("prune change log failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,282 @@
+"""授权数据同步到 etcd
+
+网关等服务从 etcd 读取 `ga.auth.permissions.{权限名称}.roles` （拥有该权限的角色
+名称列表，JSON），这里负责在授权关系变化后更新这些 key 。
+
+修改授权关系的事务同时在 outbox 表（`authz_etcd_outbox`）中写入受影响的权限名称
+（见 `codebase.models.write_outbox`），请求不等待 etcd 。后台任务
+`OutboxDrainer` 批量读取 outbox ，合并重复的权限，根据数据库中的当前数据计算 key
+的值，在一个 etcd 事务中全部写入（权限已不存在或没有任何角色时删除 key），成功后
+删除这些 outbox 记录；失败时保留记录，按指数退避重试。
+
+同步是基于状态的，重复同步是安全的。etcd 中的数据与数据库不一致时（如 outbox
+记录丢失、etcd 数据被误改），使用 `reconcile` （`manage.py core syncetcd`）
+全量校正。
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+from eva.conf import settings
+from sqlalchemy import func, select
+from tornado.ioloop import IOLoop
+from tornado.locks import Event
+from tornado.util import TimeoutError as _TimeoutError
+
+from codebase.models import (
+    Permission,
+    on_changes_committed,
+    _ETCD_OUTBOX,
+)
+from codebase.utils.etcd import get_client
+from codebase.utils.metrics import REGISTRY
+from codebase.utils.sqlalchemy import dbc
+
+
+PERMISSION_KEY_PREFIX = "ga.auth.permissions."
+PERMISSION_KEY_SUFFIX = ".roles"
+
+
+def get_permission_role_key(permission):
+    return f"{PERMISSION_KEY_PREFIX}{permission}{PERMISSION_KEY_SUFFIX}"
+
+
+def _same_value(current, expected):
+    if current is None or expected is None:
+        return current is expected
+    try:
+        return json.loads(current) == json.loads(expected)
+    except ValueError:
+        return False
+
+
+def permission_role_values(db, names):
+    """计算给定权限对应的 etcd key/value ，值为 None 表示删除
+    """
+    roles = Permission.role_names(db, names)
+    values = {}
+    for name in names:
+        key = get_permission_role_key(name)
+        values[key] = json.dumps(roles[name]) if roles.get(name) else None
+    return values
+
+
+def load_outbox(batch_size):
+    """读取最早的一批 outbox 记录，返回 `(ids, 最早的创建时间, etcd key/value)`
+    """
+    db = dbc.session()
+    outbox = _ETCD_OUTBOX.c
+    rows = db.execute(
+        select([outbox.id, outbox.permission, outbox.created])
+        .order_by(outbox.id).limit(batch_size)).fetchall()
+    if not rows:
+        return [], None, {}
+    # 先读 outbox 再读授权数据，计算出的值不会早于这些记录对应的修改
+    names = sorted({r.permission for r in rows})
+    return ([r.id for r in rows], min(r.created for r in rows),
+            permission_role_values(db, names))
+
+
+def delete_outbox(ids):
+    # 按 id 删除：读取之后提交的记录（id 可能更小）需要在下一批同步
+    db = dbc.session()
+    db.execute(_ETCD_OUTBOX.delete().where(_ETCD_OUTBOX.c.id.in_(ids)))
+    db.commit()
+
+
+def count_outbox():
+    db = dbc.session()
+    return db.execute(
+        select([func.count()]).select_from(_ETCD_OUTBOX)).scalar()
+
+
+# 本进程中运行的同步任务（`OutboxDrainer.start` 时设置）
+_active = None
+
+
+@REGISTRY.collector
+def outbox_metrics():
+    drainer = _active
+    if drainer is None:
+        return []
+    stats = drainer.stats
+    return [
+        ("authz_etcd_outbox_lag_seconds", "gauge",
+         "Seconds from outbox insert to etcd write for the last batch.",
+         [("", {}, stats["lag"])]),
+        ("authz_etcd_outbox_pending", "gauge",
+         "Outbox rows waiting to be synced after the last batch.",
+         [("", {}, stats["pending"])]),
+        ("authz_etcd_outbox_synced_total", "counter",
+         "Outbox rows synced to etcd.",
+         [("", {}, stats["synced"])]),
+        ("authz_etcd_outbox_errors_total", "counter",
+         "Failed outbox sync attempts.",
+         [("", {}, stats["errors"])]),
+    ]
+
+
+class OutboxDrainer:
+    """将 outbox 中的权限同步到 etcd 的后台任务
+
+    每个部署只需要一个（多进程时只在 worker 0 中运行）。`stats` 记录：
+
+    - `synced`: 已同步的 outbox 记录数
+    - `keys`: 已写入（或删除）的 etcd key 数
+    - `batches` / `errors`: 成功的批次数 / 失败次数
+    - `lag`: 最近一批中最早的记录从写入 outbox 到同步完成的秒数（传播延迟）
+    - `pending`: 最近一批同步后 outbox 中剩余的记录数
+
+    启动后 `stats` 通过 `/_metrics` 输出（`authz_etcd_outbox_*`）。
+    """
+
+    def __init__(self, client=None, batch_size=None, interval=None,
+                 max_backoff=None):
+        self.client = client
+        self.batch_size = int(batch_size or settings.ETCD_OUTBOX_BATCH_SIZE)
+        self.interval = float(interval or settings.ETCD_OUTBOX_INTERVAL)
+        self.max_backoff = float(
+            max_backoff or settings.ETCD_OUTBOX_MAX_BACKOFF)
+        self.failures = 0
+        self.stats = {"synced": 0, "keys": 0, "batches": 0, "errors": 0,
+                      "lag": 0.0, "pending": 0}
+        self.io_loop = None
+        self._wake = Event()
+        self._running = False
+
+    def start(self):
+        """在当前 IOLoop 中启动
+        """
+        global _active  # pylint: disable=global-statement
+        self.io_loop = IOLoop.current()
+        self._running = True
+        _active = self
+        on_changes_committed(self._on_changes)
+        self.io_loop.spawn_callback(self.run)
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def _on_changes(self, _changes):
+        # 本进程内的修改立即唤醒，其他进程的修改等待下次轮询；
+        # 回调在数据库线程中执行
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self._wake.set)
+
+    def backoff(self):
+        return min(self.interval * 2 ** self.failures, self.max_backoff)
+
+    async def drain_once(self):
+        """同步一批 outbox 记录，返回同步的记录数，etcd 失败时抛出 `EtcdError`
+        """
+        ids, created, values = await dbc.run_in_executor(
+            load_outbox, self.batch_size)
+        if not ids:
+            self.stats["pending"] = 0
+            return 0
+        await (self.client or get_client()).txn(values)
+        await dbc.run_in_executor(delete_outbox, ids)
+        self.stats["pending"] = await dbc.run_in_executor(count_outbox)
+
+        lag = (datetime.datetime.utcnow() - created).total_seconds()
+        self.stats["lag"] = lag
+        self.stats["synced"] += len(ids)
+        self.stats["keys"] += len(values)
+        self.stats["batches"] += 1
+        logging.debug("synced %d permissions to etcd, lag %.3fs",
+                      len(values), lag)
+        return len(ids)
+
+    async def run(self):
+        while self._running:
+            self._wake.clear()
+            try:
+                count = await self.drain_once()
+            except Exception as e:  # pylint: disable=broad-except
+                self.failures += 1
+                self.stats["errors"] += 1
+                delay = self.backoff()
+                logging.error("sync outbox to etcd failed (%d): %s, "
+                              "retry in %.1fs", self.failures, e, delay)
+                # 退避期间不因新的修改提前重试
+                await asyncio.sleep(delay)
+                continue
+
+            self.failures = 0
+            if count >= self.batch_size:
+                # 还有积压，继续同步
+                continue
+            try:
+                await self._wake.wait(
+                    datetime.timedelta(seconds=self.interval))
+            except _TimeoutError:
+                pass
+
+
+async def reconcile(client=None, batch_size=None, dry_run=False):
+    """根据数据库全量校正 etcd 中的 `ga.auth.permissions.*.roles`
+
+    1. 按 id 分批读取权限，计算角色列表，与 etcd 中对应的 key 比较，只写入有
+       差异的 key （没有角色的权限删除 key）
+    2. 分页扫描 etcd 中的前缀，删除数据库中已不存在的权限的 key
+
+    每批最多 `batch_size` （默认 `ETCD_MAX_TXN_OPS`）个权限/key ，内存占用与
+    数据量无关。`dry_run` 为真时只比较不写入。返回统计信息。
+    """
+    client = client or get_client()
+    batch_size = int(batch_size or settings.ETCD_MAX_TXN_OPS)
+    stats = {"permissions": 0, "keys": 0, "put": 0, "delete": 0,
+             "unchanged": 0, "seconds": 0.0}
+    start = time.monotonic()
+
+    async def apply(current, expected):
+        changed = {k: v for k, v in expected.items()
+                   if not _same_value(current.get(k), v)}
+        for value in changed.values():
+            stats["put" if value is not None else "delete"] += 1
+        stats["unchanged"] += len(expected) - len(changed)
+        if changed and not dry_run:
+            await client.txn(changed)
+
+    db = dbc.session()
+    perm = Permission.__table__
+    try:
+        last_id = 0
+        while True:
+            rows = db.execute(
+                select([perm.c.id, perm.c.name])
+                .where(perm.c.id > last_id)
+                .order_by(perm.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            expected = permission_role_values(db, [r.name for r in rows])
+            # 结束只读事务，避免长事务
+            db.rollback()
+            current = await client.get_many(list(expected))
+            await apply(current, expected)
+            stats["permissions"] += len(rows)
+
+        async for current in client.iter_prefix(
+                PERMISSION_KEY_PREFIX, batch_size):
+            stats["keys"] += len(current)
+            names = {}
+            for key in current:
+                if key.endswith(PERMISSION_KEY_SUFFIX):
+                    names[key[len(PERMISSION_KEY_PREFIX):
+                              -len(PERMISSION_KEY_SUFFIX)]] = key
+            exist = {name for name, in db.execute(
+                select([perm.c.name]).where(perm.c.name.in_(list(names))))}
+            db.rollback()
+            # 已存在的权限在第一步中处理，这里只删除多余的 key
+            await apply(current, {key: None for name, key in names.items()
+                                  if name not in exist})
+    finally:
+        db.close()
+
+    stats["seconds"] = time.monotonic() - start
+    return stats
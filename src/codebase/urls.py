@@ -3,6 +3,8 @@ from tornado.web import url
 from codebase.controllers import (
     default,
     authz,
+    bulk,
+    change,
     permission,
     role,
     user
@@ -18,6 +20,12 @@ HANDLERS = [
     url(r"/_health",
         default.HealthHandler),
 
+    url(r"/_debug/db",
+        default.DebugDBHandler),
+
+    url(r"/_metrics",
+        default.MetricsHandler),
+
     # Authorization
     url(r"/has_permission",
         authz.HasPermissionHandler),
@@ -25,8 +33,31 @@ HANDLERS = [
     url(r"/has_permission_id",
         authz.HasPermissionIDHandler),
 
+    url(r"/has_permission/batch",
+        authz.HasPermissionBatchHandler),
+
+    # Bulk
+    url(r"/bulk/import",
+        bulk.BulkImportHandler),
+
+    url(r"/bulk/export",
+        bulk.BulkExportHandler),
+
+    # Change
+    url(r"/changes",
+        change.ChangeHandler),
+
+    url(r"/watch",
+        change.WatchHandler),
+
     # User
 
+    url(r"/user/role/append",
+        user.UserRoleBulkAppendHandler),
+
+    url(r"/user/role/remove",
+        user.UserRoleBulkRemoveHandler),
+
     url(r"/user/"
         r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
         r"/role",
@@ -59,6 +90,21 @@ HANDLERS = [
         r"/permission",
         role.RolePermissionHandler),
 
+    url(r"/role/"
+        r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+        r"/parent",
+        role.RoleParentHandler),
+
+    url(r"/role/"
+        r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+        r"/parent/append",
+        role.RoleParentAppendHandler),
+
+    url(r"/role/"
+        r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+        r"/parent/remove",
+        role.RoleParentRemoveHandler),
+
     url(r"/role/permission/append",
         role.RolePermissionAppendHandler),
 
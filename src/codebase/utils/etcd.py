@@ -0,0 +1,191 @@
+"""etcd v3 异步客户端
+
+通过 etcd 的 gRPC-JSON 网关（HTTP）访问，基于 Tornado `AsyncHTTPClient` ：
+
+- 进程内长期复用，连接池大小为 `ETCD_POOL_SIZE`
+- 配置多个 endpoint 时，请求失败（网络错误、5xx）自动切换到下一个，并记住可用的
+  endpoint
+- `txn` 在一个事务中写入/删除多个 key ，超过 `ETCD_MAX_TXN_OPS` （etcd 服务端
+  `--max-txn-ops` ，默认 128）时分为多个事务
+
+不使用 etcd3-py 的客户端：它在构造时同步探测服务端版本，会阻塞 IOLoop 。
+"""
+
+import base64
+import json
+import logging
+
+from eva.conf import settings
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+
+class EtcdError(Exception):
+    """etcd 请求失败（所有 endpoint 均不可用，或请求本身出错）
+    """
+
+
+def _encode(value):
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    return base64.b64encode(value).decode("ascii")
+
+
+def _decode(value):
+    return base64.b64decode(value).decode("utf8")
+
+
+def prefix_range_end(prefix):
+    """以 `prefix` 为前缀的所有 key 的 range_end
+    """
+    end = bytearray(prefix.encode("utf8"))
+    end[-1] += 1
+    return bytes(end)
+
+
+class EtcdClient:
+
+    def __init__(self, endpoints, api_prefix="/v3", timeout=3, pool_size=10,
+                 max_txn_ops=128):
+        self.endpoints = [
+            e if "://" in e else f"http://{e}" for e in endpoints]
+        self.api_prefix = api_prefix
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_txn_ops = max_txn_ops
+        self._current = 0
+        self._http = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            [e.strip() for e in settings.ETCD_ENDPOINTS.split(";") if e.strip()],
+            api_prefix=settings.ETCD_API_PREFIX,
+            timeout=float(settings.ETCD_TIMEOUT),
+            pool_size=int(settings.ETCD_POOL_SIZE),
+            max_txn_ops=int(settings.ETCD_MAX_TXN_OPS),
+        )
+
+    @property
+    def http(self):
+        # 在 IOLoop 中首次使用时创建，独立的连接池不与其他请求共享
+        if self._http is None:
+            self._http = AsyncHTTPClient(
+                force_instance=True, max_clients=self.pool_size)
+        return self._http
+
+    def close(self):
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+    async def call(self, method, body):
+        """调用网关接口（如 `/kv/txn`），返回解析后的 JSON
+        """
+        error = None
+        for i in range(len(self.endpoints)):
+            index = (self._current + i) % len(self.endpoints)
+            url = self.endpoints[index] + self.api_prefix + method
+            try:
+                resp = await self.http.fetch(
+                    url, method="POST", body=json.dumps(body),
+                    headers={"Content-Type": "application/json"},
+                    request_timeout=self.timeout, raise_error=False)
+            except (OSError, HTTPClientError) as e:
+                # 连接失败、超时等，尝试下一个 endpoint
+                error = e
+            else:
+                if resp.code < 500 and resp.code != 599:
+                    if resp.code >= 400:
+                        raise EtcdError(f"{url}: {resp.code} {resp.body!r}")
+                    self._current = index
+                    return json.loads(resp.body) if resp.body else {}
+                error = resp.error or resp.code
+            logging.warning("etcd endpoint %s failed: %s",
+                            self.endpoints[index], error)
+        raise EtcdError(f"all etcd endpoints failed, last error: {error}")
+
+    async def txn(self, values):
+        """写入多个 key ，值为 None 时删除该 key
+
+        每 `max_txn_ops` 个 key 一个事务，返回事务数。
+        """
+        ops = []
+        for key, value in values.items():
+            if value is None:
+                ops.append({"request_delete_range": {"key": _encode(key)}})
+            else:
+                ops.append({"request_put": {
+                    "key": _encode(key), "value": _encode(value)}})
+        for i in range(0, len(ops), self.max_txn_ops):
+            await self.call("/kv/txn", {
+                "success": ops[i:i + self.max_txn_ops]})
+        return (len(ops) + self.max_txn_ops - 1) // self.max_txn_ops
+
+    async def range(self, key, range_end=None, limit=0):
+        """读取 key（或 [key, range_end) 范围内的所有 key），返回 `{key: value}`
+        """
+        data = await self.call("/kv/range", _range_request(key, range_end, limit))
+        return _decode_kvs(data)
+
+    async def get(self, key):
+        return (await self.range(key)).get(key)
+
+    async def get_many(self, keys):
+        """在一个事务中读取多个 key ，返回存在的 `{key: value}`
+        """
+        result = {}
+        for i in range(0, len(keys), self.max_txn_ops):
+            data = await self.call("/kv/txn", {"success": [
+                {"request_range": _range_request(key)}
+                for key in keys[i:i + self.max_txn_ops]]})
+            for resp in data.get("responses", []):
+                result.update(_decode_kvs(resp.get("response_range", {})))
+        return result
+
+    async def iter_prefix(self, prefix, limit=1000):
+        """按 key 的顺序分页读取以 `prefix` 开头的所有 key ，每页生成一个
+        `{key: value}` ，不一次读取全部数据
+        """
+        start = prefix.encode("utf8")
+        end = prefix_range_end(prefix)
+        while True:
+            data = await self.call("/kv/range", _range_request(start, end, limit))
+            kvs = data.get("kvs", [])
+            if kvs:
+                yield _decode_kvs(data)
+            if not data.get("more") or not kvs:
+                break
+            start = base64.b64decode(kvs[-1]["key"]) + b"\0"
+
+
+def _range_request(key, range_end=None, limit=0):
+    body = {"key": _encode(key)}
+    if range_end is not None:
+        body["range_end"] = _encode(range_end)
+    if limit:
+        body["limit"] = limit
+    return body
+
+
+def _decode_kvs(data):
+    return {_decode(kv["key"]): _decode(kv.get("value", ""))
+            for kv in data.get("kvs", [])}
+
+
+_client = None
+
+
+def get_client():
+    """进程内共享的 etcd 客户端
+    """
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        _client = EtcdClient.from_settings()
+    return _client
+
+
+def reset_client():
+    global _client  # pylint: disable=global-statement
+    if _client is not None:
+        _client.close()
+    _client = None
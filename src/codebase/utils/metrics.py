@@ -0,0 +1,196 @@
+"""进程内指标
+
+`Counter` / `LabeledHistogram` 按标签值记录，`REGISTRY.render()` 输出 Prometheus
+文本格式（`/_metrics`）。记录只是一次字典查找与加锁累加；无法在记录时统计的数据
+（如缓存命中数、连接池状态）通过 `REGISTRY.collector` 注册回调，在输出时读取。
+"""
+
+import bisect
+import threading
+
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """分桶计数（线程安全）
+
+    `buckets` 为各桶的上限（升序），超过最大上限的计入 `+Inf` 。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self):
+        """返回 `[(上限, 小于等于该上限的计数)]` ，最后一项上限为 `+Inf`
+        """
+        with self._lock:
+            counts = list(self.counts)
+        result = []
+        total = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        """JSON 可序列化的快照
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": [{"le": "+Inf" if b == float("inf") else b, "count": n}
+                        for b, n in self.cumulative()],
+        }
+
+
+class Counter:
+    """按标签值累加的计数（线程安全）
+    """
+
+    def __init__(self, labelnames=()):
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [("", dict(zip(self.labelnames, k)), v) for k, v in items]
+
+
+class LabeledHistogram:
+    """按标签值分组的 `Histogram`
+    """
+
+    def __init__(self, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        histogram = self.histograms.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    labels, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def samples(self):
+        result = []
+        for key, histogram in list(self.histograms.items()):
+            result.extend(histogram_samples(
+                dict(zip(self.labelnames, key)), histogram))
+        return result
+
+
+def histogram_samples(labels, histogram):
+    """`Histogram` 的样本：`_bucket` （累计计数）、`_sum` 、`_count`
+    """
+    result = []
+    for bound, n in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(float(bound))
+        result.append(("_bucket", dict(labels, le=le), n))
+    result.append(("_sum", labels, histogram.sum))
+    result.append(("_count", labels, histogram.count))
+    return result
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n").replace('"', '\\"')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        label_str = ",".join(
+            f'{k}="{_escape(v)}"' for k, v in labels.items())
+        name = f"{name}{{{label_str}}}"
+    if isinstance(value, float):
+        value = repr(value)
+    return f"{name} {value}"
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.caches = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(labelnames)
+        self.metrics.append((name, "counter", documentation, metric))
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        metric = LabeledHistogram(labelnames, buckets)
+        self.metrics.append((name, "histogram", documentation, metric))
+        return metric
+
+    def collector(self, func):
+        """注册输出时调用的回调，返回 `[(名称, 类型, 说明, [(后缀, 标签, 值)])]`
+        """
+        self.collectors.append(func)
+        return func
+
+    def cache(self, name, stats):
+        """注册缓存，`stats()` 返回 `(命中数, 未命中数, 当前项数)`
+        """
+        self.caches[name] = stats
+
+    def cache_samples(self):
+        hits, misses, sizes, ratios = [], [], [], []
+        for name, stats in sorted(self.caches.items()):
+            hit, miss, size = stats()
+            labels = {"cache": name}
+            hits.append(("", labels, hit))
+            misses.append(("", labels, miss))
+            sizes.append(("", labels, size))
+            ratios.append(("", labels, hit / (hit + miss) if hit + miss else 0.0))
+        return [
+            ("authz_cache_hits_total", "counter", "Cache hits.", hits),
+            ("authz_cache_misses_total", "counter", "Cache misses.", misses),
+            ("authz_cache_size", "gauge", "Cached items.", sizes),
+            ("authz_cache_hit_ratio", "gauge",
+             "Cache hit ratio since process start.", ratios),
+        ]
+
+    def collect(self):
+        for name, kind, documentation, metric in self.metrics:
+            yield name, kind, documentation, metric.samples()
+        if self.caches:
+            yield from self.cache_samples()
+        for func in self.collectors:
+            yield from func()
+
+    def render(self):
+        lines = []
+        for name, kind, documentation, samples in self.collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(_format_sample(name + suffix, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,105 @@
+"""多进程（pre-fork）运行
+
+父进程绑定监听端口后 fork 出多个 worker 共享该端口，父进程只负责监控：
+
+- worker 异常退出时重新启动（超过最大重启次数后整体退出）
+- 收到 SIGTERM / SIGINT 时转发给所有 worker ，等待它们优雅退出
+
+参考 `tornado.process.fork_processes` ，增加了信号转发。
+"""
+
+import logging
+import os
+import signal
+import sys
+import time
+
+
+_worker_id = None
+
+
+def worker_id():
+    """当前 worker 的编号（0 ~ N-1），单进程模式下返回 None
+    """
+    return _worker_id
+
+
+def fork_workers(num_workers, max_restarts=100):
+    """启动 `num_workers` 个 worker 进程
+
+    在 worker 进程中返回其编号；父进程不会返回，所有 worker 退出后父进程退出。
+    必须在创建 IOLoop 及数据库连接之前调用。
+    """
+    global _worker_id  # pylint: disable=global-statement
+
+    children = {}
+    stopping = []
+
+    def forward_signal(sig, _frame):
+        logging.warning("Caught signal: %s, forward to workers", sig)
+        stopping.append(sig)
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    # 在 fork 之前设置，避免错过 fork 期间收到的信号
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+
+    def start_child(i):
+        pid = os.fork()
+        if pid == 0:
+            # worker 进程使用默认信号处理，由调用方重新设置
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return i
+        children[pid] = i
+        return None
+
+    logging.info("Starting %d worker processes", num_workers)
+    for i in range(num_workers):
+        wid = start_child(i)
+        if wid is not None:
+            _worker_id = wid
+            return wid
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+
+        wid = children.pop(pid)
+        if stopping:
+            logging.info("worker %d (pid %d) exited", wid, pid)
+            continue
+
+        if os.WIFSIGNALED(status):
+            logging.warning("worker %d (pid %d) killed by signal %d, restarting",
+                            wid, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning("worker %d (pid %d) exited with status %d, restarting",
+                            wid, pid, os.WEXITSTATUS(status))
+        else:
+            logging.info("worker %d (pid %d) exited normally", wid, pid)
+            continue
+
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error("Too many worker restarts, giving up")
+            forward_signal(signal.SIGTERM, None)
+            continue
+
+        # 避免 worker 启动即失败时频繁重启
+        time.sleep(min(restarts, 5) * 0.2)
+        new_id = start_child(wid)
+        if new_id is not None:
+            _worker_id = new_id
+            return new_id
+
+    sys.exit(1 if restarts > max_restarts else 0)
@@ -2,20 +2,111 @@
 """SQLAlchemy Help Method
 """
 
+import contextvars
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.process import cpu_count
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import OperationalError, InterfaceError, ProgrammingError
+from sqlalchemy.exc import (
+    OperationalError,
+    InterfaceError,
+    ProgrammingError,
+    TimeoutError as PoolTimeoutError,
+)
 
 from eva.conf import settings
 
+from codebase.utils.metrics import REGISTRY, Histogram, histogram_samples
+
 
 ORMBase = declarative_base()
 
 
+class PoolMetrics:
+    """连接池指标：获取连接的等待时间分布、正在等待的线程数、超时次数
+    """
+
+    def __init__(self):
+        self.wait = Histogram()
+        self.waiting = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.waiting += 1
+        return time.perf_counter()
+
+    def end(self, start, timeout=False):
+        self.wait.observe(time.perf_counter() - start)
+        with self._lock:
+            self.waiting -= 1
+            if timeout:
+                self.timeouts += 1
+
+
+class TimedQueuePool(QueuePool):
+    """记录获取连接等待时间的 `QueuePool`
+    """
+
+    def __init__(self, creator, **kwargs):
+        self.metrics = kwargs.pop("metrics", None) or PoolMetrics()
+        super().__init__(creator, **kwargs)
+
+    def _do_get(self):
+        start = self.metrics.begin()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.end(start, timeout=True)
+            raise
+        except Exception:
+            self.metrics.end(start)
+            raise
+        self.metrics.end(start)
+        return conn
+
+    def recreate(self):
+        # engine.dispose() 时重建连接池，保留指标
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def status_dict(self):
+        return {
+            "pool_size": self.size(),
+            "max_overflow": self._max_overflow,
+            "timeout": self._timeout,
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "waiting": self.metrics.waiting,
+            "timeouts": self.metrics.timeouts,
+            "wait_seconds": self.metrics.wait.snapshot(),
+        }
+
+
+def pool_options():
+    """由 settings 生成 `create_engine` 的连接池参数
+    """
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(settings.DB_POOL_SIZE),
+        "max_overflow": int(settings.DB_MAX_OVERFLOW),
+        "pool_timeout": float(settings.DB_POOL_TIMEOUT),
+        "pool_recycle": int(settings.DB_POOL_RECYCLE),
+        "pool_pre_ping": settings.DB_POOL_PRE_PING == "true",
+    }
+
+
 class DBC:
     """DB Connection
 
@@ -25,9 +116,81 @@ class DBC:
 
     def __init__(self):
         self.db_uri = settings.DB_URI
-        self.engine = create_engine(self.db_uri, echo=False)
+        if self.db_uri in ("sqlite://", "sqlite:///:memory:"):
+            # 内存数据库只存在于单个连接中，线程池中的查询需要共享该连接
+            kwargs = {"poolclass": StaticPool,
+                      "connect_args": {"check_same_thread": False}}
+        else:
+            kwargs = pool_options()
+            if self.db_uri.startswith("sqlite"):
+                # 文件 SQLite ：连接会在线程池的不同线程中借出、归还
+                kwargs["connect_args"] = {"check_same_thread": False}
+        self.engine = create_engine(self.db_uri, echo=False, **kwargs)
         session_factory = sessionmaker(bind=self.engine)
         self.session = scoped_session(session_factory)
+        self._executor = None
+
+    def executor_workers(self):
+        """线程池大小：`settings.DB_EXECUTOR_WORKERS`
+
+        `StaticPool` （内存 SQLite）的所有线程共享同一个 DBAPI 连接，多个线程
+        同时使用会交错执行彼此的事务，因此只使用一个线程，数据库操作串行执行。
+        """
+        if isinstance(self.engine.pool, StaticPool):
+            return min(int(settings.DB_EXECUTOR_WORKERS), 1)
+        return int(settings.DB_EXECUTOR_WORKERS)
+
+    @property
+    def executor(self):
+        """执行数据库操作的有界线程池（`executor_workers`）
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.executor_workers(),
+                thread_name_prefix="db",
+            )
+        return self._executor
+
+    def run_in_executor(self, func, *args, **kwargs):
+        """在线程池中执行 `func` ，返回可以 await 的 Future
+
+        `func` 中通过 `self.session` 获得的是工作线程自己的 session，执行结束
+        后自动清理。`DB_EXECUTOR_WORKERS` 为 0 时直接在当前线程执行。
+        `func` 在调用方上下文（contextvars）的副本中执行。
+        """
+        if self.executor_workers() <= 0:
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+            return future
+
+        def task():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.session.remove()
+
+        context = contextvars.copy_context()
+        return IOLoop.current().run_in_executor(
+            self.executor, context.run, task)
+
+    def pool_status(self):
+        """连接池状态，供 `/_debug/db` 使用
+        """
+        pool = self.engine.pool
+        status = {"pool_class": type(pool).__name__}
+        if isinstance(pool, TimedQueuePool):
+            status.update(pool.status_dict())
+            # 每个 worker 进程一个连接池
+            workers = int(settings.WORKERS) or cpu_count()
+            status["max_connections_per_process"] = (
+                status["pool_size"] + status["max_overflow"])
+            status["max_connections"] = (
+                status["max_connections_per_process"] * workers)
+        status["executor_workers"] = self.executor_workers()
+        return status
 
     def create_all(self):
         # TODO: session.remove() 保证不会死锁
@@ -54,3 +217,26 @@ class DBC:
 
 
 dbc = DBC()
+
+
+@REGISTRY.collector
+def pool_metrics():
+    pool = dbc.engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return []
+    status = pool.status_dict()
+    return [
+        ("authz_db_pool_connections", "gauge", "Database pool connections.",
+         [("", {"state": "checked_in"}, status["checked_in"]),
+          ("", {"state": "checked_out"}, status["checked_out"]),
+          ("", {"state": "overflow"}, status["overflow"])]),
+        ("authz_db_pool_waiting", "gauge",
+         "Threads waiting for a database connection.",
+         [("", {}, status["waiting"])]),
+        ("authz_db_pool_timeouts_total", "counter",
+         "Database connection checkout timeouts.",
+         [("", {}, status["timeouts"])]),
+        ("authz_db_pool_wait_seconds", "histogram",
+         "Database connection checkout wait time.",
+         histogram_samples({}, pool.metrics.wait)),
+    ]
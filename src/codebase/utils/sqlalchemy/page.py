@@ -1,15 +1,113 @@
 # pylint: disable=invalid-name
 
+import base64
+import datetime
+import json
+
 from eva.conf import settings
-from sqlalchemy import asc, desc, func, inspect
+from sqlalchemy import and_, asc, desc, event, func, inspect, or_, text, DateTime
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.ddl import DropTable
+from sqlalchemy.sql.expression import Delete, Insert
+
+from codebase.utils.cache import TTLCache
+from codebase.utils.metrics import REGISTRY
+
+
+# 列表总数缓存，键为 (表名, 计数 SQL, 参数)
+#
+# 通过本进程写入（包括 ORM 与 Core）的 INSERT / DELETE 会使对应表的缓存失效，
+# 其他进程的写入依赖过期时间 `LIST_TOTAL_CACHE_TTL`
+totals = TTLCache(
+    maxsize=1024 if int(settings.LIST_TOTAL_CACHE_TTL) > 0 else 0,
+    ttl=int(settings.LIST_TOTAL_CACHE_TTL),
+)
+REGISTRY.cache("list_totals", lambda: (totals.hits, totals.misses, len(totals)))
+
+
+def invalidate_totals(table_name):
+    totals.evict(lambda key: key[0] == table_name)
+
+
+@event.listens_for(Engine, "after_execute")
+def _track_table_writes(conn, clauseelement, *_args):
+    if isinstance(clauseelement, (Insert, Delete)):
+        name = clauseelement.table.name
+        invalidate_totals(name)
+        # 提交前其他请求可能读到旧的总数并缓存，提交时再失效一次
+        conn.info.setdefault("totals_dirty", set()).add(name)
+    elif isinstance(clauseelement, DropTable):
+        invalidate_totals(clauseelement.element.name)
+
+
+@event.listens_for(Engine, "commit")
+def _invalidate_on_commit(conn):
+    for name in conn.info.pop("totals_dirty", ()):
+        invalidate_totals(name)
+
+
+@event.listens_for(Engine, "rollback")
+def _discard_on_rollback(conn):
+    conn.info.pop("totals_dirty", None)
+
+
+def _estimate_total(q, table_name):
+    """使用数据库统计信息估算表的行数（仅支持 PostgreSQL），无法估算时返回 None
+    """
+    if q.session.get_bind().dialect.name != "postgresql":
+        return None
+    total = q.session.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"),
+        {"name": table_name},
+    ).scalar()
+    # 从未 ANALYZE 过的表 reltuples 为 -1（或 0）
+    if total is None or total <= 0:
+        return None
+    return int(total)
+
+
+def count_total(q, model, mode="exact"):
+    """统计列表总数
+
+    - `exact` : 精确总数（使用缓存）
+    - `approximate` : 不带过滤条件时使用数据库统计信息估算，否则同 `exact`
+    - `none` : 不统计，返回 None
+
+    返回 `(total, is_approximate)`
+    """
+    if mode == "none":
+        return None, False
+
+    ins = inspect(model)
+    table_name = ins.local_table.name
+    if mode == "approximate" and q.whereclause is None:
+        total = _estimate_total(q, table_name)
+        if total is not None:
+            return total, True
+
+    count_q = q.with_entities(func.count(ins.primary_key[0]))
+    stmt = count_q.statement
+    key = (table_name, str(stmt), repr(stmt.compile().params))
+    total = totals.get(key)
+    if total is None:
+        total = count_q.scalar()
+        totals.set(key, total)
+    return total, False
 
 
 def get_list(hdr, q, default_sort_by="id", allow_sort_by=None, model=None):
     # TODO: 单独测试该函数
 
-    ins = inspect(model)
-    pk = ins.primary_key[0]
-    total = q.with_entities(func.count(pk)).scalar()
+    # 指定了 cursor 参数（可以为空，表示第一页）时使用游标分页
+    cursor = hdr.get_argument("cursor", None)
+    if cursor is not None:
+        return get_cursor_list(
+            hdr, q, cursor, default_sort_by, allow_sort_by, model)
+
+    total_mode = hdr.get_argument("total", "exact").lower()
+    if total_mode not in ["exact", "approximate", "none"]:
+        return f"unknown-total:{total_mode}", None, None
+    total, approximate = count_total(q, model, total_mode)
 
     sb = hdr.get_argument("sort_by", default_sort_by).lower()
     if sb not in allow_sort_by and sb != "id":
@@ -24,17 +122,181 @@ def get_list(hdr, q, default_sort_by="id", allow_sort_by=None, model=None):
     start = (current_page - 1) * page_size
     stop = current_page * page_size
 
-    if current_page < 1 or start > total:
+    # 不统计总数时，超出范围的页返回空列表
+    if current_page < 1 or (total is not None and start > total):
         return f"no-such-page:{current_page}", None, None
 
+    _filter = {
+        "page_size": page_size,
+        "page": current_page,
+        "sort_by": sb,
+        "asc": is_asc,
+    }
+    if total is not None:
+        _filter["total"] = total
+    if approximate:
+        _filter["total_approximate"] = True
+
+    return "", q.slice(start, stop), _filter
+
+
+def encode_cursor(data):
+    raw = json.dumps(data, separators=(",", ":")).encode("utf8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    data = json.loads(raw.decode("utf8"))
+    if not isinstance(data, dict):
+        raise ValueError("invalid cursor")
+    return data
+
+
+def _dump_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _load_value(column, value):
+    """游标中的排序值：只能是 JSON 标量，日期时间列为 ISO 格式的字符串
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"invalid value: {value!r}")
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError(f"invalid datetime: {value!r}")
+        for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError(f"invalid datetime: {value}")
+    return value
+
+
+def get_cursor_list(hdr, q, cursor, default_sort_by="id", allow_sort_by=None,
+                    model=None):
+    """游标（keyset）分页
+
+    按 (排序属性, 主键) 排序，游标记录了当前页首/尾记录的这两个值，翻页时使用
+    `WHERE (sort_by, id) > (v, i)` 定位，不使用 OFFSET ，也不统计总数。
+    返回的游标是不透明的字符串，排序方式也编码在游标中。
+    """
+    ins = inspect(model)
+    pk = ins.primary_key[0]
+    page_size = int(hdr.get_argument("page_size", settings.PAGE_SIZE))
+
+    state = None
+    if cursor:
+        try:
+            state = decode_cursor(cursor)
+            sb = state["sort_by"]
+            is_asc = bool(state["asc"])
+            backward = state["direction"] == "prev"
+        except (ValueError, KeyError, TypeError):
+            return "invalid-cursor", None, None
+        if sb not in allow_sort_by and sb != "id":
+            return "invalid-cursor", None, None
+        # 游标只能用于生成它的排序方式
+        requested = hdr.get_argument("sort_by", None)
+        if requested is not None and requested.lower() != sb:
+            return "invalid-cursor", None, None
+    else:
+        sb = hdr.get_argument("sort_by", default_sort_by).lower()
+        if sb not in allow_sort_by and sb != "id":
+            return f"unknown-sort-by:{sb}", None, None
+        is_asc = hdr.get_argument("asc", "false") not in ["false", "0"]
+        backward = False
+
+    column = ins.columns[sb]
+    # 向前翻页时反向扫描，取到结果后再反转
+    scan_asc = is_asc != backward
+    if state:
+        try:
+            value = _load_value(column, state["value"])
+            last_id = state["id"]
+            if isinstance(last_id, bool) or not isinstance(last_id, int):
+                raise ValueError(f"invalid id: {last_id!r}")
+        except (ValueError, KeyError, TypeError):
+            return "invalid-cursor", None, None
+        if scan_asc:
+            q = q.filter(or_(column > value,
+                             and_(column == value, pk > last_id)))
+        else:
+            q = q.filter(or_(column < value,
+                             and_(column == value, pk < last_id)))
+
+    order = asc if scan_asc else desc
+    q = q.order_by(order(column), order(pk))
+    result = q.limit(page_size + 1).all()
+    has_more = len(result) > page_size
+    result = result[:page_size]
+    if backward:
+        result.reverse()
+
+    def make_cursor(obj, direction):
+        return encode_cursor({
+            "sort_by": sb,
+            "asc": is_asc,
+            "direction": direction,
+            "value": _dump_value(getattr(obj, column.key)),
+            "id": getattr(obj, pk.key),
+        })
+
+    # 向后翻页时，后面是否还有数据由 has_more 判断；前面是否有数据取决于是否
+    # 由游标定位而来。向前翻页时相反。
+    has_next = has_more if not backward else True
+    has_prev = state is not None if not backward else has_more
+    next_cursor = prev_cursor = None
+    if result and has_next:
+        next_cursor = make_cursor(result[-1], "next")
+    if result and has_prev:
+        prev_cursor = make_cursor(result[0], "prev")
+
     return (
         "",
-        q.slice(start, stop),
+        result,
         {
             "page_size": page_size,
-            "page": current_page,
-            "total": total,
             "sort_by": sb,
             "asc": is_asc,
+            "next": next_cursor,
+            "prev": prev_cursor,
         },
     )
+
+
+def _after(keys, values):
+    """`(keys) > (values)` ，展开为 OR/AND 以兼容不支持行值比较的数据库
+    """
+    key, value = keys[0], values[0]
+    if len(keys) == 1:
+        return key > value
+    return or_(key > value, and_(key == value, _after(keys[1:], values[1:])))
+
+
+def iter_keyset_pages(conn, query, keys, page_size):
+    """按 `keys` （唯一）排序分页读取 Core 查询的结果，每次产生一页（元组列表）
+
+    每页执行一条 `WHERE (keys) > (上一页最后的值) ORDER BY keys LIMIT page_size` ，
+    直到某页不足 `page_size` 。不依赖服务端游标（pg8000 等驱动会在客户端缓存全部
+    结果），内存占用只与 `page_size` 有关。
+    """
+    width = len(list(query.inner_columns))
+    for i, key in enumerate(keys):
+        query = query.column(key.label(f"keyset_{i}"))
+    query = query.order_by(*keys).limit(page_size)
+
+    last = None
+    while True:
+        q = query if last is None else query.where(_after(keys, last))
+        rows = conn.execute(q).fetchall()
+        if rows:
+            yield [tuple(row)[:width] for row in rows]
+        if len(rows) < page_size:
+            break
+        last = tuple(rows[-1])[width:]
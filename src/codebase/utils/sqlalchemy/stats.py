@@ -0,0 +1,70 @@
+"""SQL 查询统计
+
+`QueryStats` 记录查询次数与数据库耗时（游标执行的时间，不含获取连接的等待）。
+当前的统计对象保存在 contextvar 中：每个请求在自己的 asyncio Task 中处理，上下文
+互不影响；`dbc.run_in_executor` 在线程池中执行时复制调用方的上下文，因此 IOLoop
+线程与数据库线程中的查询都计入发起它们的请求。没有统计对象时事件回调直接返回。
+"""
+
+import contextlib
+import contextvars
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+current_stats = contextvars.ContextVar("query_stats", default=None)
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def record(self, seconds):
+        # 同一请求的数据库操作依次执行（await），不需要加锁
+        self.count += 1
+        self.seconds += seconds
+
+
+def start_tracking():
+    """在当前上下文中开始统计，返回统计对象
+    """
+    stats = QueryStats()
+    current_stats.set(stats)
+    return stats
+
+
+@contextlib.contextmanager
+def track_queries():
+    """统计 with 块内（当前上下文中）的查询
+    """
+    token = current_stats.set(QueryStats())
+    try:
+        yield current_stats.get()
+    finally:
+        current_stats.reset(token)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, *_args):
+    if current_stats.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, *_args):
+    stats = current_stats.get()
+    if stats is not None:
+        starts = conn.info.get("query_start")
+        if starts:
+            stats.record(time.perf_counter() - starts.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # 出错的查询也计入
+    if context.connection is not None and context.cursor is not None:
+        _after_cursor_execute(context.connection)
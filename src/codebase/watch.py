@@ -0,0 +1,104 @@
+"""等待全局修订号变化（`/watch` 长轮询）
+
+每个进程维护一个 `RevisionWatcher` ：等待中的请求只是 IOLoop 上的一个 Future ，
+不占用线程与数据库连接。修订号的来源：
+
+- 本进程提交的变更：通过 `on_changes_committed` 立即刷新
+- 其他进程（worker）提交的变更：有请求等待时每 `WATCH_POLL_INTERVAL` 秒读取
+  一次修订号（单行查询）
+
+修订号增加时唤醒所有等待的请求，由它们各自读取变更日志。
+"""
+
+import asyncio
+import logging
+
+from eva.conf import settings
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+from codebase.models import current_revision, on_changes_committed
+from codebase.utils.sqlalchemy import dbc
+
+
+def _read_revision():
+    return current_revision(dbc.session())
+
+
+class RevisionWatcher:
+
+    def __init__(self):
+        self.revision = None
+        self.waiters = 0
+        self.io_loop = None
+        self._condition = Condition()
+        self._refreshing = False
+        self._stale = False
+        self._polling = False
+
+    def _bind(self):
+        # 测试中每个用例使用新的 IOLoop ，与 IOLoop 相关的状态随之重建
+        io_loop = IOLoop.current()
+        if io_loop is not self.io_loop:
+            self.io_loop = io_loop
+            self.revision = None
+            self._condition = Condition()
+            self._refreshing = self._stale = self._polling = False
+
+    def notify_changed(self, _changes=None):
+        """变更已提交（可以在任意线程中调用）
+        """
+        if self.io_loop is not None and self.waiters:
+            self.io_loop.add_callback(self.refresh)
+
+    async def refresh(self):
+        """读取修订号，增加时唤醒等待者；并发调用合并为一次查询
+        """
+        if self._refreshing:
+            self._stale = True
+            return
+        self._refreshing = True
+        try:
+            while True:
+                self._stale = False
+                revision = await dbc.run_in_executor(_read_revision)
+                if self.revision is None or revision > self.revision:
+                    self.revision = revision
+                    self._condition.notify_all()
+                if not self._stale:
+                    break
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("refresh revision failed")
+        finally:
+            self._refreshing = False
+
+    async def _poll(self):
+        io_loop = self.io_loop
+        try:
+            while self.waiters and io_loop is self.io_loop:
+                await self.refresh()
+                await asyncio.sleep(float(settings.WATCH_POLL_INTERVAL))
+        finally:
+            if io_loop is self.io_loop:
+                self._polling = False
+
+    async def wait(self, since, timeout):
+        """等待修订号大于 `since` ，返回是否等到（超时返回 False）
+        """
+        self._bind()
+        deadline = self.io_loop.time() + timeout
+        self.waiters += 1
+        try:
+            if not self._polling:
+                self._polling = True
+                self.io_loop.spawn_callback(self._poll)
+            while self.revision is None or self.revision <= since:
+                if not await self._condition.wait(deadline):
+                    return False
+            return True
+        finally:
+            self.waiters -= 1
+
+
+watcher = RevisionWatcher()
+on_changes_committed(watcher.notify_changed)
@@ -1,9 +1,11 @@
 # pylint: disable=W0223,W0221,C0103
 
 import functools
+import hashlib
 import json
 import logging
 import pprint
+import uuid
 
 from eva.conf import settings
 
@@ -12,7 +14,38 @@ from tornado.web import HTTPError
 from tornado.escape import json_decode
 from tornado.log import app_log, gen_log
 
-from codebase.models import User
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from codebase.models import User, current_revision, on_changes_committed
+from codebase.utils.cache import TTLCache
+from codebase.utils.metrics import REGISTRY
+from codebase.utils.sqlalchemy import dbc
+from codebase.utils.sqlalchemy.stats import start_tracking
+
+
+# 用户 uuid -> 用户 id ，用户 id 不会变化，只缓存已存在的用户
+user_ids = TTLCache(maxsize=int(settings.USER_CACHE_SIZE))
+REGISTRY.cache("user_ids", lambda: (user_ids.hits, user_ids.misses,
+                                    len(user_ids)))
+
+requests_total = REGISTRY.counter(
+    "authz_http_requests_total", "HTTP requests.",
+    ("handler", "method", "code"))
+request_seconds = REGISTRY.histogram(
+    "authz_http_request_duration_seconds", "HTTP request latency.",
+    ("handler", "method"))
+
+
+@on_changes_committed
+def update_user_ids(changes):
+    for change in changes:
+        if change.kind != "user":
+            continue
+        if change.op == "add":
+            user_ids.set(change.uuid, change.id)
+        else:
+            user_ids.delete(change.uuid)
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -34,15 +67,37 @@ else:
 
 
 class APIRequestHandler(MainBaseHandler):
+
+    # 本次请求的 SQL 查询统计（`codebase.utils.sqlalchemy.stats`）
+    query_stats = None
+
+    def prepare(self):
+        self.query_stats = start_tracking()
+
     def get_current_user(self):
         uid = self.request.headers.get("X-User-Id")
         if not uid:
             raise HTTPError(403, reason="no-x-user-id")
-        user = self.db.query(User).filter_by(uuid=uid).first()
-        if not user:
-            user = User(uuid=uid)
+        try:
+            uid = uuid.UUID(uid)
+        except ValueError:
+            raise HTTPError(403, reason="invalid-x-user-id")
+
+        user_id = user_ids.get(uid)
+        if user_id is None:
+            user_id = self.db.query(User.id).filter_by(uuid=uid).scalar()
+            if user_id is None:
+                # 未记录过的用户没有任何角色，返回临时对象，不写数据库
+                return User(uuid=uid)
+            user_ids.set(uid, user_id)
+
+        # 由缓存的主键直接构造持久化对象，不需要查询 authz_user ，
+        # 访问 roles 时再按 user_id 加载
+        user = self.db.identity_map.get(identity_key(User, user_id))
+        if user is None:
+            user = User(id=user_id, uuid=uid)
+            make_transient_to_detached(user)
             self.db.add(user)
-            self.db.commit()
         return user
 
     def fail(self, error="fail", errors=None, status=400, **kwargs):
@@ -73,8 +128,38 @@ class APIRequestHandler(MainBaseHandler):
     def db(self):
         return self.application.db_session()
 
+    def finish(self, chunk=None):
+        stats = self.query_stats
+        # pylint: disable=protected-access
+        if stats is not None and settings.DEBUG == "true" and \
+                not self._headers_written:
+            self.set_header("X-Query-Count", stats.count)
+            self.set_header("X-Query-Time", f"{stats.seconds * 1000:.3f}")
+        return super().finish(chunk)
+
     def on_finish(self):
         self.application.db_session.remove()
+        self.log_slow_request()
+        handler = type(self).__name__
+        method = self.request.method
+        requests_total.inc((handler, method, str(self.get_status())))
+        request_seconds.observe((handler, method), self.request.request_time())
+
+    def log_slow_request(self):
+        """查询次数或数据库耗时超过 `SLOW_REQUEST_QUERIES` /
+        `SLOW_REQUEST_DB_TIME` 时记录日志
+        """
+        stats = self.query_stats
+        if stats is None:
+            return
+        max_queries = int(settings.SLOW_REQUEST_QUERIES)
+        max_seconds = float(settings.SLOW_REQUEST_DB_TIME)
+        if (max_queries and stats.count > max_queries) or \
+                (max_seconds and stats.seconds > max_seconds):
+            gen_log.warning(
+                "slow request %d %s: %d queries, db %.1fms, total %.1fms",
+                self.get_status(), self._request_summary(), stats.count,
+                stats.seconds * 1000, self.request.request_time() * 1000)
 
     def write_error(self, status_code, **kwargs):
         """定制出错返回
@@ -148,3 +233,54 @@ def authenticated(method):
         return method(self, *args, **kwargs)
 
     return wrapper
+
+
+def admin_required(method):
+    """需要超级管理员角色（`settings.ADMIN_ROLE_NAME` ，直接拥有或继承）
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        user = self.current_user
+        if user.id is None or not User.is_admin(self.db, user.id):
+            raise HTTPError(403, reason="need-admin")
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def revision_etag(method):
+    """按全局修订号生成 ETag ，未变化时返回 304 ，不执行 `method`
+
+    ETag 由修订号与请求（URI、X-User-Id）生成，检查只需要读取修订号一行，不查询
+    也不序列化数据。修订号在查询数据之前读取：期间提交的变更会使数据比 ETag 新，
+    客户端下次请求时 ETag 不匹配，重新获取，不会缓存过期的数据。
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        revision = current_revision(self.db)
+        key = "{} {}".format(
+            self.request.uri, self.request.headers.get("X-User-Id", ""))
+        digest = hashlib.md5(key.encode("utf8")).hexdigest()[:16]
+        self.set_header("Etag", f'"{revision}-{digest}"')
+        if self.check_etag_header():
+            self.set_status(304)
+            return None
+
+        result = method(self, *args, **kwargs)
+        if self.get_status() != 200:
+            self.clear_header("Etag")
+        return result
+
+    return wrapper
+
+
+def run_on_db_executor(method):
+    """在数据库线程池中执行 handler 方法，查询期间 IOLoop 可以继续处理其他请求
+
+    方法内通过 `self.db` 获得的是工作线程的 session ，执行结束后自动清理。
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return dbc.run_in_executor(method, self, *args, **kwargs)
+
+    return wrapper
@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import sys
 import time
 import signal
 import logging
@@ -7,9 +8,14 @@ from functools import partial
 from importlib import import_module
 
 import tornado.options
+import tornado.process
 from eva.conf import settings
 
 from codebase.app import make_app
+from codebase.graph import graph
+from codebase.retention import ChangeLogPruner
+from codebase.sync import OutboxDrainer
+from codebase.utils.process import fork_workers, worker_id
 from codebase.utils.sqlalchemy import dbc
 
 MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 0
@@ -18,7 +24,7 @@ MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 0
 # how to shutdown tornado web server gracefully, ref:
 # - https://gist.github.com/wonderbeyond/d38cd85243befe863cdde54b84505784
 # - https://gist.github.com/mywaiting/4643396
-def sig_handler(server, sig, _):
+def sig_handler(server, tasks, sig, _):
     io_loop = tornado.ioloop.IOLoop.instance()
 
     def stop_loop(deadline):
@@ -34,6 +40,8 @@ def sig_handler(server, sig, _):
     def shutdown():
         logging.info('Stopping http server')
         server.stop()
+        for task in tasks:
+            task.stop()
         logging.info('Will shutdown in %s seconds ...',
                      MAX_WAIT_SECONDS_BEFORE_SHUTDOWN)
         stop_loop(time.time() + MAX_WAIT_SECONDS_BEFORE_SHUTDOWN)
@@ -51,22 +59,59 @@ def main():
         import_module(settings.MODELS_MODULE)
         dbc.create_all()
 
-    # 启动 Tornado
-    app = make_app()
-    server = tornado.httpserver.HTTPServer(app, xheaders=True)
-
     # 设置 options
     tornado.options.define("port", default=3000, help="listen port", type=int)
-    if app.settings["debug"]:
+    tornado.options.define(
+        "workers", default=int(settings.WORKERS), type=int,
+        help="number of worker processes, 0 means one per CPU core")
+    if settings.DEBUG == "true":
         tornado.options.options.logging = "debug"
     tornado.options.parse_command_line()
 
     port = tornado.options.options.port
     sockets = tornado.netutil.bind_sockets(port)
 
+    # 多进程模式：所有 worker 共享监听端口
+    workers = tornado.options.options.workers
+    if workers <= 0:
+        workers = tornado.process.cpu_count()
+    if workers > 1:
+        # 内存鉴权图只应用本进程提交的变更，其他 worker 的修改（如撤销权限）
+        # 不可见，会做出过期的鉴权决定，因此不允许多进程运行
+        if settings.AUTHZ_ENGINE == "memory":
+            logging.error("AUTHZ_ENGINE=memory can not run with %d workers, "
+                          "use WORKERS=1 or AUTHZ_ENGINE=sql", workers)
+            sys.exit(1)
+        # 不能共享父进程创建的数据库连接：fork 之前在父进程中关闭连接池
+        dbc.engine.dispose()
+        fork_workers(workers, int(settings.WORKER_MAX_RESTARTS))
+
+    # 加载内存鉴权图
+    if settings.AUTHZ_ENGINE == "memory":
+        graph.load()
+
+    # 启动 Tornado
+    app = make_app()
+    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+
+    # 后台任务，退出时停止
+    tasks = []
+
     # 监听信号，优雅退出
-    signal.signal(signal.SIGTERM, partial(sig_handler, server))
-    signal.signal(signal.SIGINT, partial(sig_handler, server))
+    signal.signal(signal.SIGTERM, partial(sig_handler, server, tasks))
+    signal.signal(signal.SIGINT, partial(sig_handler, server, tasks))
+
+    # etcd 同步任务只在一个 worker 中运行，同步状态（延迟、积压、失败次数）
+    # 通过 `/_metrics` 输出
+    if settings.SYCN_ETCD == "true" and worker_id() in (None, 0):
+        tasks.append(OutboxDrainer())
+
+    # 变更日志清理任务同样只在一个 worker 中运行
+    if int(settings.CHANGES_RETENTION) > 0 and worker_id() in (None, 0):
+        tasks.append(ChangeLogPruner())
+
+    for task in tasks:
+        task.start()
 
     server.add_sockets(sockets)
     logging.info("api server is running at %d", port)
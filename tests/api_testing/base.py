@@ -1,11 +1,16 @@
 # pylint: disable=R0903
 
+import contextlib
+import functools
 import json
+import threading
+import time
 import uuid
 import logging
 
 import tornado.testing
 from eva.conf import settings
+from sqlalchemy import event
 
 from codebase.utils.sqlalchemy import dbc
 from codebase.utils.swaggerui import api
@@ -48,6 +53,68 @@ def get_body_json(resp):
     return scrub(json.loads(resp.body))
 
 
+def parse_metrics(text):
+    """解析文本格式的指标（`/_metrics`），返回 `{样本名（含标签）: 值}`
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class QueryRecorder:
+    """记录期间 engine 执行的所有 SQL 与数据库耗时
+
+    通过 engine 事件记录，包括数据库线程池中执行的查询（测试中没有其他并发请求）。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before(self, conn, _cursor, _statement, *_args):
+        conn.info.setdefault("recorder_start", []).append(time.perf_counter())
+
+    def _after(self, conn, _cursor, statement, *_args):
+        seconds = time.perf_counter() - conn.info["recorder_start"].pop()
+        with self._lock:
+            self.statements.append(" ".join(statement.split()))
+            self.seconds += seconds
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        event.listen(self.engine, "after_cursor_execute", self._after)
+        return self
+
+    def __exit__(self, *_exc):
+        event.remove(self.engine, "before_cursor_execute", self._before)
+        event.remove(self.engine, "after_cursor_execute", self._after)
+
+    def report(self):
+        return "\n".join(f"  {i + 1}. {s}" for i, s in enumerate(self.statements))
+
+
+def query_budget(count, seconds=None):
+    """测试方法的查询预算：整个测试的查询不超过 `count` 次（数据库耗时不超过
+    `seconds` 秒）
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.assertMaxQueries(count, seconds):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class BaseTestCase(tornado.testing.AsyncHTTPTestCase):
 
     main_title = None
@@ -125,6 +192,27 @@ class BaseTestCase(tornado.testing.AsyncHTTPTestCase):
     def api_delete(self, url, headers=None, **kwargs):
         return self._api_request("DELETE", url, headers=headers, **kwargs)
 
+    @contextlib.contextmanager
+    def assertMaxQueries(self, count, seconds=None):
+        """with 块内（如一个请求）的查询不超过 `count` 次，数据库耗时不超过
+        `seconds` 秒，超过时列出执行的 SQL
+        """
+        with QueryRecorder(dbc.engine) as recorder:
+            yield recorder
+        if recorder.count > count:
+            self.fail(f"{recorder.count} queries executed, expected at most "
+                      f"{count}:\n{recorder.report()}")
+        if seconds is not None and recorder.seconds > seconds:
+            self.fail(f"database time {recorder.seconds:.3f}s, expected at most "
+                      f"{seconds}s:\n{recorder.report()}")
+
+    def count_queries(self, func, *args, **kwargs):
+        """执行 `func` ，返回 `(查询次数, func 的返回值)`
+        """
+        with QueryRecorder(dbc.engine) as recorder:
+            result = func(*args, **kwargs)
+        return recorder.count, result
+
     def validate_default_success(self, body):
         self.assertEqual(body["status"], "success")
 
@@ -0,0 +1,84 @@
+"""进程内的 etcd v3 gRPC-JSON 网关模拟，仅实现 `kv/txn` 与 `kv/range`
+"""
+
+import base64
+import json
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+
+def _decode(value):
+    return base64.b64decode(value).decode("utf8")
+
+
+def _encode(value):
+    return base64.b64encode(value.encode("utf8")).decode("ascii")
+
+
+class _Handler(tornado.web.RequestHandler):
+
+    def initialize(self, etcd):
+        self.etcd = etcd
+
+    def post(self, method):
+        if self.etcd.failing:
+            self.set_status(503)
+            return
+        body = json.loads(self.request.body)
+        self.etcd.requests.append((method, body))
+        if method == "txn":
+            responses = []
+            for op in body.get("success", []):
+                if "request_put" in op:
+                    put = op["request_put"]
+                    self.etcd.store[_decode(put["key"])] = _decode(put["value"])
+                    responses.append({"response_put": {}})
+                elif "request_range" in op:
+                    responses.append(
+                        {"response_range": self.range(op["request_range"])})
+                else:
+                    key = _decode(op["request_delete_range"]["key"])
+                    self.etcd.store.pop(key, None)
+                    responses.append({"response_delete_range": {}})
+            self.write({"succeeded": True, "responses": responses})
+        elif method == "range":
+            self.write(self.range(body))
+        else:
+            self.set_status(404)
+
+    def range(self, body):
+        key = _decode(body["key"])
+        end = _decode(body["range_end"]) if "range_end" in body else None
+        kvs = [{"key": _encode(k), "value": _encode(v)}
+               for k, v in sorted(self.etcd.store.items())
+               if k == key or (end is not None and key <= k < end)]
+        limit = body.get("limit", 0)
+        result = {"count": len(kvs)}
+        if limit and len(kvs) > limit:
+            kvs = kvs[:limit]
+            result["more"] = True
+        result["kvs"] = kvs
+        return result
+
+
+class FakeEtcd:
+    """在当前 IOLoop 中启动，`endpoint` 为监听地址
+
+    `store` 为当前数据，`requests` 记录收到的请求，`failing` 为真时返回 503 。
+    """
+
+    def __init__(self):
+        self.store = {}
+        self.requests = []
+        self.failing = False
+        app = tornado.web.Application([
+            (r"/v3/kv/(\w+)", _Handler, {"etcd": self})])
+        sock, port = bind_unused_port()
+        self.server = HTTPServer(app)
+        self.server.add_sockets([sock])
+        self.endpoint = f"127.0.0.1:{port}"
+
+    def stop(self):
+        self.server.stop()
@@ -10,6 +10,7 @@ from codebase.models import (
     Role
 )
 from codebase.utils.swaggerui import api
+from codebase.graph import graph
 
 from .base import (
     BaseTestCase,
@@ -23,9 +24,12 @@ from .base import (
 class _Base(BaseTestCase):
 
     rs = api.spec.resources["authz"]
+    engine = "orm"
 
     def setUp(self):
         super().setUp()
+        self.default_engine = settings.AUTHZ_ENGINE
+        settings.AUTHZ_ENGINE = self.engine
 
         user = User(uuid=str(uuid.uuid4()))
         self.db.add(user)
@@ -42,6 +46,11 @@ class _Base(BaseTestCase):
         self.user = user
         self.permission = perm
 
+    def tearDown(self):
+        settings.AUTHZ_ENGINE = self.default_engine
+        graph.reset()
+        super().tearDown()
+
     def shortDescription(self):
         class_doc = self.__doc__
         doc = self._testMethodDoc
@@ -67,7 +76,7 @@ class _Base(BaseTestCase):
         self.assertEqual(body["status"], status)
 
 
-def has_permission_class_factory(name, method):
+def has_permission_class_factory(name, method, engine="orm"):
 
     class _BaseHasPermission(_Base):
 
@@ -111,6 +120,84 @@ def has_permission_class_factory(name, method):
             self.validate_response_200(
                 str(self.user.uuid), perm.name, "no")
 
+        def test_changed(self):
+            """授权关系变化后结果随之变化
+            """
+            perm = Permission(name="new-permission")
+            self.db.add(perm)
+            self.db.commit()
+            self.validate_response_200(
+                str(self.user.uuid), perm.name, "no")
+
+            role = self.db.query(Role).filter_by(name="test-role").one()
+            role.permissions.append(perm)
+            self.db.commit()
+            self.validate_response_200(
+                str(self.user.uuid), perm.name, "yes")
+
+            role = self.db.query(Role).filter_by(name="test-role").one()
+            perm = self.db.query(Permission).filter_by(
+                name="new-permission").one()
+            role.permissions.remove(perm)
+            self.db.commit()
+            self.validate_response_200(
+                str(self.user.uuid), perm.name, "no")
+
+        def test_inherited(self):
+            """通过角色继承获得权限
+            """
+            user_id = str(self.user.uuid)
+            grandparent = Role(name="grandparent-role")
+            grandparent.permissions.append(Permission(name="inherited"))
+            parent = Role(name="parent-role")
+            self.db.add_all([grandparent, parent])
+            self.db.commit()
+            self.validate_response_200(user_id, "inherited", "no")
+
+            role = self.db.query(Role).filter_by(name="test-role").one()
+            parent = self.db.query(Role).filter_by(name="parent-role").one()
+            grandparent = self.db.query(Role).filter_by(
+                name="grandparent-role").one()
+            role.add_parent(self.db, parent)
+            parent.add_parent(self.db, grandparent)
+            self.db.commit()
+            self.validate_response_200(user_id, "inherited", "yes")
+
+            # 继承超级管理员角色
+            admin = self.db.query(Role).filter_by(
+                name=settings.ADMIN_ROLE_NAME).one()
+            grandparent = self.db.query(Role).filter_by(
+                name="grandparent-role").one()
+            grandparent.add_parent(self.db, admin)
+            self.db.add(Permission(name="new-permission"))
+            self.db.commit()
+            self.validate_response_200(user_id, "new-permission", "yes")
+
+            parent = self.db.query(Role).filter_by(name="parent-role").one()
+            grandparent = self.db.query(Role).filter_by(
+                name="grandparent-role").one()
+            parent.remove_parent(self.db, grandparent)
+            self.db.commit()
+            self.validate_response_200(user_id, "inherited", "no")
+            self.validate_response_200(user_id, "new-permission", "no")
+
+        def test_permission_deleted(self):
+            """删除已授权的权限后，新建的权限不会继承原有授权
+            """
+            user_id = str(self.user.uuid)
+            self.validate_response_200(user_id, "test-permission", "yes")
+
+            perm = self.db.query(Permission).filter_by(
+                name="test-permission").one()
+            self.db.delete(perm)
+            self.db.commit()
+            self.validate_response_400(
+                user_id, "test-permission", "invalid-permission")
+
+            self.db.add(Permission(name="new-permission"))
+            self.db.commit()
+            self.validate_response_200(user_id, "new-permission", "no")
+
         def test_user_notexist(self):
             """指定的用户ID不存在
             """
@@ -132,7 +219,8 @@ def has_permission_class_factory(name, method):
     def __init__(self, *args, **kwargs):
         _BaseHasPermission.__init__(self, *args, **kwargs)
         setattr(_BaseHasPermission, "method", method)
-    newclass = type(name, (_BaseHasPermission,), {"__init__": __init__})
+    newclass = type(name, (_BaseHasPermission,), {
+        "__init__": __init__, "engine": engine})
     newclass.__doc__ = "/has_permission - 鉴权（使用权限名称）"
     return newclass
 
@@ -141,9 +229,13 @@ HasPermissionGetTestCase = has_permission_class_factory(
     "HasPermissionGetTestCase", "GET")
 HasPermissionPostTestCase = has_permission_class_factory(
     "HasPermissionPostTestCase", "POST")
+HasPermissionSQLTestCase = has_permission_class_factory(
+    "HasPermissionSQLTestCase", "GET", engine="sql")
+HasPermissionMemoryTestCase = has_permission_class_factory(
+    "HasPermissionMemoryTestCase", "GET", engine="memory")
 
 
-def has_permission_id_class_factory(name, method):
+def has_permission_id_class_factory(name, method, engine="orm"):
 
     class _BaseHasPermission(_Base):
 
@@ -207,7 +299,8 @@ def has_permission_id_class_factory(name, method):
     def __init__(self, *args, **kwargs):
         _BaseHasPermission.__init__(self, *args, **kwargs)
         setattr(_BaseHasPermission, "method", method)
-    newclass = type(name, (_BaseHasPermission,), {"__init__": __init__})
+    newclass = type(name, (_BaseHasPermission,), {
+        "__init__": __init__, "engine": engine})
     newclass.__doc__ = "/has_permission_id - 鉴权（使用权限ID）"
     return newclass
 
@@ -216,3 +309,222 @@ HasPermissionIDGetTestCase = has_permission_id_class_factory(
     "HasPermissionIDGetTestCase", "GET")
 HasPermissionIDPostTestCase = has_permission_id_class_factory(
     "HasPermissionIDPostTestCase", "POST")
+HasPermissionIDSQLTestCase = has_permission_id_class_factory(
+    "HasPermissionIDSQLTestCase", "GET", engine="sql")
+HasPermissionIDMemoryTestCase = has_permission_id_class_factory(
+    "HasPermissionIDMemoryTestCase", "GET", engine="memory")
+
+
+class UserHasPermissionTestCase(_Base):
+    """User.has_permission - ORM 方式鉴权
+    """
+
+    def test_query_count(self):
+        """查询次数与用户的角色数无关
+        """
+        def count(name):
+            user = self.db.query(User).filter_by(id=self.user.id).one()
+            perm = self.db.query(Permission).filter_by(name=name).one()
+            n, granted = self.count_queries(user.has_permission, perm)
+            self.db.expire_all()
+            return n, granted
+
+        parent = Role(name="parent-role",
+                      permissions=[Permission(name="inherited")])
+        # 没有授权给任何角色的权限需要检查所有角色，是查询最多的情况
+        self.db.add_all([parent, Permission(name="nobody")])
+        self.db.commit()
+        role = self.db.query(Role).filter_by(name="test-role").one()
+        role.add_parent(self.db, parent)
+        self.db.commit()
+        self.assertTrue(count("inherited")[1])
+        few, granted = count("nobody")
+        self.assertFalse(granted)
+
+        user = self.db.query(User).filter_by(id=self.user.id).one()
+        for i in range(5):
+            role = Role(name=f"role-{i}",
+                        permissions=[Permission(name=f"perm-{i}")])
+            role_parent = Role(name=f"parent-{i}")
+            self.db.add_all([role, role_parent])
+            self.db.flush()
+            role.add_parent(self.db, role_parent)
+            user.roles.append(role)
+        self.db.commit()
+        self.assertTrue(count("perm-4")[1])
+        many, granted = count("nobody")
+        self.assertFalse(granted)
+        self.assertEqual(many, few)
+
+
+class HasPermissionBatchTestCase(_Base):
+    """/has_permission/batch - 批量鉴权
+    """
+
+    method = "POST"
+
+    def test_success(self):
+        """混合使用权限名称和权限ID
+        """
+        perm = Permission(name="new-permission")
+        self.db.add(perm)
+        self.db.commit()
+
+        user_id = str(self.user.uuid)
+        notexist = str(uuid.uuid4())
+        checks = [
+            {"user_id": user_id, "permission_name": "test-permission"},
+            {"user_id": user_id, "permission_id": str(self.permission.uuid)},
+            {"user_id": user_id, "permission_name": "new-permission"},
+            {"user_id": user_id, "permission_id": str(perm.uuid)},
+            {"user_id": notexist, "permission_name": "test-permission"},
+            {"user_id": user_id, "permission_name": "notexist"},
+            {"user_id": user_id, "permission_id": notexist},
+        ]
+        resp = self.api_post("/has_permission/batch", body={"checks": checks})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.validate_default_success(body)
+
+        spec = self.rs.post_has_permission_batch.op_spec[
+            "responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+
+        self.assertEqual(
+            [item["status"] for item in body["data"]],
+            ["yes", "yes", "no", "no",
+             "invalid-user", "invalid-permission", "invalid-permission"])
+
+    def test_admin_yes(self):
+        """超级用户拥有所有权限
+        """
+        perm = Permission(name="new-permission")
+        self.db.add(perm)
+        role = self.db.query(Role).filter_by(
+            name=settings.ADMIN_ROLE_NAME).first()
+        self.user.roles.append(role)
+        self.db.commit()
+
+        resp = self.api_post("/has_permission/batch", body={"checks": [
+            {"user_id": str(self.user.uuid), "permission_name": perm.name},
+        ]})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(body["data"][0]["status"], "yes")
+
+    def test_inherited(self):
+        """通过角色继承获得权限，继承超级管理员角色拥有所有权限
+        """
+        user_id = str(self.user.uuid)
+        other = User(uuid=str(uuid.uuid4()))
+        other_role = Role(name="other-role")
+        other.roles.append(other_role)
+        parent = Role(name="parent-role")
+        parent.permissions.append(Permission(name="inherited"))
+        self.db.add_all([other, parent])
+        self.db.commit()
+        other_id = str(other.uuid)
+
+        role = self.db.query(Role).filter_by(name="test-role").one()
+        role.add_parent(self.db, parent)
+        admin = self.db.query(Role).filter_by(
+            name=settings.ADMIN_ROLE_NAME).one()
+        other_role.add_parent(self.db, admin)
+        self.db.commit()
+
+        resp = self.api_post("/has_permission/batch", body={"checks": [
+            {"user_id": user_id, "permission_name": "inherited"},
+            {"user_id": other_id, "permission_name": "test-permission"},
+            {"user_id": user_id, "permission_name": "admin"},
+        ]})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual([item["status"] for item in body["data"]],
+                         ["yes", "yes", "no"])
+
+    def test_invalid_checks(self):
+        """检查项格式错误
+        """
+        for checks in [None, [{"user_id": str(self.user.uuid)}]]:
+            resp = self.api_post(
+                "/has_permission/batch", body={"checks": checks})
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            self.assertEqual(body["status"], "invalid-checks")
+
+    def test_invalid_field(self):
+        """字段不是字符串的检查项返回 invalid-user / invalid-permission
+        """
+        user_id = str(self.user.uuid)
+        checks = [
+            {"user_id": [user_id], "permission_name": "test-permission"},
+            {"user_id": {"id": user_id}, "permission_id": "x"},
+            {"user_id": user_id, "permission_name": ["test-permission"]},
+            {"user_id": user_id, "permission_id": {"id": "x"}},
+            {"user_id": user_id, "permission_name": 1},
+            {"user_id": user_id, "permission_name": "test-permission"},
+        ]
+        resp = self.api_post("/has_permission/batch", body={"checks": checks})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(
+            [item["status"] for item in body["data"]],
+            ["invalid-user", "invalid-user", "invalid-permission",
+             "invalid-permission", "invalid-permission", "yes"])
+
+    def test_too_many_checks(self):
+        """检查项超过限制
+        """
+        item = {"user_id": str(self.user.uuid),
+                "permission_name": "test-permission"}
+        limit = int(settings.HAS_PERMISSION_BATCH_LIMIT)
+        resp = self.api_post(
+            "/has_permission/batch", body={"checks": [item] * (limit + 1)})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(body["status"], "too-many-checks")
+
+
+class HasPermissionBatchMemoryTestCase(HasPermissionBatchTestCase):
+    """/has_permission/batch - 批量鉴权（内存引擎）
+    """
+
+    engine = "memory"
+
+
+class GraphLoadTestCase(_Base):
+    """内存鉴权图按键分页加载
+    """
+
+    engine = "memory"
+    main_title = True
+
+    def test_paged_load(self):
+        """每页记录数小于数据量时加载完整的关系
+        """
+        roles = [Role(name=f"load-role-{i}") for i in range(5)]
+        perms = [Permission(name=f"load-perm-{i}") for i in range(5)]
+        users = [User(uuid=str(uuid.uuid4())) for _ in range(5)]
+        for i, user in enumerate(users):
+            user.roles = roles[:i + 1]
+            roles[i].permissions = perms[i:i + 1]
+        self.db.add_all(users)
+        self.db.commit()
+        roles[4].add_parent(self.db, roles[0])
+        self.db.commit()
+        expect = {(str(u.uuid), p.name): j <= i
+                  for i, u in enumerate(users) for j, p in enumerate(perms)}
+
+        chunk_size = settings.BULK_CHUNK_SIZE
+        settings.BULK_CHUNK_SIZE = "2"
+        try:
+            graph.load()
+        finally:
+            settings.BULK_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(len(graph.users), self.db.query(User).count())
+        self.assertEqual(graph.role_parents[roles[4].id], {roles[0].id})
+        for (user_id, name), granted in expect.items():
+            self.assertEqual(graph.has_permission(
+                graph.get_user_id(user_id),
+                graph.get_permission_id_by_name(name)), granted)
@@ -0,0 +1,264 @@
+import asyncio
+import json
+import uuid
+from unittest import mock
+
+from eva.conf import settings
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from tornado.tcpclient import TCPClient
+from tornado.testing import gen_test
+
+from codebase.bulk import Importer
+
+from codebase.models import (
+    User,
+    Permission,
+    Role,
+    _ROLE_PERMISSIONS,
+)
+from codebase.utils.sqlalchemy import dbc
+from codebase.utils.sqlalchemy.page import iter_keyset_pages
+from codebase.utils.swaggerui import api
+
+from .base import (
+    BaseTestCase,
+    validate_default_error,
+    get_body_json
+)
+
+
+def ndjson(records):
+    return "".join(json.dumps(r) + "\n" for r in records)
+
+
+class _Base(BaseTestCase):
+
+    rs = api.spec.resources["bulk"]
+
+    def bulk_import(self, data, **kwargs):
+        url = "/bulk/import"
+        if kwargs:
+            url += "?" + "&".join(f"{k}={v}" for k, v in kwargs.items())
+        return self.fetch(
+            url, method="POST", body=data,
+            headers={"Content-Type": "application/x-ndjson"},
+            raise_error=False)
+
+
+class BulkImportTestCase(_Base):
+    """POST /bulk/import - 批量导入
+    """
+
+    def test_success(self):
+        """导入角色、权限及关联关系，重复导入不产生重复数据
+        """
+        user_ids = [str(uuid.uuid4()) for _ in range(5)]
+        records = [
+            {"type": "permission", "name": "perm0", "summary": "s0"},
+            {"type": "role", "name": "role0", "description": "d0"},
+        ]
+        for i in range(10):
+            records.append({"type": "role_permission",
+                            "role": f"role{i % 3}",
+                            "permission": f"perm{i}"})
+        for i, user_id in enumerate(user_ids):
+            records.append({"type": "user_role",
+                            "user": user_id, "role": f"role{i % 2}"})
+
+        perm_total = self.db.query(Permission).count()
+        role_total = self.db.query(Role).count()
+        for _ in range(2):
+            # chunk_size 较小，导入分多个事务完成
+            resp = self.bulk_import(ndjson(records), chunk_size=3)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 200)
+
+            spec = self.rs.post_bulk_import.op_spec["responses"]["200"]["schema"]
+            api.validate_object(spec, body)
+            self.assertEqual(body["data"]["lines"], len(records))
+
+        self.assertEqual(self.db.query(Permission).count(), perm_total + 10)
+        # role0 为新建，role1 / role2 由关联关系自动创建
+        self.assertEqual(self.db.query(Role).count(), role_total + 3)
+        self.assertEqual(self.db.query(User).count(), len(user_ids) + 1)
+
+        perm = self.db.query(Permission).filter_by(name="perm0").one()
+        self.assertEqual(perm.summary, "s0")
+        role = self.db.query(Role).filter_by(name="role0").one()
+        self.assertEqual(role.description, "d0")
+        self.assertEqual(sorted(p.name for p in role.permissions),
+                         ["perm0", "perm3", "perm6", "perm9"])
+
+        user = self.db.query(User).filter_by(uuid=user_ids[1]).one()
+        self.assertEqual([r.name for r in user.roles], ["role1"])
+
+    def test_role_parent(self):
+        """导入角色继承关系，形成环时报错
+        """
+        records = [
+            {"type": "role_parent", "role": "child", "parent": "parent"},
+            {"type": "role_parent", "role": "parent", "parent": "root"},
+        ]
+        resp = self.bulk_import(ndjson(records))
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(body["data"]["role_parent"], 2)
+
+        child = self.db.query(Role).filter_by(name="child").one()
+        self.assertEqual(sorted(r.name for r in child.ancestors),
+                         ["parent", "root"])
+
+        resp = self.bulk_import(ndjson([
+            {"type": "role_parent", "role": "root", "parent": "child"}]))
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(body["status"], "role-cycle:root:child")
+
+    def test_invalid_line(self):
+        """格式错误的行
+        """
+        cases = [
+            ("{not json}\n", "invalid-json:1"),
+            ('{"type": "group"}\n', "invalid-record:1"),
+            ('\n{"type": "user_role", "user": "x", "role": "r"}\n',
+             "invalid-record:2"),
+            ('{"type": "role", "name": "r"}\n{"type": "role"}',
+             "invalid-record:2"),
+        ]
+        for data, status in cases:
+            resp = self.bulk_import(data)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            validate_default_error(body)
+            self.assertEqual(body["status"], status)
+
+
+class BulkImportCleanupTestCase(_Base):
+    """POST /bulk/import - 出错或客户端断开时释放会话
+    """
+
+    def setUp(self):
+        super().setUp()
+        self._line_size = settings.BULK_MAX_LINE_SIZE
+        patcher = mock.patch.object(
+            Importer, "abort", autospec=True, side_effect=Importer.abort)
+        self.abort = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        settings.BULK_MAX_LINE_SIZE = self._line_size
+        super().tearDown()
+
+    def assertAborted(self):
+        self.assertTrue(self.abort.called)
+        self.assertTrue(self.abort.call_args[0][0].closed)
+
+    def test_database_error(self):
+        """导入时数据库出错，返回 500 并回滚
+        """
+        data = ndjson([{"type": "permission", "name": "perm0"}])
+        with mock.patch.object(Importer, "_import_permission",
+                               side_effect=OperationalError("", {}, "")), \
+                self.assertLogs("tornado.application", "ERROR"):
+            resp = self.bulk_import(data, chunk_size=1)
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 500)
+        self.assertEqual(body["status"], "internal-error")
+        self.assertAborted()
+
+    def test_line_too_long(self):
+        """没有换行的输入超过单行最大字节数
+        """
+        settings.BULK_MAX_LINE_SIZE = "100"
+        data = ndjson([{"type": "role", "name": "r"}]) + "x" * 200
+        resp = self.bulk_import(data)
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(body["status"], "line-too-long:2")
+        self.assertAborted()
+
+    @gen_test(timeout=10)
+    async def test_connection_closed(self):
+        """客户端中途断开
+        """
+        line = json.dumps({"type": "permission", "name": "perm0"}) + "\n"
+        stream = await TCPClient().connect("127.0.0.1", self.get_http_port())
+        await stream.write(
+            b"POST /bulk/import?chunk_size=1 HTTP/1.1\r\n"
+            b"Host: localhost\r\nContent-Length: 100000\r\n\r\n" +
+            line.encode())
+        await asyncio.sleep(0.1)
+        stream.close()
+        for _ in range(50):
+            if self.abort.called:
+                break
+            await asyncio.sleep(0.1)
+        self.assertAborted()
+
+
+class BulkExportTestCase(_Base):
+    """GET /bulk/export - 批量导出
+    """
+
+    def test_roundtrip(self):
+        """导出的数据可以重新导入
+        """
+        perms = [Permission(name=f"perm{i}", summary=f"s{i}")
+                 for i in range(7)]
+        role = Role(name="role", permissions=perms[:5])
+        self.db.add_all(perms + [role])
+        self.current_user.roles.append(role)
+        self.db.commit()
+        user_id = str(self.current_user.uuid)
+
+        resp = self.api_get("/bulk/export?chunk_size=2")
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(
+            resp.headers["Content-Type"].startswith("application/x-ndjson"))
+        records = [json.loads(line) for line in resp.body.decode().splitlines()]
+        perm_total = self.db.query(Permission).count()
+        role_total = self.db.query(Role).count()
+        self.assertEqual([r["type"] for r in records],
+                         ["permission"] * perm_total + ["role"] * role_total +
+                         ["role_permission"] * 5 + ["user_role"])
+        self.assertEqual(records[-1], {"type": "user_role",
+                                       "user": user_id,
+                                       "role": "role"})
+
+        # 通过 ORM 删除，同时删除关联关系
+        for obj in self.db.query(Role).all() + self.db.query(Permission).all():
+            self.db.delete(obj)
+        self.db.commit()
+
+        resp = self.bulk_import(resp.body)
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(body["data"]["permission"], perm_total)
+        self.assertEqual(body["data"]["role_permission"], 5)
+
+        role = self.db.query(Role).filter_by(name="role").one()
+        self.assertEqual(len(role.permissions), 5)
+        self.assertEqual(
+            self.db.query(Permission).filter_by(name="perm6").one().summary,
+            "s6")
+
+    def test_keyset_pages(self):
+        """按联合键分页读取，页大小整除记录数时以空页结束
+        """
+        role = Role(name="role", permissions=[
+            Permission(name=f"perm{i}") for i in range(4)])
+        self.db.add(role)
+        self.db.commit()
+
+        rp = _ROLE_PERMISSIONS.c
+        with dbc.engine.connect() as conn:
+            for size in (1, 2, 3, 4, 5):
+                pages = list(iter_keyset_pages(
+                    conn, select([rp.permission_id]),
+                    [rp.role_id, rp.permission_id], size))
+                self.assertTrue(all(len(page) <= size for page in pages))
+                self.assertEqual(
+                    [row for page in pages for row in page],
+                    [(p.id,) for p in sorted(role.permissions,
+                                             key=lambda p: p.id)])
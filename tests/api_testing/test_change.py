@@ -0,0 +1,345 @@
+import asyncio
+import datetime
+import time
+import uuid
+from unittest import mock
+
+from eva.conf import settings
+from tornado.testing import gen_test
+
+from codebase.models import (
+    Role,
+    Permission,
+    current_revision,
+    _CHANGE_LOG,
+    _REVISION,
+)
+from codebase.retention import ChangeLogPruner, prune
+from codebase.utils.sqlalchemy import dbc
+from codebase.utils.swaggerui import api
+
+from .base import (
+    BaseTestCase,
+    validate_default_error,
+    get_body_json
+)
+
+
+class ChangeTestCase(BaseTestCase):
+    """GET /changes - 获取指定修订号之后的变更
+    """
+
+    rs = api.spec.resources["change"]
+
+    def get_changes(self, since=None, **kwargs):
+        url = "/changes"
+        if since is not None:
+            kwargs["since"] = since
+        if kwargs:
+            url += "?" + "&".join(f"{k}={v}" for k, v in kwargs.items())
+        resp = self.api_get(url)
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        spec = self.rs.get_changes.op_spec["responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+        return body["data"]
+
+    def test_success(self):
+        """角色、权限、用户角色变化后，返回受影响的实体
+        """
+        start = self.get_changes()["revision"]
+        self.assertEqual(self.get_changes(start)["roles"], [])
+
+        resp = self.api_post("/role/permission/append", body={
+            "role": "my-role", "permissions": ["p0", "p1"]})
+        self.assertEqual(resp.code, 200)
+        role_id = str(self.db.query(Role).filter_by(name="my-role").one().uuid)
+        user_id = str(uuid.uuid4())
+        resp = self.api_post(f"/user/{user_id}/role/append",
+                             body={"roles": [role_id]})
+        self.assertEqual(resp.code, 200)
+
+        data = self.get_changes(start)
+        self.assertGreater(data["revision"], start)
+        self.assertFalse(data["more"])
+        self.assertEqual(data["roles"], [role_id])
+        self.assertEqual(data["permissions"], ["p0", "p1"])
+        self.assertEqual(data["users"], [user_id])
+
+        # 之后没有新的变更
+        data = self.get_changes(data["revision"])
+        self.assertEqual((data["users"], data["roles"], data["permissions"]),
+                         ([], [], []))
+
+    def test_inherited(self):
+        """增加父角色时，子角色及其后代角色受影响
+        """
+        roles = [Role(name=f"role{i}") for i in range(4)]
+        self.db.add_all(roles)
+        self.db.commit()
+        # role2 -> role1
+        roles[2].add_parent(self.db, roles[1])
+        self.db.commit()
+        ids = [str(r.uuid) for r in self.db.query(Role).filter(
+            Role.name.in_([r.name for r in roles])).order_by(Role.name)]
+        start = self.get_changes()["revision"]
+
+        resp = self.api_post(f"/role/{ids[1]}/parent/append",
+                             body={"parents": [ids[0]]})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.get_changes(start)["roles"],
+                         sorted([ids[1], ids[2]]))
+
+    def test_delete_permission(self):
+        """删除的权限（名称已不存在）
+        """
+        perm = Permission(name="to-delete")
+        self.db.add(perm)
+        self.db.commit()
+        perm_id = str(perm.uuid)
+        start = self.get_changes()["revision"]
+
+        resp = self.api_delete(f"/permission/{perm_id}")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.get_changes(start)["permissions"], ["to-delete"])
+
+    def test_limit(self):
+        """分批读取，不拆分同一修订号
+        """
+        start = self.get_changes()["revision"]
+        for i in range(5):
+            # 每次提交一个修订号，影响一个角色与两个权限
+            self.db.add(Role(name=f"role{i}", permissions=[
+                Permission(name=f"p{i}-0"), Permission(name=f"p{i}-1")]))
+            self.db.commit()
+
+        since, pages, permissions = start, 0, []
+        while True:
+            data = self.get_changes(since, limit=4)
+            pages += 1
+            permissions.extend(data["permissions"])
+            since = data["revision"]
+            if not data["more"]:
+                break
+        self.assertEqual(since, start + 5)
+        self.assertEqual(sorted(permissions),
+                         sorted(f"p{i}-{j}" for i in range(5) for j in (0, 1)))
+        self.assertGreater(pages, 2)
+
+        # 单个修订号的记录数超过 limit 时完整返回
+        data = self.get_changes(start, limit=1)
+        self.assertEqual(data["revision"], start + 1)
+        self.assertEqual(data["permissions"], ["p0-0", "p0-1"])
+
+    def test_max_limit(self):
+        """limit 超过 CHANGES_MAX_LIMIT 时按最大值返回
+        """
+        start = self.get_changes()["revision"]
+        for i in range(5):
+            self.db.add(Role(name=f"role{i}", permissions=[
+                Permission(name=f"p{i}-0"), Permission(name=f"p{i}-1")]))
+            self.db.commit()
+
+        with mock.patch.object(settings, "CHANGES_MAX_LIMIT", "4"):
+            data = self.get_changes(start, limit=10 ** 12)
+            self.assertTrue(data["more"])
+            self.assertEqual(data, self.get_changes(start, limit=4))
+        data = self.get_changes(start, limit=1000)
+        self.assertFalse(data["more"])
+        self.assertEqual(data["revision"], start + 5)
+
+    def test_rollback(self):
+        """回滚的事务不增加修订号
+        """
+        start = self.get_changes()["revision"]
+        self.db.add(Role(name="rollback"))
+        self.db.flush()
+        self.db.rollback()
+        self.assertEqual(self.get_changes()["revision"], start)
+
+    def test_invalid_since(self):
+        """修订号不存在、参数格式错误
+        """
+        revision = self.get_changes()["revision"]
+        for query, status in [(f"since={revision + 1}", "invalid-since"),
+                              ("since=-1", "invalid-since"),
+                              ("since=abc", "invalid-argument"),
+                              ("since=0&limit=0", "invalid-argument")]:
+            resp = self.api_get(f"/changes?{query}")
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            validate_default_error(body)
+            self.assertEqual(body["status"], status)
+
+
+def _add_role(name):
+    db = dbc.session()
+    db.add(Role(name=name))
+    db.commit()
+    return str(db.query(Role).filter_by(name=name).one().uuid)
+
+
+class WatchTestCase(BaseTestCase):
+    """GET /watch - 等待指定修订号之后的变更（长轮询）
+    """
+
+    rs = api.spec.resources["change"]
+
+    async def watch(self, query):
+        start = time.monotonic()
+        resp = await self.http_client.fetch(
+            self.get_url(f"/watch?{query}"), raise_error=False)
+        return resp, get_body_json(resp), time.monotonic() - start
+
+    def validate(self, resp, body):
+        self.assertEqual(resp.code, 200)
+        spec = self.rs.get_watch.op_spec["responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+
+    @gen_test(timeout=10)
+    async def test_wait(self):
+        """等待中提交的变更立即返回
+        """
+        since = await dbc.run_in_executor(current_revision, dbc.session())
+        future = asyncio.ensure_future(self.watch(f"since={since}&timeout=5"))
+        await asyncio.sleep(0.2)
+        self.assertFalse(future.done())
+
+        role_id = await dbc.run_in_executor(_add_role, "watched")
+        resp, body, elapsed = await future
+        self.validate(resp, body)
+        self.assertEqual(body["data"]["roles"], [role_id])
+        self.assertEqual(body["data"]["revision"], since + 1)
+        self.assertLess(elapsed, 3)
+
+    @gen_test(timeout=10)
+    async def test_existing_changes(self):
+        """已有变更时立即返回
+        """
+        since = await dbc.run_in_executor(current_revision, dbc.session())
+        role_id = await dbc.run_in_executor(_add_role, "existing")
+        resp, body, elapsed = await self.watch(f"since={since}&timeout=5")
+        self.validate(resp, body)
+        self.assertEqual(body["data"]["roles"], [role_id])
+        self.assertLess(elapsed, 3)
+
+    @gen_test(timeout=10)
+    async def test_timeout(self):
+        """超时返回空的变更
+        """
+        since = await dbc.run_in_executor(current_revision, dbc.session())
+        resp, body, elapsed = await self.watch(f"since={since}&timeout=1")
+        self.validate(resp, body)
+        self.assertEqual(body["data"]["revision"], since)
+        self.assertEqual(body["data"]["roles"], [])
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    @gen_test(timeout=10)
+    async def test_other_process(self):
+        """其他进程提交的变更（没有进程内通知）通过轮询发现
+        """
+        interval = settings.WATCH_POLL_INTERVAL
+        settings.WATCH_POLL_INTERVAL = "0.1"
+        try:
+            since = await dbc.run_in_executor(current_revision, dbc.session())
+            future = asyncio.ensure_future(
+                self.watch(f"since={since}&timeout=5"))
+            await asyncio.sleep(0.2)
+
+            def commit():
+                with dbc.engine.begin() as conn:
+                    conn.execute(_REVISION.update().values(revision=since + 1))
+                    conn.execute(_CHANGE_LOG.insert().values(
+                        revision=since + 1, kind="permission", ref="remote",
+                        created=datetime.datetime.utcnow()))
+            await dbc.run_in_executor(commit)
+
+            resp, body, _ = await future
+            self.validate(resp, body)
+            self.assertEqual(body["data"]["permissions"], ["remote"])
+        finally:
+            settings.WATCH_POLL_INTERVAL = interval
+
+    def test_invalid_argument(self):
+        """缺少 since 、参数格式错误
+        """
+        for query, status in [("", "invalid-argument"),
+                              ("since=abc", "invalid-argument"),
+                              ("since=0&timeout=-1", "invalid-argument"),
+                              ("since=100000", "invalid-since")]:
+            resp = self.api_get(f"/watch?{query}")
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            validate_default_error(body)
+            self.assertEqual(body["status"], status)
+
+
+class ChangeLogPruneTestCase(BaseTestCase):
+    """变更日志清理
+    """
+
+    def setUp(self):
+        super().setUp()
+        self._retention = settings.CHANGES_RETENTION
+        settings.CHANGES_RETENTION = "3600"
+        self.start = current_revision(self.db)
+        for i in range(3):
+            self.db.add(Role(name=f"prune-{i}"))
+            self.db.commit()
+        # 前两个修订号过期
+        old = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        self.db.execute(_CHANGE_LOG.update().where(
+            _CHANGE_LOG.c.revision <= self.start + 2).values(created=old))
+        self.db.commit()
+
+    def tearDown(self):
+        settings.CHANGES_RETENTION = self._retention
+        super().tearDown()
+
+    def assertTooOld(self, url):
+        resp = self.api_get(url)
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        validate_default_error(body)
+        self.assertEqual(body["status"], "since-too-old")
+        self.assertEqual(body["data"]["revision"], current_revision(self.db))
+
+    def test_prune(self):
+        """删除过期的修订号，更早的 since 返回 since-too-old
+        """
+        pruner = ChangeLogPruner()
+        # 每个事务删除一个修订号
+        with mock.patch.object(settings, "CHANGES_PRUNE_BATCH", "1"):
+            self.io_loop.run_sync(pruner.prune_once)
+        self.assertGreater(pruner.stats["deleted"], 0)
+        revisions = {r for r, in self.db.query(_CHANGE_LOG.c.revision)}
+        self.assertEqual(min(revisions), self.start + 3)
+
+        since = self.start + 2
+        resp = self.api_get(f"/changes?since={since}")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(get_body_json(resp)["data"]["roles"], [
+            str(self.db.query(Role).filter_by(name="prune-2").one().uuid)])
+        self.assertTooOld(f"/changes?since={since - 1}")
+        self.assertTooOld(f"/watch?since={since - 1}&timeout=0")
+
+    def test_prune_all(self):
+        """全部清理后只能从当前修订号开始
+        """
+        self.db.execute(_CHANGE_LOG.update().values(
+            created=datetime.datetime.utcnow() - datetime.timedelta(hours=2)))
+        self.db.commit()
+        self.assertGreater(prune(batch_size=100), 0)
+        self.assertEqual(self.db.query(_CHANGE_LOG).count(), 0)
+
+        revision = current_revision(self.db)
+        resp = self.api_get(f"/changes?since={revision}")
+        self.assertEqual(resp.code, 200)
+        self.assertTooOld(f"/changes?since={revision - 1}")
+
+    def test_disabled(self):
+        """保留时间为 0 时不清理
+        """
+        total = self.db.query(_CHANGE_LOG).count()
+        self.assertEqual(prune(retention=0), 0)
+        self.assertEqual(self.db.query(_CHANGE_LOG).count(), total)
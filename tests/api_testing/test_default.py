@@ -1,7 +1,27 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+import uuid
+
+from eva.conf import settings
 from yaml import safe_load
 from swagger_spec_validator.util import get_validator
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from codebase.models import Permission, Role, User
+from codebase.utils.sqlalchemy import TimedQueuePool
+from codebase.utils.swaggerui import api
 
-from .base import BaseTestCase
+from .base import (
+    BaseTestCase,
+    get_body_json,
+    parse_metrics,
+    validate_default_error,
+)
 
 
 class HealthTestCase(BaseTestCase):
@@ -17,6 +37,211 @@ class HealthTestCase(BaseTestCase):
         self.assertEqual(resp.body, b"ok")
 
 
+class DebugDBTestCase(BaseTestCase):
+    """GET /_debug/db - 数据库连接池状态
+    """
+
+    def grant(self, role):
+        user = self.db.query(User).filter_by(
+            uuid=self.current_user.uuid).one()
+        user.roles.append(role)
+        self.db.commit()
+
+    def admin_role(self):
+        return self.db.query(Role).filter_by(
+            name=settings.ADMIN_ROLE_NAME).one()
+
+    def test_success(self):
+        """返回正确
+        """
+        self.grant(self.admin_role())
+        resp = self.api_get("/_debug/db")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        spec = api.spec_dict["definitions"]["DebugDBResponse"]
+        api.validate_object(spec, body)
+        # 测试使用内存 SQLite ，共享一个连接，只使用一个线程
+        self.assertEqual(body["data"]["pool_class"], "StaticPool")
+        self.assertEqual(body["data"]["executor_workers"], 1)
+
+    def test_need_admin(self):
+        """需要超级管理员角色，继承的也可以
+        """
+        resp = self.fetch("/_debug/db")
+        self.assertEqual(get_body_json(resp)["status"], "no-x-user-id")
+
+        resp = self.api_get("/_debug/db")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        validate_default_error(body)
+        self.assertEqual(body["status"], "need-admin")
+
+        # 未记录过的用户
+        resp = self.fetch("/_debug/db",
+                          headers={"X-User-Id": str(uuid.uuid4())})
+        self.assertEqual(get_body_json(resp)["status"], "need-admin")
+
+        role = Role(name="ops")
+        self.db.add(role)
+        self.db.flush()
+        role.add_parent(self.db, self.admin_role())
+        self.grant(role)
+        resp = self.api_get("/_debug/db")
+        self.assertEqual(resp.code, 200)
+
+    def test_queue_pool(self):
+        """记录借出的连接数、等待时间与超时
+        """
+        engine = create_engine(
+            "sqlite://", poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.05)
+        conn = engine.connect()
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+
+        status = engine.pool.status_dict()
+        self.assertEqual(status["checked_out"], 1)
+        self.assertEqual(status["waiting"], 0)
+        self.assertEqual(status["timeouts"], 1)
+        wait = status["wait_seconds"]
+        self.assertEqual(wait["count"], 2)
+        self.assertGreaterEqual(wait["sum"], 0.05)
+        self.assertEqual(wait["buckets"][-1], {"le": "+Inf", "count": 2})
+        spec = api.spec_dict["definitions"]["Histogram"]
+        api.validate_object(spec, wait)
+
+        conn.close()
+        engine.dispose()
+        # 重建连接池后保留指标
+        self.assertEqual(engine.pool.status_dict()["timeouts"], 1)
+        self.assertEqual(engine.pool.status_dict()["checked_out"], 0)
+
+
+# 启动应用并发送并发请求（数据库操作分布在线程池的多个线程中），输出各请求的
+# 状态码与连接池类型
+FILE_DB_SCRIPT = textwrap.dedent(r"""
+    import json
+    import uuid
+
+    from tornado.gen import multi
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.netutil import bind_sockets
+
+    from codebase.app import make_app
+    from codebase.models import Role, User
+    from codebase.utils.sqlalchemy import dbc
+
+    dbc.create_all()
+    db = dbc.session()
+    # 超级管理员，可以访问 /_debug/db
+    admin = db.query(Role).filter_by(name="admin").one()
+    user = User(uuid=uuid.uuid4(), roles=[admin])
+    db.add(user)
+    db.commit()
+    headers = {"X-User-Id": str(user.uuid)}
+    dbc.session.remove()
+
+    sockets = bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(make_app())
+    server.add_sockets(sockets)
+    base = "http://127.0.0.1:%d" % sockets[0].getsockname()[1]
+
+    async def main():
+        client = AsyncHTTPClient()
+        creates = [client.fetch(base + "/role", method="POST", headers=headers,
+                                body=json.dumps({"name": "role%d" % i}),
+                                raise_error=False) for i in range(8)]
+        lists = [client.fetch(base + "/role", headers=headers,
+                              raise_error=False) for _ in range(8)]
+        for resp in await multi(creates + lists):
+            print(resp.code)
+        resp = await client.fetch(base + "/role?page_size=100", headers=headers)
+        names = [r["name"] for r in json.loads(resp.body)["data"]]
+        print(len([n for n in names if n.startswith("role")]))
+        resp = await client.fetch(base + "/_debug/db", headers=headers)
+        print(json.loads(resp.body)["data"]["pool_class"])
+
+    IOLoop.current().run_sync(main)
+""")
+
+
+class FileSQLiteTestCase(unittest.TestCase):
+    """使用文件 SQLite 启动应用
+    """
+
+    def test_requests(self):
+        """连接在线程池的不同线程中使用，请求均成功
+        """
+        src = os.path.join(os.path.dirname(__file__), "..", "..", "src")
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PYTHONPATH=os.path.abspath(src),
+                       DB_URI=f"sqlite:///{tmp}/authz.db", DEBUG="false")
+            proc = subprocess.run(
+                [sys.executable, "-c", FILE_DB_SCRIPT], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                timeout=60, check=False)
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode())
+        lines = proc.stdout.decode().split()
+        self.assertEqual(lines, ["200"] * 16 + ["8", "TimedQueuePool"])
+
+
+class MetricsTestCase(BaseTestCase):
+    """GET /_metrics - 运行指标
+    """
+
+    def get_metrics(self):
+        resp = self.fetch("/_metrics")
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(resp.headers["Content-Type"].startswith(
+            "text/plain; version=0.0.4"))
+        return parse_metrics(resp.body.decode())
+
+    def test_success(self):
+        """记录请求数、耗时、权限检查结果与缓存命中
+        """
+        perm = Permission(name="perm")
+        role = Role(name="role", permissions=[perm])
+        self.db.add_all([perm, role, Permission(name="other")])
+        self.current_user.roles.append(role)
+        self.db.commit()
+        user_id = str(self.current_user.uuid)
+
+        before = self.get_metrics()
+        for name in ["perm", "perm", "other"]:
+            resp = self.api_get(
+                f"/has_permission?user_id={user_id}&permission_name={name}")
+            self.assertEqual(resp.code, 200)
+        for _ in range(2):
+            resp = self.api_get("/my/role")
+            self.assertEqual(resp.code, 200)
+        after = self.get_metrics()
+
+        def delta(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        handler = 'handler="HasPermissionHandler"'
+        self.assertEqual(delta(
+            f'authz_http_requests_total{{{handler},method="GET",code="200"}}'),
+            3)
+        self.assertEqual(delta(
+            "authz_http_request_duration_seconds_count"
+            f'{{{handler},method="GET"}}'), 3)
+        self.assertEqual(delta(
+            "authz_http_request_duration_seconds_bucket"
+            f'{{{handler},method="GET",le="+Inf"}}'), 3)
+        self.assertEqual(
+            delta(f'authz_decisions_total{{{handler},decision="yes"}}'), 2)
+        self.assertEqual(
+            delta(f'authz_decisions_total{{{handler},decision="no"}}'), 1)
+        # 第二次请求的用户 id 来自缓存
+        self.assertGreaterEqual(
+            delta('authz_cache_hits_total{cache="user_ids"}'), 1)
+        ratio = after['authz_cache_hit_ratio{cache="user_ids"}']
+        self.assertTrue(0 < ratio <= 1)
+
+
 class SpecTestCase(BaseTestCase):
     """GET / - SwaggerUI 文档
     """
@@ -0,0 +1,91 @@
+from sqlalchemy import event
+
+from codebase.models import (
+    Permission,
+    Role
+)
+from codebase.utils.sqlalchemy import dbc
+
+from .base import BaseTestCase
+
+
+class ETagTestCase(BaseTestCase):
+    """读接口的 ETag / If-None-Match
+    """
+
+    def setUp(self):
+        super().setUp()
+        role = Role(name="my-role", permissions=[Permission(name="my-perm")])
+        self.db.add(role)
+        self.current_user.roles.append(role)
+        self.db.commit()
+        self.role_id = str(role.uuid)
+        self.user_id = str(self.current_user.uuid)
+
+    def urls(self):
+        return ["/my/role", "/my/permission", "/role", "/permission",
+                f"/role/{self.role_id}/permission",
+                f"/user/{self.user_id}/role"]
+
+    def get(self, url, etag=None):
+        headers = {"If-None-Match": etag} if etag else None
+        return self.api_get(url, headers=headers)
+
+    def test_not_modified(self):
+        """数据未变化时返回 304 ，变化后返回新的数据与 ETag
+        """
+        etags = {}
+        for url in self.urls():
+            resp = self.get(url)
+            self.assertEqual(resp.code, 200, url)
+            etags[url] = resp.headers["Etag"]
+
+            resp = self.get(url, etags[url])
+            self.assertEqual(resp.code, 304, url)
+            self.assertEqual(resp.body, b"")
+        # 不同的请求 ETag 不同
+        self.assertEqual(len(set(etags.values())), len(etags))
+
+        self.db.add(Permission(name="other"))
+        self.db.commit()
+        for url in self.urls():
+            resp = self.get(url, etags[url])
+            self.assertEqual(resp.code, 200, url)
+            self.assertNotEqual(resp.headers["Etag"], etags[url])
+
+    def test_skip_query(self):
+        """返回 304 时只读取修订号
+        """
+        url = f"/role/{self.role_id}/permission"
+        etag = self.get(url).headers["Etag"]
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(dbc.engine, "before_cursor_execute", count)
+        try:
+            resp = self.get(url, etag)
+        finally:
+            event.remove(dbc.engine, "before_cursor_execute", count)
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertIn("authz_revision", statements[0])
+
+    def test_user(self):
+        """不同用户的 /my/role 的 ETag 不同
+        """
+        etag = self.get("/my/role").headers["Etag"]
+        self.http_request_headers["X-User-Id"] = \
+            "00000000-0000-0000-0000-000000000001"
+        resp = self.get("/my/role", etag)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.body.count(b"my-role"), 0)
+
+    def test_error(self):
+        """出错时不返回 ETag
+        """
+        resp = self.get("/role/00000000-0000-0000-0000-000000000001/permission")
+        self.assertEqual(resp.code, 400)
+        self.assertNotIn("Etag", resp.headers)
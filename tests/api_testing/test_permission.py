@@ -59,6 +59,27 @@ class MyPermissionListTestCase(_Base):
             [role_basename + str(i) for i in range(role_numbers)],
             sorted(role_names))
 
+    def test_inherited(self):
+        """包括从祖先角色继承的权限
+        """
+        parent = Role(name="parent-role")
+        parent.permissions.append(Permission(name="inherited"))
+        role = Role(name="my-role")
+        role.permissions.append(Permission(name="own"))
+        self.db.add_all([parent, role])
+        self.current_user.roles.append(role)
+        self.db.commit()
+        role.add_parent(self.db, parent)
+        self.db.commit()
+
+        resp = self.api_get("/my/permission")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(len(body["data"]), 1)
+        self.assertEqual(
+            sorted(p["name"] for p in body["data"][0]["permissions"]),
+            ["inherited", "own"])
+
 
 class PermissionListTestCase(_Base):
     """GET /permission - 获取权限列表
@@ -101,6 +122,25 @@ class PermissionListTestCase(_Base):
         self.assertEqual(len(body["data"]), body["filter"]["page_size"])
         self.assertEqual(body["filter"]["total"], self.total + 1)
 
+    def test_cursor(self):
+        """游标分页
+        """
+        names = []
+        url = "/permission?cursor=&page_size=10"
+        while url:
+            resp = self.api_get(url)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 200)
+
+            spec = self.rs.get_permission.op_spec["responses"]["200"]["schema"]
+            api.validate_object(spec, body)
+
+            names.extend(x["name"] for x in body["data"])
+            cursor = body["filter"]["next"]
+            url = f"/permission?cursor={cursor}" if cursor else None
+
+        self.assertEqual(len(set(names)), self.total + 1)
+
     def test_no_such_page(self):
         """查无此页
         """
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import textwrap
+import unittest
+
+from codebase.utils.process import worker_id
+
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "..", "src")
+
+
+def run_workers(body):
+    """在子进程中运行 `fork_workers` ，返回 `(退出码, 各 worker 输出的行)`
+    """
+    script = textwrap.dedent("""
+        import os
+        import sys
+        from codebase.utils.process import fork_workers, worker_id
+        wid = fork_workers(3, max_restarts=2)
+        assert wid == worker_id()
+    """) + textwrap.dedent(body)
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(SRC))
+    proc = subprocess.run([sys.executable, "-c", script], env=env,
+                          stdout=subprocess.PIPE, timeout=60, check=False)
+    return proc.returncode, sorted(proc.stdout.decode().split())
+
+
+class ForkWorkersTestCase(unittest.TestCase):
+    """多进程（pre-fork）运行
+    """
+
+    def test_single_process(self):
+        """单进程模式下没有 worker 编号
+        """
+        self.assertIsNone(worker_id())
+
+    def test_workers_exit(self):
+        """每个 worker 得到自己的编号，全部正常退出后父进程退出
+        """
+        code, lines = run_workers(r"""
+            os.write(1, b"%d\n" % wid)
+            sys.exit(0)
+        """)
+        self.assertEqual(code, 0)
+        self.assertEqual(lines, ["0", "1", "2"])
+
+    def test_restart(self):
+        """异常退出的 worker 以原编号重启，超过最大重启次数后父进程以错误退出
+        """
+        code, lines = run_workers(r"""
+            os.write(1, b"%d\n" % wid)
+            sys.exit(1 if wid == 1 else 0)
+        """)
+        self.assertEqual(code, 1)
+        # 首次启动 + 2 次重启
+        self.assertEqual(lines, ["0", "1", "1", "1", "2"])
@@ -0,0 +1,98 @@
+from eva.conf import settings
+
+from codebase.models import (
+    Permission,
+    Role,
+    User
+)
+
+from .base import BaseTestCase, query_budget
+
+
+class QueryBudgetTestCase(BaseTestCase):
+    """各接口的查询次数预算
+
+    查询次数应为常数，不随角色、权限的数量增长（N+1 查询）。预算包含 ETag 读取
+    修订号、查询用户 id （首次请求，之后命中缓存）的查询。
+    """
+
+    def setUp(self):
+        super().setUp()
+        self._settings = (settings.AUTHZ_ENGINE, settings.RELATIONSHIP_LOADING)
+        settings.AUTHZ_ENGINE = "sql"
+        self.user_id = str(self.current_user.uuid)
+        self.add_roles(1)
+        role = self.db.query(Role).filter_by(name="role-0").one()
+        self.role_id = str(role.uuid)
+        self.perm_id = str(role.permissions[0].uuid)
+
+    def tearDown(self):
+        settings.AUTHZ_ENGINE, settings.RELATIONSHIP_LOADING = self._settings
+        super().tearDown()
+
+    def add_roles(self, count):
+        """为当前用户增加 `count` 个角色，每个角色 3 个权限
+        """
+        user = self.db.query(User).filter_by(uuid=self.user_id).one()
+        start = self.db.query(Role).filter(Role.name.like("role-%")).count()
+        for i in range(start, start + count):
+            role = Role(name=f"role-{i}", permissions=[
+                Permission(name=f"perm-{i}-{j}") for j in range(3)])
+            user.roles.append(role)
+        self.db.commit()
+
+    def budgets(self):
+        return [
+            (f"/has_permission?user_id={self.user_id}"
+             f"&permission_name=perm-0-0", 2),
+            (f"/has_permission_id?user_id={self.user_id}"
+             f"&permission_id={self.perm_id}", 2),
+            ("/my/role", 3),
+            ("/my/permission", 4),
+            ("/role", 3),
+            ("/permission", 3),
+            ("/permission?cursor=", 3),
+            (f"/role/{self.role_id}/permission", 3),
+            (f"/role/{self.role_id}/permission?inherited=false", 3),
+            (f"/user/{self.user_id}/role", 3),
+        ]
+
+    def test_budget(self):
+        """每个请求的查询不超过预算，增加角色与权限后仍不超过
+        """
+        for _ in range(2):
+            for url, count in self.budgets():
+                # 数据库耗时的预算较宽，只用于发现明显的退化（如全表扫描）
+                with self.assertMaxQueries(count, seconds=0.5):
+                    resp = self.api_get(url)
+                self.assertEqual(resp.code, 200, url)
+            self.add_roles(20)
+
+    def test_budget_joined(self):
+        """使用 JOIN 预先加载关联对象
+        """
+        settings.RELATIONSHIP_LOADING = "joined"
+        self.test_budget()
+
+    @query_budget(5)
+    def test_has_permission_batch(self):
+        """批量检查的查询次数与检查项数无关
+        """
+        checks = [{"user_id": self.user_id, "permission_name": f"perm-0-{i % 3}"}
+                  for i in range(50)]
+        checks.append({"user_id": self.user_id, "permission_id": self.perm_id})
+        resp = self.api_post("/has_permission/batch", body={"checks": checks})
+        self.assertEqual(resp.code, 200)
+
+    def test_my_permission(self):
+        """我的权限：查询次数与角色数无关
+        """
+        counts = []
+        for _ in range(2):
+            # 第一次请求之后用户 id 命中缓存
+            self.api_get("/my/permission")
+            count, resp = self.count_queries(self.api_get, "/my/permission")
+            self.assertEqual(resp.code, 200)
+            counts.append(count)
+            self.add_roles(20)
+        self.assertEqual(counts[0], counts[1])
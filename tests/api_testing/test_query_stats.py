@@ -0,0 +1,69 @@
+from eva.conf import settings
+
+from codebase.models import (
+    Permission,
+    Role
+)
+from codebase.utils.sqlalchemy.stats import track_queries
+
+from .base import BaseTestCase
+
+
+class QueryStatsTestCase(BaseTestCase):
+    """每个请求的 SQL 查询统计
+    """
+
+    def setUp(self):
+        super().setUp()
+        self._settings = (settings.DEBUG, settings.SLOW_REQUEST_QUERIES,
+                          settings.SLOW_REQUEST_DB_TIME)
+        role = Role(name="my-role", permissions=[Permission(name="my-perm")])
+        self.db.add(role)
+        self.current_user.roles.append(role)
+        self.db.commit()
+
+    def tearDown(self):
+        (settings.DEBUG, settings.SLOW_REQUEST_QUERIES,
+         settings.SLOW_REQUEST_DB_TIME) = self._settings
+        super().tearDown()
+
+    def test_headers(self):
+        """DEBUG 模式下返回查询次数与耗时（包括数据库线程池中的查询）
+        """
+        settings.DEBUG = "true"
+        resp = self.api_get("/my/permission")
+        self.assertEqual(resp.code, 200)
+        self.assertGreater(int(resp.headers["X-Query-Count"]), 0)
+        self.assertGreaterEqual(float(resp.headers["X-Query-Time"]), 0)
+
+        # 不访问数据库的请求
+        resp = self.fetch("/_health")
+        self.assertEqual(resp.headers["X-Query-Count"], "0")
+
+        settings.DEBUG = "false"
+        resp = self.api_get("/my/permission")
+        self.assertNotIn("X-Query-Count", resp.headers)
+
+    def test_slow_request_log(self):
+        """超过查询次数预算时记录日志
+        """
+        settings.SLOW_REQUEST_QUERIES = "1"
+        with self.assertLogs("tornado.general", "WARNING") as logs:
+            self.api_get("/my/permission")
+        self.assertIn("slow request 200 GET /my/permission", logs.output[0])
+
+        settings.SLOW_REQUEST_QUERIES = "0"
+        settings.SLOW_REQUEST_DB_TIME = "0"
+        with self.assertRaises(AssertionError):
+            with self.assertLogs("tornado.general", "WARNING"):
+                self.api_get("/my/permission")
+
+    def test_track_queries(self):
+        """统计只记录当前上下文中的查询
+        """
+        with track_queries() as stats:
+            self.db.query(Role).all()
+            self.db.query(Permission).count()
+        self.assertEqual(stats.count, 2)
+        self.db.query(Role).all()
+        self.assertEqual(stats.count, 2)
@@ -1,8 +1,16 @@
 import uuid
 
 from eva.utils.time_ import utc_rfc3339_string
-
-from codebase.models import Permission, Role, User
+from sqlalchemy import select
+
+from codebase.models import (
+    _ROLE_CLOSURE,
+    Permission,
+    Role,
+    RoleClosureError,
+    User,
+)
+from codebase.utils.sqlalchemy.page import encode_cursor
 from codebase.utils.swaggerui import api
 
 from .base import (
@@ -44,6 +52,35 @@ class MyRoleListTestCase(RoleBaseTestCase):
         self.assertEqual([basename + str(i)
                           for i in range(numbers)], sorted(names))
 
+        # 再次请求时由缓存获得用户，角色变化立即可见
+        role = self.db.query(Role).filter_by(name=basename + "0").one()
+        self.db.delete(role)
+        self.db.commit()
+        resp = self.api_get("/my/role")
+        body = get_body_json(resp)
+        self.assertEqual(len(body["data"]), numbers - 1)
+
+    def test_unknown_user(self):
+        """未记录过的用户没有角色，不会创建用户
+        """
+        total = self.db.query(User).count()
+        self.http_request_headers["X-User-Id"] = str(uuid.uuid4())
+        resp = self.api_get("/my/role")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(body["data"], [])
+        self.assertEqual(self.db.query(User).count(), total)
+
+    def test_invalid_user_id(self):
+        """X-User-Id 不是合法的 UUID
+        """
+        self.http_request_headers["X-User-Id"] = "not-a-uuid"
+        resp = self.api_get("/my/role")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        validate_default_error(body)
+        self.assertEqual(body["status"], "invalid-x-user-id")
+
 
 class RoleListTestCase(RoleBaseTestCase):
     """GET /role - 查看所有角色列表
@@ -82,6 +119,41 @@ class RoleListTestCase(RoleBaseTestCase):
         self.assertEqual(body["filter"]["total"], self.total + 3)
         # 系统初始化了3个角色
 
+    def test_total_mode(self):
+        """总数统计方式
+        """
+        resp = self.api_get("/role?total=none")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertNotIn("total", body["filter"])
+        self.assertEqual(len(body["data"]), body["filter"]["page_size"])
+
+        # sqlite 不支持估算，返回精确总数
+        resp = self.api_get("/role?total=approximate")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(body["filter"]["total"], self.total + 3)
+
+        resp = self.api_get("/role?total=unknown")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(body["status"], "unknown-total:unknown")
+
+    def test_total_cache_invalidate(self):
+        """创建、删除角色后总数随之变化
+        """
+        resp = self.api_get("/role")
+        self.assertEqual(get_body_json(resp)["filter"]["total"], self.total + 3)
+
+        resp = self.api_post("/role", body={"name": "new-role"})
+        role_id = get_body_json(resp)["id"]
+        resp = self.api_get("/role")
+        self.assertEqual(get_body_json(resp)["filter"]["total"], self.total + 4)
+
+        self.api_delete(f"/role/{role_id}")
+        resp = self.api_get("/role")
+        self.assertEqual(get_body_json(resp)["filter"]["total"], self.total + 3)
+
     def test_no_such_page(self):
         """查无此页
         """
@@ -92,6 +164,71 @@ class RoleListTestCase(RoleBaseTestCase):
             validate_default_error(body)
             self.assertEqual(body["status"], f"no-such-page:{page}")
 
+    def test_cursor(self):
+        """游标分页
+        """
+        for sort_by in ["id", "name", "created"]:
+            names = []
+            cursors = []
+            url = f"/role?cursor=&sort_by={sort_by}&asc=true"
+            while True:
+                resp = self.api_get(url)
+                body = get_body_json(resp)
+                self.assertEqual(resp.code, 200)
+
+                spec = self.rs.get_role.op_spec["responses"]["200"]["schema"]
+                api.validate_object(spec, body)
+                self.assertNotIn("total", body["filter"])
+
+                names.append([x["name"] for x in body["data"]])
+                if not body["filter"]["next"]:
+                    break
+                cursors.append(body["filter"]["next"])
+                url = f"/role?cursor={body['filter']['next']}"
+
+            all_names = [name for page in names for name in page]
+            self.assertEqual(len(all_names), self.total + 3)
+            self.assertEqual(len(set(all_names)), self.total + 3)
+
+            # 从最后一页向前翻页
+            resp = self.api_get(f"/role?cursor={cursors[-1]}")
+            body = get_body_json(resp)
+            resp = self.api_get(f"/role?cursor={body['filter']['prev']}")
+            body = get_body_json(resp)
+            self.assertEqual([x["name"] for x in body["data"]], names[-2])
+
+    def test_invalid_cursor(self):
+        """错误的游标
+        """
+        resp = self.api_get("/role?cursor=notexist")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        validate_default_error(body)
+        self.assertEqual(body["status"], "invalid-cursor")
+
+        def cursor(sort_by, value, _id):
+            return encode_cursor({"sort_by": sort_by, "asc": True,
+                                  "direction": "next", "value": value,
+                                  "id": _id})
+
+        for url in [
+                # 排序值、id 的类型错误
+                f"/role?cursor={cursor('name', {'a': 1}, 1)}",
+                f"/role?cursor={cursor('created', 1546300800, 1)}",
+                f"/role?cursor={cursor('id', 1, [1])}",
+                # 与请求的排序方式不一致
+                f"/role?cursor={cursor('name', 'role', 1)}&sort_by=created",
+        ]:
+            resp = self.api_get(url)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400, url)
+            validate_default_error(body)
+            self.assertEqual(body["status"], "invalid-cursor")
+
+        resp = self.api_get(
+            f"/role?cursor={cursor('name', 'role', 1)}&sort_by=name")
+        self.assertEqual(resp.code, 200)
+
     def test_unknown_sort(self):
         """错误过滤
         """
@@ -290,6 +427,139 @@ class RolePermissionListTestCase(RoleBaseTestCase):
 
         self.assertEqual(len(body["data"]), permission_total)
 
+    def test_inherited(self):
+        """包括从祖先角色继承的权限
+        """
+        roles = [Role(name=f"role{i}") for i in range(3)]
+        for i, role in enumerate(roles):
+            role.permissions.append(Permission(name=f"perm{i}"))
+        self.db.add_all(roles)
+        self.db.commit()
+        # role0 <- role1 <- role2
+        roles[1].add_parent(self.db, roles[0])
+        roles[2].add_parent(self.db, roles[1])
+        self.db.commit()
+        role_id = str(roles[2].uuid)
+
+        for url, names in [
+                (f"/role/{role_id}/permission", ["perm0", "perm1", "perm2"]),
+                (f"/role/{role_id}/permission?inherited=false", ["perm2"])]:
+            resp = self.api_get(url)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 200)
+            self.assertEqual(sorted(p["name"] for p in body["data"]), names)
+
+
+class RoleParentTestCase(RoleBaseTestCase):
+    """/role/{id}/parent - 角色继承
+    """
+
+    def setUp(self):
+        super().setUp()
+        roles = [Role(name=f"role{i}") for i in range(4)]
+        self.db.add_all(roles)
+        self.db.commit()
+        self.role_ids = [str(r.uuid) for r in roles]
+
+    def append(self, role, *parents):
+        return self.api_post(f"/role/{self.role_ids[role]}/parent/append",
+                             body={"parents": [self.role_ids[p] for p in parents]})
+
+    def remove(self, role, *parents):
+        return self.api_post(f"/role/{self.role_ids[role]}/parent/remove",
+                             body={"parents": [self.role_ids[p] for p in parents]})
+
+    def ancestors(self, role):
+        role = self.db.query(Role).filter_by(uuid=self.role_ids[role]).one()
+        return sorted(r.name for r in role.ancestors)
+
+    def test_append_and_remove(self):
+        """增加、删除父角色，闭包随之维护
+        """
+        resp = self.append(1, 0)
+        self.assertEqual(resp.code, 200)
+        resp = self.append(2, 1)
+        self.assertEqual(resp.code, 200)
+
+        resp = self.api_get(f"/role/{self.role_ids[2]}/parent")
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        spec = self.rs.get_role_id_parent.op_spec["responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+        self.assertEqual([r["name"] for r in body["data"]], ["role1"])
+        self.assertEqual(self.ancestors(2), ["role0", "role1"])
+
+        resp = self.remove(1, 0)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.ancestors(2), ["role1"])
+        self.assertEqual(self.ancestors(1), [])
+
+    def test_diamond(self):
+        """多条继承路径：删除其中一条后仍然通过另一条继承
+        """
+        # role3 -> role1 -> role0, role3 -> role2 -> role0
+        self.append(1, 0)
+        self.append(2, 0)
+        self.append(3, 1, 2)
+        self.assertEqual(self.ancestors(3), ["role0", "role1", "role2"])
+
+        self.remove(3, 1)
+        self.assertEqual(self.ancestors(3), ["role0", "role2"])
+        self.remove(2, 0)
+        self.assertEqual(self.ancestors(3), ["role2"])
+
+    def test_cycle(self):
+        """不能继承自身或后代
+        """
+        self.append(1, 0)
+        self.append(2, 1)
+        for role, parent in [(0, 0), (0, 2)]:
+            resp = self.append(role, parent)
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            self.assertEqual(body["status"], "role-cycle")
+            self.assertEqual(body["data"], [self.role_ids[parent]])
+
+    def test_notexist(self):
+        """父角色不存在
+        """
+        notexist = str(uuid.uuid4())
+        resp = self.api_post(f"/role/{self.role_ids[0]}/parent/append",
+                             body={"parents": [notexist]})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(body["status"], "have-not-exist")
+        self.assertEqual(body["data"], [notexist])
+
+    def test_missing_closure(self):
+        """闭包记录缺失时删除继承边报错，不写入 paths <= 0 的记录
+        """
+        self.append(1, 0)
+        self.append(2, 1)
+        roles = {r.name: r for r in self.db.query(Role)}
+        c = _ROLE_CLOSURE.c
+        self.db.execute(_ROLE_CLOSURE.delete().where(
+            c.descendant_id == roles["role2"].id).where(
+            c.ancestor_id == roles["role0"].id))
+        self.db.commit()
+
+        with self.assertRaises(RoleClosureError):
+            roles["role1"].remove_parent(self.db, roles["role0"])
+        self.db.rollback()
+        self.assertEqual(self.ancestors(2), ["role1"])
+        paths = [n for n, in self.db.execute(select([c.paths]))]
+        self.assertTrue(paths)
+        self.assertTrue(all(n > 0 for n in paths))
+
+    def test_delete_role(self):
+        """删除角色时删除相关的继承关系
+        """
+        self.append(1, 0)
+        self.append(2, 1)
+        resp = self.api_delete(f"/role/{self.role_ids[1]}")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.ancestors(2), [])
+
 
 class RolePermissionAppendTestCase(RoleBaseTestCase):
     """POST /role/permission/append - 增加指定角色的权限
@@ -364,6 +634,38 @@ class RolePermissionAppendTestCase(RoleBaseTestCase):
         self.assertEqual(resp.code, 200)
         self.validate_default_success(body)
 
+    def test_idempotent(self):
+        """不存在的角色、权限自动创建，重复增加不报错，不重复记录
+        """
+        names = [f"idem-perm-{i}" for i in range(5)]
+        for _ in range(2):
+            resp = self.api_post("/role/permission/append", body={
+                "role": "idem-role", "permissions": names + names[:2]})
+            self.assertEqual(resp.code, 200)
+
+        role = self.db.query(Role).filter_by(name="idem-role").one()
+        self.assertEqual(sorted(p.name for p in role.permissions), names)
+        self.assertEqual(
+            self.db.query(Permission).filter(
+                Permission.name.like("idem-perm-%")).count(), len(names))
+
+    def test_query_count(self):
+        """查询次数与权限数无关
+        """
+        self.db.add(Role(name="count-role"))
+        self.db.commit()
+        counts = []
+        for total in (5, 100):
+            names = [f"count-perm-{total}-{i}" for i in range(total)]
+            for path in ("/role/permission/append",
+                         "/role/permission/remove"):
+                count, resp = self.count_queries(
+                    self.api_post, path,
+                    body={"role": "count-role", "permissions": names})
+                self.assertEqual(resp.code, 200)
+                counts.append(count)
+        self.assertEqual(counts[:2], counts[2:])
+
 
 class RolePermissionRemoveTestCase(RoleBaseTestCase):
     """POST /role/permission/remove - 删除指定角色的权限
@@ -435,3 +737,16 @@ class RolePermissionRemoveTestCase(RoleBaseTestCase):
 
         self.assertEqual(body["status"], "have-not-exist")
         self.assertEqual(len(body["data"]), notexist_total)
+
+    def test_not_linked(self):
+        """删除角色没有的权限时忽略
+        """
+        role = Role(name="my-role", permissions=[Permission(name="mine")])
+        self.db.add_all([role, Permission(name="other")])
+        self.db.commit()
+
+        resp = self.api_post("/role/permission/remove", body={
+            "role": "my-role", "permissions": ["other", "mine"]})
+        self.assertEqual(resp.code, 200)
+        role = self.db.query(Role).filter_by(name="my-role").one()
+        self.assertEqual(role.permissions, [])
@@ -0,0 +1,250 @@
+import json
+from unittest import mock
+
+from eva.conf import settings
+from sqlalchemy import select
+from tornado.testing import bind_unused_port
+
+from codebase.models import (
+    Permission,
+    Role,
+    _ETCD_OUTBOX,
+)
+from codebase import sync
+from codebase.sync import (
+    OutboxDrainer,
+    get_permission_role_key,
+    reconcile,
+)
+from codebase.utils.etcd import EtcdError, reset_client
+
+from .base import BaseTestCase, parse_metrics
+from .fake_etcd import FakeEtcd
+
+
+def _dead_endpoint():
+    # 取一个未监听的端口，连接会被拒绝
+    sock, port = bind_unused_port()
+    sock.close()
+    return f"127.0.0.1:{port}"
+
+
+class _EtcdBase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.etcd = FakeEtcd()
+        self._settings = (settings.SYCN_ETCD, settings.ETCD_ENDPOINTS)
+        settings.SYCN_ETCD = "true"
+        settings.ETCD_ENDPOINTS = self.etcd.endpoint
+        reset_client()
+
+    def tearDown(self):
+        reset_client()
+        settings.SYCN_ETCD, settings.ETCD_ENDPOINTS = self._settings
+        self.etcd.stop()
+        super().tearDown()
+
+    def get_roles(self, perm_name):
+        value = self.etcd.store.get(get_permission_role_key(perm_name))
+        return json.loads(value) if value is not None else None
+
+
+class EtcdSyncTestCase(_EtcdBase):
+    """通过 outbox 同步授权数据到 etcd
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.drainer = OutboxDrainer()
+
+    def drain(self):
+        return self.io_loop.run_sync(self.drainer.drain_once)
+
+    def outbox(self):
+        return sorted(name for name, in self.db.execute(
+            select([_ETCD_OUTBOX.c.permission])))
+
+    def test_append_and_remove(self):
+        """修改时只写 outbox ，同步时在一个事务中写入所有 key
+        """
+        self.db.add(Role(name="other", permissions=[Permission(name="p0")]))
+        self.db.commit()
+        self.drain()
+        self.etcd.requests.clear()
+
+        resp = self.api_post("/role/permission/append", body={
+            "role": "my-role", "permissions": ["p0", "p1", "p2"]})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.etcd.requests, [])
+        self.assertEqual(self.outbox(), ["p0", "p1", "p2"])
+
+        self.assertEqual(self.drain(), 3)
+        self.assertEqual(len(self.etcd.requests), 1)
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.get_roles("p0"), ["my-role", "other"])
+        self.assertEqual(self.get_roles("p1"), ["my-role"])
+        self.assertEqual(self.get_roles("p2"), ["my-role"])
+
+        resp = self.api_post("/role/permission/remove", body={
+            "role": "my-role", "permissions": ["p0", "p1"]})
+        self.assertEqual(resp.code, 200)
+        self.drain()
+        self.assertEqual(self.get_roles("p0"), ["other"])
+        # 没有任何角色时删除 key
+        self.assertIsNone(self.get_roles("p1"))
+        self.assertEqual(self.get_roles("p2"), ["my-role"])
+
+    def test_coalesce(self):
+        """同一权限的多条 outbox 记录合并为一个 key
+        """
+        for role_name in ("r0", "r1", "r2"):
+            resp = self.api_post("/role/permission/append", body={
+                "role": role_name, "permissions": ["p0"]})
+            self.assertEqual(resp.code, 200)
+        self.assertEqual(self.outbox(), ["p0"] * 3)
+
+        self.assertEqual(self.drain(), 3)
+        self.assertEqual(self.drainer.stats["keys"], 1)
+        self.assertGreaterEqual(self.drainer.stats["lag"], 0)
+        self.assertEqual(self.get_roles("p0"), ["r0", "r1", "r2"])
+        self.assertEqual(self.drain(), 0)
+
+    def test_metrics(self):
+        """运行中的同步任务的延迟、积压与失败次数通过 /_metrics 输出
+        """
+        resp = self.api_post("/role/permission/append", body={
+            "role": "my-role", "permissions": ["p0", "p1", "p2"]})
+        self.assertEqual(resp.code, 200)
+        self.drainer.batch_size = 2
+        self.assertEqual(self.drain(), 2)
+        self.drainer.stats["errors"] = 1
+
+        with mock.patch.object(sync, "_active", self.drainer):
+            resp = self.fetch("/_metrics")
+        self.assertEqual(resp.code, 200)
+        metrics = parse_metrics(resp.body.decode())
+        self.assertEqual(metrics["authz_etcd_outbox_pending"], 1)
+        self.assertEqual(metrics["authz_etcd_outbox_synced_total"], 2)
+        self.assertEqual(metrics["authz_etcd_outbox_errors_total"], 1)
+        self.assertGreaterEqual(metrics["authz_etcd_outbox_lag_seconds"], 0)
+
+        # 没有运行同步任务时不输出
+        resp = self.fetch("/_metrics")
+        self.assertNotIn("authz_etcd_outbox", resp.body.decode())
+
+    def test_inherited(self):
+        """增加父角色后，子角色出现在继承的权限中
+        """
+        parent = Role(name="parent", permissions=[Permission(name="p0")])
+        child = Role(name="child")
+        self.db.add_all([parent, child])
+        self.db.commit()
+        parent_id, child_id = str(parent.uuid), str(child.uuid)
+
+        resp = self.api_post(f"/role/{child_id}/parent/append",
+                             body={"parents": [parent_id]})
+        self.assertEqual(resp.code, 200)
+        self.drain()
+        self.assertEqual(self.get_roles("p0"), ["child", "parent"])
+
+        resp = self.api_post(f"/role/{child_id}/parent/remove",
+                             body={"parents": [parent_id]})
+        self.assertEqual(resp.code, 200)
+        self.drain()
+        self.assertEqual(self.get_roles("p0"), ["parent"])
+
+    def test_failover(self):
+        """第一个 endpoint 不可用时使用下一个
+        """
+        settings.ETCD_ENDPOINTS = f"{_dead_endpoint()};{self.etcd.endpoint}"
+        reset_client()
+
+        for name in ("p0", "p1"):
+            resp = self.api_post("/role/permission/append", body={
+                "role": "my-role", "permissions": [name]})
+            self.assertEqual(resp.code, 200)
+            self.drain()
+            self.assertEqual(self.get_roles(name), ["my-role"])
+
+    def test_etcd_unavailable(self):
+        """etcd 不可用时请求不受影响，outbox 保留到同步成功
+        """
+        self.etcd.failing = True
+        resp = self.api_post("/role/permission/append", body={
+            "role": "my-role", "permissions": ["p0"]})
+        self.assertEqual(resp.code, 200)
+
+        with self.assertRaises(EtcdError):
+            self.drain()
+        self.assertEqual(self.outbox(), ["p0"])
+        self.assertEqual(self.etcd.store, {})
+
+        self.etcd.failing = False
+        self.assertEqual(self.drain(), 1)
+        self.assertEqual(self.get_roles("p0"), ["my-role"])
+        self.assertEqual(self.outbox(), [])
+
+    def test_backoff(self):
+        """失败后重试间隔指数增长，不超过上限
+        """
+        drainer = OutboxDrainer(interval=1, max_backoff=10)
+        delays = []
+        for drainer.failures in range(1, 6):
+            delays.append(drainer.backoff())
+        self.assertEqual(delays, [2, 4, 8, 10, 10])
+
+
+class ReconcileTestCase(_EtcdBase):
+    """根据数据库全量校正 etcd
+    """
+
+    def reconcile(self, **kwargs):
+        return self.io_loop.run_sync(lambda: reconcile(**kwargs))
+
+    def test_reconcile(self):
+        """只写入有差异的 key ，删除多余的 key
+        """
+        settings.SYCN_ETCD = "false"
+        parent = Role(name="parent", permissions=[
+            Permission(name=f"p{i}") for i in range(5)])
+        child = Role(name="child")
+        self.db.add_all([parent, child, Permission(name="no-role")])
+        self.db.commit()
+        child.add_parent(self.db, parent)
+        self.db.commit()
+
+        key = get_permission_role_key
+        self.etcd.store.update({
+            key("p0"): '["child", "parent"]',
+            key("p1"): '["parent"]',
+            key("p2"): '["child","parent"]',
+            key("no-role"): '["parent"]',
+            key("deleted"): '["parent"]',
+            "ga.auth.permissions.other": "keep",
+        })
+        before = dict(self.etcd.store)
+
+        stats = self.reconcile(batch_size=2, dry_run=True)
+        self.assertEqual(self.etcd.store, before)
+        self.assertEqual(stats["permissions"],
+                         self.db.query(Permission).count())
+        # p1 错误，p3 / p4 缺失；no-role / deleted 多余
+        self.assertEqual((stats["put"], stats["delete"]), (3, 2))
+
+        stats = self.reconcile(batch_size=2)
+        self.assertEqual((stats["put"], stats["delete"]), (3, 2))
+        for i in range(5):
+            self.assertEqual(self.get_roles(f"p{i}"), ["child", "parent"])
+        self.assertIsNone(self.get_roles("no-role"))
+        self.assertIsNone(self.get_roles("deleted"))
+        self.assertEqual(self.etcd.store["ga.auth.permissions.other"], "keep")
+
+        # 没有差异时不写入
+        self.etcd.requests.clear()
+        stats = self.reconcile(batch_size=2)
+        self.assertEqual((stats["put"], stats["delete"]), (0, 0))
+        self.assertFalse(any(
+            "request_put" in op or "request_delete_range" in op
+            for _, body in self.etcd.requests
+            for op in body.get("success", [])))
@@ -1,9 +1,20 @@
+import re
 import uuid
+from unittest import mock
 
+from eva.conf import settings
+from sqlalchemy import literal, select
+from sqlalchemy.exc import IntegrityError
+
+from codebase import bulk
+from codebase.bulk import insert_links
 from codebase.models import (
     Role,
-    User
+    User,
+    make_link_indexes_unique,
+    _USER_ROLES,
 )
+from codebase.utils.sqlalchemy import dbc
 from codebase.utils.swaggerui import api
 
 from .base import (
@@ -108,6 +119,21 @@ class UserRoleAppendTestCase(_BaseTestCase):
         self.assertEqual(body["status"], "have-not-exist")
         self.assertEqual(len(body["data"]), notexist_total)
 
+    def test_append_twice(self):
+        """重复增加角色不报错，不重复记录
+        """
+        role = Role(name="twice")
+        self.db.add(role)
+        self.db.commit()
+        user_id, role_id = str(uuid.uuid4()), str(role.uuid)
+
+        for _ in range(2):
+            resp = self.api_post(f"/user/{user_id}/role/append", body={
+                "roles": [role_id, role_id]})
+            self.assertEqual(resp.code, 200)
+        user = self.db.query(User).filter_by(uuid=user_id).one()
+        self.assertEqual([str(r.uuid) for r in user.roles], [role_id])
+
 
 class UserRoleRemoveTestCase(_BaseTestCase):
     """POST /user/{id}/role/remove - 删除指定用户的角色
@@ -176,3 +202,192 @@ class UserRoleRemoveTestCase(_BaseTestCase):
 
         self.assertEqual(body["status"], "have-not-exist")
         self.assertEqual(len(body["data"]), notexist_total)
+
+
+class UserRoleBulkTestCase(_BaseTestCase):
+    """POST /user/role/append 、/user/role/remove - 批量修改用户的角色
+    """
+
+    def setUp(self):
+        super().setUp()
+        self._settings = (settings.USER_ROLE_BULK_MAX_USERS,
+                          settings.BULK_CHUNK_SIZE)
+        for i in range(3):
+            self.db.add(Role(name=f"bulk-role-{i}"))
+        self.db.add(User(uuid=str(uuid.uuid4())))
+        self.db.commit()
+        self.role_ids = [str(r.uuid) for r in self.db.query(Role).filter(
+            Role.name.like("bulk-role-%"))]
+        self.user_ids = [str(self.db.query(User).filter(
+            User.id != self.current_user.id).one().uuid)]
+        self.user_ids += [str(uuid.uuid4()) for _ in range(9)]
+
+    def tearDown(self):
+        (settings.USER_ROLE_BULK_MAX_USERS,
+         settings.BULK_CHUNK_SIZE) = self._settings
+        super().tearDown()
+
+    def user_roles(self, user_id):
+        user = self.db.query(User).filter_by(uuid=user_id).first()
+        return sorted(str(r.uuid) for r in user.roles) if user else None
+
+    def test_append(self):
+        """增加角色，不存在的用户自动创建，重复增加不报错
+        """
+        settings.BULK_CHUNK_SIZE = "4"
+        resp = self.api_post("/user/role/append", body={
+            "users": self.user_ids, "roles": self.role_ids})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        spec = self.rs.post_user_role_append.op_spec[
+            "responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+        self.assertEqual(body["data"], {"users": 10, "created_users": 9,
+                                        "added": 30})
+        for user_id in self.user_ids:
+            self.assertEqual(self.user_roles(user_id), sorted(self.role_ids))
+
+        resp = self.api_post("/user/role/append", body={
+            "users": self.user_ids, "roles": self.role_ids})
+        body = get_body_json(resp)
+        self.assertEqual(body["data"], {"users": 10, "created_users": 0,
+                                        "added": 0})
+
+    def test_change_log_chunks(self):
+        """用户数超过分批大小时，变更日志按批查询用户 uuid
+        """
+        # 已存在的用户：变更中没有附带 uuid ，需要从数据库读取
+        self.db.add_all(User(uuid=u) for u in self.user_ids[1:5])
+        self.db.commit()
+        settings.BULK_CHUNK_SIZE = "4"
+        start = get_body_json(self.api_get("/changes"))["data"]["revision"]
+        with self.assertMaxQueries(100) as recorder:
+            resp = self.api_post("/user/role/append", body={
+                "users": self.user_ids[:5], "roles": self.role_ids[:1]})
+        self.assertEqual(resp.code, 200)
+        for statement in recorder.statements:
+            for params in re.findall(r" IN \(([?, ]*)\)", statement):
+                self.assertLessEqual(params.count("?"), 4, statement)
+
+        resp = self.api_get(f"/changes?since={start}")
+        data = get_body_json(resp)["data"]
+        self.assertEqual(sorted(data["users"]), sorted(self.user_ids[:5]))
+        self.assertEqual(data["roles"], self.role_ids[:1])
+
+    def test_remove(self):
+        """删除角色，不存在的用户与用户没有的角色忽略
+        """
+        self.api_post("/user/role/append", body={
+            "users": self.user_ids[:5], "roles": self.role_ids})
+        resp = self.api_post("/user/role/remove", body={
+            "users": self.user_ids, "roles": self.role_ids[:2]})
+        body = get_body_json(resp)
+        self.assertEqual(resp.code, 200)
+        spec = self.rs.post_user_role_remove.op_spec[
+            "responses"]["200"]["schema"]
+        api.validate_object(spec, body)
+        self.assertEqual(body["data"], {"users": 10, "removed": 10})
+        for user_id in self.user_ids[:5]:
+            self.assertEqual(self.user_roles(user_id), self.role_ids[2:])
+        self.assertIsNone(self.user_roles(self.user_ids[-1]))
+
+    def test_query_count(self):
+        """查询次数与用户数无关
+        """
+        counts = []
+        for total in (5, 50):
+            users = [str(uuid.uuid4()) for _ in range(total)]
+            for path in ("/user/role/append", "/user/role/remove"):
+                count, resp = self.count_queries(
+                    self.api_post, path,
+                    body={"users": users, "roles": self.role_ids})
+                self.assertEqual(resp.code, 200)
+                counts.append(count)
+        self.assertEqual(counts[:2], counts[2:])
+
+    def test_notexist_roles(self):
+        """使用不存在的角色ID
+        """
+        notexist = [str(uuid.uuid4()) for _ in range(2)]
+        for path in ("/user/role/append", "/user/role/remove"):
+            resp = self.api_post(path, body={
+                "users": self.user_ids, "roles": self.role_ids + notexist})
+            body = get_body_json(resp)
+            self.assertEqual(resp.code, 400)
+            spec = self.rs.post_user_role_append.op_spec[
+                "responses"]["default"]["schema"]
+            api.validate_object(spec, body)
+            self.assertEqual(body["status"], "have-not-exist")
+            self.assertEqual(sorted(body["data"]), sorted(notexist))
+
+    def test_invalid_argument(self):
+        """参数错误、用户数超过限制
+        """
+        for body in ({"users": self.user_ids},
+                     {"users": ["bad"], "roles": self.role_ids},
+                     {"users": "x", "roles": self.role_ids}):
+            resp = self.api_post("/user/role/append", body=body)
+            self.assertEqual(get_body_json(resp)["status"], "invalid-argument")
+
+        settings.USER_ROLE_BULK_MAX_USERS = "5"
+        resp = self.api_post("/user/role/append", body={
+            "users": self.user_ids, "roles": self.role_ids})
+        self.assertEqual(get_body_json(resp)["status"], "too-many-users")
+
+
+class UserRoleUniqueTestCase(_BaseTestCase):
+    """用户角色关联唯一
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.role = Role(name="unique-role")
+        self.db.add(self.role)
+        self.db.commit()
+        self.user_id = self.current_user.id
+
+    def links(self):
+        return self.db.query(_USER_ROLES).filter_by(
+            user_id=self.user_id, role_id=self.role.id).count()
+
+    def test_concurrent_insert(self):
+        """查询已有关联之后其他请求插入了相同的关联
+        """
+        pair = (self.user_id, self.role.id)
+        row = {"user_id": pair[0], "role_id": pair[1]}
+        self.db.execute(_USER_ROLES.insert(), row)
+        with self.assertRaises(IntegrityError):
+            self.db.execute(_USER_ROLES.insert(), row)
+        self.db.rollback()
+
+        self.db.execute(_USER_ROLES.insert(), row)
+        # 查询已有关联时还看不到其他请求插入的记录
+        with mock.patch.object(
+                bulk, "select",
+                lambda columns: select(columns).where(literal(False))):
+            insert_links(self.db, _USER_ROLES, _USER_ROLES.c.user_id,
+                         _USER_ROLES.c.role_id, "user_role", [pair])
+        self.db.commit()
+        self.assertEqual(self.links(), 1)
+
+    def test_migration(self):
+        """迁移删除重复的关联，并创建唯一索引
+        """
+        index = next(iter(_USER_ROLES.indexes))
+        with dbc.engine.begin() as conn:
+            # 旧版本的非唯一索引
+            index.drop(conn)
+            conn.execute(f"CREATE INDEX {index.name} "
+                         f"ON authz_user__role (user_id, role_id)")
+            conn.execute(_USER_ROLES.insert(), [
+                {"user_id": self.user_id, "role_id": self.role.id}] * 3)
+
+        for removed in (2, None):
+            with dbc.engine.begin() as conn:
+                result = make_link_indexes_unique(conn)
+            self.assertEqual(result.get("authz_user__role"), removed)
+        self.assertEqual(self.links(), 1)
+        with self.assertRaises(IntegrityError):
+            self.db.execute(_USER_ROLES.insert(), {
+                "user_id": self.user_id, "role_id": self.role.id})
+        self.db.rollback()